@@ -0,0 +1,185 @@
+import os
+import random
+from datetime import datetime, timedelta
+from json import dumps
+from os.path import join
+from sql_gen import TableMD
+from typing import Callable, Dict, Iterator, List, Optional
+
+
+# values of the low cardinality columns of the sample files (raw_data/events, raw_data/orgs)
+EVENT_TYPES = ["User Created", "User Updated", "User Deleted"]
+USER_TYPES = ["Admin", "User", "Creator"]
+PLAN_NAMES = ["Free", "Medium", "Enterprise", None]
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+class DataGenerator:
+    """
+    Generates synthetic records shaped like the sample input files, for any table metadata file. Well known
+    columns (ids, user and organization columns...) get values looking like the samples, other columns get values
+    according to their type. Organization names are drawn from a fixed pool, so the organizations and the events
+    generated with the same generator refer to each other. Timestamps are spread uniformly over the days of the
+    date range, in random order like in the samples.
+    :param start_date: First day (YYYY-MM-DD) of the timestamps
+    :type start_date: str
+    :param days: Number of days the timestamps are spread over
+    :type days: int
+    :param n_orgs: Number of distinct organizations
+    :type n_orgs: int
+    :param n_users: Number of distinct users
+    :type n_users: int
+    :param duplicate_ratio: Share of the records reusing the id of an earlier record (i.e. updates of the same
+    entity, exercising the upsert)
+    :type duplicate_ratio: float
+    :param seed: Seed of the random generator, the same seed generates the same records
+    :type seed: int
+    """
+
+    def __init__(
+        self,
+        start_date: str = "2020-12-01",
+        days: int = 7,
+        n_orgs: int = 100,
+        n_users: int = 10000,
+        duplicate_ratio: float = 0.0,
+        seed: int = 0,
+    ):
+        self.start = datetime.strptime(start_date, "%Y-%m-%d")
+        self.seconds = days * 86400
+        self.n_users = n_users
+        self.duplicate_ratio = duplicate_ratio
+        self.rng = random.Random(seed)
+        self.org_names = [f"Organization {i}" for i in range(n_orgs)]
+        self._ids: List[str] = []
+
+    def _hex_id(self) -> str:
+        return "%032x" % self.rng.getrandbits(128)
+
+    def _id(self) -> str:
+        if self._ids and self.rng.random() < self.duplicate_ratio:
+            return self.rng.choice(self._ids)
+        value = self._hex_id()
+        self._ids.append(value)
+        return value
+
+    def _timestamp(self) -> str:
+        offset = timedelta(seconds=self.rng.random() * self.seconds)
+        return (self.start + offset).strftime(TIMESTAMP_FORMAT)
+
+    def _username(self) -> str:
+        return f"user{self.rng.randrange(self.n_users)}"
+
+    def _by_type(self, column: Dict) -> Callable[[dict], object]:
+        column_type = str(column.get("type")).strip().lower()
+        if column_type.startswith("timestamp") or column_type == "date":
+            return lambda record: self._timestamp()
+        if column_type in ("int", "integer", "int4", "bigint", "int8", "smallint", "int2"):
+            return lambda record: self.rng.randrange(1 << 15)
+        if column_type in ("real", "float4", "double precision", "float8"):
+            return lambda record: self.rng.random()
+        if column_type in ("bool", "boolean"):
+            return lambda record: self.rng.random() < 0.5
+        length = min(int(column.get("length") or 16), 16)
+        return lambda record: "%0*x" % (length, self.rng.getrandbits(length * 4))
+
+    def column_generator(self, column: Dict) -> Callable[[dict], object]:
+        """Function generating the value of a column, given the values generated so far for the record"""
+        name = column["name"]
+        if name == "id":
+            return lambda record: self._id()
+        if name == "organization_key":
+            return lambda record: self._hex_id()
+        if name == "event_type":
+            return lambda record: self.rng.choice(EVENT_TYPES)
+        if name == "user_type":
+            return lambda record: self.rng.choice(USER_TYPES)
+        if name == "plan_name":
+            return lambda record: self.rng.choice(PLAN_NAMES)
+        if name == "username":
+            return lambda record: self._username()
+        if name == "user_email":
+            return lambda record: f"{record.get('username') or self._username()}@example.com"
+        if name == "organization_name":
+            return lambda record: self.rng.choice(self.org_names)
+        return self._by_type(column)
+
+    def records(self, table_md: TableMD, n_rows: int) -> Iterator[dict]:
+        """
+        Generates the records of a table metadata file
+        :param table_md: Table metadata, a value is generated for each of its columns
+        :type table_md: TableMD
+        :param n_rows: Number of records
+        :type n_rows: int
+        """
+        generators = [(col["name"], self.column_generator(col)) for col in table_md.columns]
+        for _ in range(n_rows):
+            record = {}
+            for name, generate in generators:
+                record[name] = generate(record)
+            yield record
+
+    def organizations(self, table_md: TableMD) -> Iterator[dict]:
+        """One record per organization of the pool, for the organizations table metadata"""
+        for record, name in zip(self.records(table_md, len(self.org_names)), self.org_names):
+            record["organization_name"] = name
+            yield record
+
+
+def write_json_file(path: str, records: Iterator[dict]) -> int:
+    """Writes records as a JSON list (the layout of the sample files), returns the number of records written"""
+    n_records = 0
+    with open(path, "w") as f:
+        f.write("[")
+        for record in records:
+            f.write(",\n  " if n_records else "\n  ")
+            f.write(dumps(record))
+            n_records += 1
+        f.write("\n]\n")
+    return n_records
+
+
+def generate_dataset(
+    tables_md_dir: str,
+    raw_data_dir: str,
+    rows: int,
+    files: int = 1,
+    generator: Optional[DataGenerator] = None,
+) -> Dict[str, List[str]]:
+    """
+    Generates the input files of every table metadata file of a directory, laid out like raw_data
+    ({raw_data_dir}/{load_prefix}/*.json) so that file_op.import_sources can load them. Tables with a filter key
+    (events) get rows records split over files files, the other ones (organizations) get one record per
+    organization of the generator.
+    :param tables_md_dir: Path leading to table metadata directory
+    :type tables_md_dir: str
+    :param raw_data_dir: Directory the input files are written to
+    :type raw_data_dir: str
+    :param rows: Number of records of the tables with a filter key
+    :type rows: int
+    :param files: Number of files the records of a table with a filter key are split into
+    :type files: int
+    :param generator: Generator of the records, a default one when not given
+    :type generator: Optional[DataGenerator]
+    :return: Paths of the generated files, by load prefix
+    :rtype: Dict[str, List[str]]
+    """
+    generator = generator or DataGenerator()
+    paths: Dict[str, List[str]] = {}
+    for table_md_file in sorted(os.listdir(tables_md_dir)):
+        md = TableMD(table_md_path=join(tables_md_dir, table_md_file))
+        src_dir = join(raw_data_dir, md.load_prefix)
+        os.makedirs(src_dir, exist_ok=True)
+        if not md.filter_key:
+            path = join(src_dir, f"{md.load_prefix}_0.json")
+            write_json_file(path, generator.organizations(md))
+            paths[md.load_prefix] = [path]
+            continue
+        paths[md.load_prefix] = []
+        for i in range(files):
+            # the first files take the remainder
+            n_rows = rows // files + (1 if i < rows % files else 0)
+            path = join(src_dir, f"{md.load_prefix}_{i}.json")
+            write_json_file(path, generator.records(md, n_rows))
+            paths[md.load_prefix].append(path)
+    return paths
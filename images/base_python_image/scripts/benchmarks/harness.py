@@ -0,0 +1,181 @@
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+
+# how often the resident set size is sampled while a stage runs
+RSS_SAMPLE_INTERVAL = 0.01
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss() -> int:
+    """Resident set size of the process in bytes, the peak so far where /proc is not available"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RssSampler:
+    """Samples the resident set size of the process in a background thread, keeping the peak"""
+
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+
+    def __run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self) -> "RssSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """p50, p95, p99 and max of latencies in seconds, reported in milliseconds"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def at(q: float) -> float:
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000, 3)
+
+    return {"p50": at(0.5), "p95": at(0.95), "p99": at(0.99), "max": at(1)}
+
+
+@dataclass
+class StageResult:
+    """
+    Measurements of a benchmark stage
+    :param name: Name of the stage
+    :type name: str
+    :param rows: Number of rows (events) processed by the stage
+    :type rows: int
+    :param seconds: Wall clock duration of the stage
+    :type seconds: float
+    :param rows_per_sec: Throughput of the stage
+    :type rows_per_sec: float
+    :param peak_rss_mb: Peak resident set size of the process while the stage ran
+    :type peak_rss_mb: float
+    :param latency_ms: Percentiles of the latency of the units of work of the stage (a file, a message...)
+    :type latency_ms: Dict[str, float]
+    """
+
+    name: str
+    rows: int = 0
+    seconds: float = 0.0
+    rows_per_sec: float = 0.0
+    peak_rss_mb: float = 0.0
+    latency_ms: Dict[str, float] = field(default_factory=dict)
+
+
+class Stage:
+    """Handed over to the measured block, which reports the rows it processed and the latency of its units of work"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.rows = 0
+        self.latencies: List[float] = []
+
+    @contextmanager
+    def unit(self) -> Iterator[None]:
+        """Times a unit of work of the stage"""
+        start = time.perf_counter()
+        yield
+        self.latencies.append(time.perf_counter() - start)
+
+
+class Benchmark:
+    """
+    Collects the measurements of the stages of a benchmark run and saves them as JSON, along with the parameters of
+    the run, so that runs can be compared (see compare).
+    :param params: Parameters of the run (data size, options...)
+    :type params: Dict
+    """
+
+    def __init__(self, params: Dict):
+        self.params = params
+        self.stages: List[StageResult] = []
+
+    @contextmanager
+    def measure(self, name: str) -> Iterator[Stage]:
+        stage = Stage(name)
+        with RssSampler() as sampler:
+            start = time.perf_counter()
+            yield stage
+            seconds = time.perf_counter() - start
+        result = StageResult(
+            name=name,
+            rows=stage.rows,
+            seconds=round(seconds, 6),
+            rows_per_sec=round(stage.rows / seconds, 1) if seconds else 0.0,
+            peak_rss_mb=round(sampler.peak / (1 << 20), 1),
+            latency_ms=percentiles(stage.latencies),
+        )
+        print(
+            f"{name}: {result.rows} rows in {result.seconds:.3f}s, {result.rows_per_sec:.0f} rows/s, "
+            f"peak RSS {result.peak_rss_mb} MB, latency {result.latency_ms}"
+        )
+        self.stages.append(result)
+
+    def results(self) -> Dict:
+        return {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "params": self.params,
+            "stages": {stage.name: asdict(stage) for stage in self.stages},
+        }
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.results(), f, indent=2)
+
+
+def compare(baseline: Dict, current: Dict, tolerance: float = 0.1) -> List[str]:
+    """
+    Compares the results of two runs stage by stage
+    :param baseline: Results of the reference run (as saved by Benchmark.save)
+    :type baseline: Dict
+    :param current: Results of the run to check
+    :type current: Dict
+    :param tolerance: Relative throughput drop (or peak RSS increase) tolerated before a stage counts as regressed
+    :type tolerance: float
+    :return: Description of every regression, empty when there is none
+    :rtype: List[str]
+    """
+    regressions = []
+    for name, stage in current["stages"].items():
+        reference: Optional[Dict] = baseline["stages"].get(name)
+        if reference is None:
+            continue
+        if stage["rows_per_sec"] < reference["rows_per_sec"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {stage['rows_per_sec']:.0f} rows/s, was {reference['rows_per_sec']:.0f} rows/s"
+            )
+        if stage["peak_rss_mb"] > reference["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: peak RSS {stage['peak_rss_mb']} MB, was {reference['peak_rss_mb']} MB"
+            )
+    return regressions
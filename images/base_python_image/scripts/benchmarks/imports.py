@@ -0,0 +1,85 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from statistics import median
+from typing import Dict, List
+
+
+ROOT_DIR = Path(__file__).parent.parent.absolute()
+# modules imported by every entry point (mode) before it starts working
+ENTRY_POINTS = {
+    "producer": ["queue_implementation.main", "queue_implementation.watcher"],
+    "consumer": ["queue_implementation.main", "queue_implementation.consumer", "sql_gen"],
+    "consumer-async": ["queue_implementation.main", "queue_implementation.async_consumer", "sql_gen"],
+    "cli": ["main"],
+    "load": ["main", "file_op", "rollup"],
+    "queue-cli": ["queue_implementation.cli"],
+}
+# third party modules worth knowing about when they are loaded
+HEAVY_MODULES = ["pandas", "numpy", "pyarrow", "pika", "watchdog", "pyfiglet", "termcolor", "psycopg2", "yaml"]
+# imports and reports in a fresh interpreter, so that nothing is cached by the benchmark itself
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+elapsed = time.perf_counter() - start
+print(json.dumps({{"ms": elapsed * 1000, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(modules: List[str], repeat: int = 5) -> Dict:
+    """
+    Time taken to import modules in a new interpreter, as the entry points do on startup
+    :param modules: Modules imported, in order
+    :type modules: List[str]
+    :param repeat: Number of interpreters started, the median time is reported
+    :type repeat: int
+    :return: Median import time (ms) and the heavy modules loaded
+    :rtype: Dict
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(ROOT_DIR), os.environ.get("PYTHONPATH")])))
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE.format(modules=modules, heavy=HEAVY_MODULES)],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        ).stdout
+        runs.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+    return {"import_ms": round(median(run["ms"] for run in runs), 1), "loaded": runs[-1]["loaded"]}
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Measures the startup (import) time of the entry points")
+    parser.add_argument(
+        "--entry-points", nargs="+", choices=list(ENTRY_POINTS), default=list(ENTRY_POINTS), help="entry points measured"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="interpreters started per entry point")
+    parser.add_argument(
+        "--budget-ms", type=float, help="exit with a non-zero code if an entry point takes longer to import"
+    )
+    return parser.parse_args(args)
+
+
+def main(argv: List[str]) -> int:
+    args = parse_args(argv)
+    over_budget = []
+    for name in args.entry_points:
+        result = measure(ENTRY_POINTS[name], repeat=args.repeat)
+        print(f"{name:<16}{result['import_ms']:>8.1f} ms  {', '.join(result['loaded']) or '-'}")
+        if args.budget_ms is not None and result["import_ms"] > args.budget_ms:
+            over_budget.append(name)
+    if over_budget:
+        print(f"over the {args.budget_ms} ms budget: {', '.join(over_budget)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
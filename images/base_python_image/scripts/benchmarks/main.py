@@ -0,0 +1,295 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from os.path import basename, join
+from pathlib import Path
+from queue import Queue
+from tempfile import TemporaryDirectory
+from typing import Iterator, List, Set
+
+from benchmarks.datagen import DataGenerator, generate_dataset
+from benchmarks.harness import Benchmark, Stage, compare
+from file_op import extract_data
+from psql_client import PgHook
+from queue_implementation.transport import InMemoryBroker, InMemoryTransport
+from sql_gen import SQLGenerator, TableMD
+
+
+ROOT_DIR = Path(__file__).parent.parent.absolute()
+TABLE_METADATA_DIR = join(ROOT_DIR, "table_metadata")
+QUEUE_TABLE_METADATA_PATH = join(ROOT_DIR, "queue_implementation", "table_metadata", "raw_events.yaml")
+FACT_EVENTS_SQL = join(ROOT_DIR, "modelling", "fact_events.sql")
+RESULTS_DIR = join(ROOT_DIR, "benchmarks", "results")
+# the Watcher moves the files it published there
+PROCESSED_DIR = join(os.sep, "tmp", "processed")
+
+STAGES = [
+    "datagen",
+    "extract_data",
+    "copy_expert",
+    "upsert_on_id",
+    "fact_events",
+    "watcher",
+    "consumer_single",
+    "consumer_batch",
+]
+DB_STAGES = {"copy_expert", "upsert_on_id", "fact_events", "consumer_single", "consumer_batch"}
+# stages producing what a stage works on, they run (unmeasured) even when only the later stage is asked for
+REQUIRES = {
+    "copy_expert": ["extract_data"],
+    "upsert_on_id": ["copy_expert"],
+    "fact_events": ["upsert_on_id"],
+    "consumer_single": ["watcher"],
+    "consumer_batch": ["watcher"],
+}
+
+
+def stages_to_run(measured: List[str]) -> Set[str]:
+    """Measured stages along with the stages they depend on"""
+    to_run = set()
+    pending = list(measured)
+    while pending:
+        stage = pending.pop()
+        if stage not in to_run:
+            to_run.add(stage)
+            pending += REQUIRES.get(stage, [])
+    return to_run
+
+
+@contextmanager
+def unmeasured(name: str) -> Iterator[Stage]:
+    yield Stage(name)
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Measures the throughput of the load and queue paths on synthetic data"
+    )
+    parser.add_argument("--rows", type=int, default=100000, help="number of events generated")
+    parser.add_argument("--files", type=int, default=4, help="number of events files")
+    parser.add_argument("--days", type=int, default=7, help="days the events are spread over")
+    parser.add_argument("--start-date", default="2020-12-01", help="first day of the events")
+    parser.add_argument("--orgs", type=int, default=100, help="number of organizations")
+    parser.add_argument("--users", type=int, default=10000, help="number of users")
+    parser.add_argument(
+        "--duplicate-ratio", type=float, default=0.05, help="share of events updating an earlier id"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--stages",
+        default=",".join(STAGES),
+        help=f"comma separated stages to measure, out of {','.join(STAGES)}",
+    )
+    parser.add_argument(
+        "--no-db", action="store_true", help="skip the stages needing PostgreSQL"
+    )
+    parser.add_argument(
+        "--chunk-rows", type=int, default=0, help="records per chunk of extract_data (0 parses files at once)"
+    )
+    parser.add_argument("--pack-size", type=int, default=0, help="events per message (Watcher)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="events per COPY (batch Consumer)")
+    parser.add_argument("--copy-format", default="csv", help="COPY format of the batch Consumer")
+    parser.add_argument(
+        "--work-dir", help="directory of the generated data, kept after the run (a temporary one otherwise)"
+    )
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="results file of a previous run to check for regressions")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="relative slowdown tolerated by --compare"
+    )
+    return parser.parse_args(args)
+
+
+def publish_files(broker: InMemoryBroker, paths: List[str], args: argparse.Namespace) -> None:
+    """Publishes input files onto the events queue of the broker with the Watcher"""
+    from queue_implementation.watcher import Watcher
+
+    watch_dir = join(args.work_dir, "watched")
+    os.makedirs(watch_dir, exist_ok=True)
+    # unique names, the Watcher can not move a file over one it processed earlier
+    token = f"{os.getpid()}_{datetime.now():%Y%m%d%H%M%S%f}"
+    names = [f"bench_{token}_{basename(path)}" for path in paths]
+    for path, name in zip(paths, names):
+        shutil.copy(path, join(watch_dir, name))
+    # existing files are published before the constructor returns
+    watcher = Watcher(
+        path=watch_dir,
+        watchdog_queue=Queue(),
+        rabbitmq_queue="events",
+        pack_size=args.pack_size or None,
+        workers=1,
+        transport=InMemoryTransport(broker),
+    )
+    watcher.close()
+    for name in names:
+        try:
+            os.remove(join(PROCESSED_DIR, name))
+        except OSError:
+            pass
+
+
+def consume(broker: InMemoryBroker, messages: List, args: argparse.Namespace, batch: bool) -> None:
+    """Consumes messages from the broker with the Consumer, until every message was acknowledged"""
+    from queue_implementation.consumer import Consumer
+
+    broker.queue("events").extend(messages)
+    broker.ack_latencies = []
+    consumer = Consumer(
+        host="",
+        queue="events",
+        table_md=TableMD(table_md_path=QUEUE_TABLE_METADATA_PATH),
+        batch_size=args.batch_size,
+        max_linger=0.1,
+        copy_format=args.copy_format,
+        transport=InMemoryTransport(broker),
+    )
+    thread = threading.Thread(
+        target=consumer.batch_load_to_pgres if batch else consumer.consume_events,
+        daemon=True,
+    )
+    thread.start()
+    while not broker.wait_idle(timeout=0.5):
+        if not thread.is_alive():
+            raise RuntimeError("the consumer stopped before acknowledging every message")
+    consumer.stop()
+    thread.join()
+    consumer.close()
+
+
+def run(args: argparse.Namespace) -> Benchmark:
+    measured = [stage for stage in args.stages.split(",") if stage]
+    unknown = set(measured) - set(STAGES)
+    if unknown:
+        raise ValueError(f"unknown stages {sorted(unknown)}, expected some of {STAGES}")
+    if args.no_db:
+        measured = [stage for stage in measured if stage not in DB_STAGES]
+    to_run = stages_to_run(measured)
+
+    bench = Benchmark(
+        params={
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "compare", "work_dir")
+        }
+    )
+
+    def stage(name: str):
+        return bench.measure(name) if name in measured else unmeasured(name)
+
+    with stage("datagen") as s:
+        generator = DataGenerator(
+            start_date=args.start_date,
+            days=args.days,
+            n_orgs=args.orgs,
+            n_users=args.users,
+            duplicate_ratio=args.duplicate_ratio,
+            seed=args.seed,
+        )
+        paths = generate_dataset(
+            tables_md_dir=TABLE_METADATA_DIR,
+            raw_data_dir=join(args.work_dir, "raw_data"),
+            rows=args.rows,
+            files=args.files,
+            generator=generator,
+        )
+        s.rows = args.rows + args.orgs
+    events_paths = paths["events"]
+    table_md = TableMD(table_md_path=join(TABLE_METADATA_DIR, "raw_events.yaml"))
+    sql_gen = SQLGenerator(table_md=table_md)
+    csv_paths = [path[: -len(".json")] + ".csv" for path in events_paths]
+    pg_hook = PgHook()
+
+    if "extract_data" in to_run:
+        with stage("extract_data") as s:
+            for src_path, dst_path in zip(events_paths, csv_paths):
+                with s.unit():
+                    extract_data(
+                        src_path=src_path,
+                        dst_path=dst_path,
+                        columns=[col.get("name") for col in table_md.columns],
+                        chunk_rows=args.chunk_rows or None,
+                    )
+            s.rows = args.rows
+
+    if "copy_expert" in to_run:
+        master_table = table_md.delta_params["master_table"]
+        pg_hook.execute(
+            [
+                sql_gen.drop_table(),
+                sql_gen.create_table_query(),
+                f"DROP TABLE IF EXISTS {table_md.schema_name}.{master_table}",
+            ]
+        )
+        with stage("copy_expert") as s:
+            for csv_path in csv_paths:
+                with s.unit():
+                    pg_hook.copy_expert(query=sql_gen.copy_query(), src_path=csv_path)
+            s.rows = args.rows
+
+    if "upsert_on_id" in to_run:
+        server_version = pg_hook.server_version()
+        with stage("upsert_on_id") as s:
+            pg_hook.execute(sql_gen.upsert_on_id(server_version=server_version))
+            s.rows = args.rows
+
+    if "fact_events" in to_run:
+        with open(FACT_EVENTS_SQL, "r") as f:
+            sql = f.read()
+        with stage("fact_events") as s:
+            pg_hook.execute(sql)
+            s.rows = args.rows
+
+    broker = InMemoryBroker(record_latencies=True)
+    if "watcher" in to_run:
+        with stage("watcher") as s:
+            publish_files(broker, events_paths, args)
+            s.rows = args.rows
+        # every consumer stage consumes the same messages
+        messages = list(broker.queue("events"))
+        broker.queue("events").clear()
+
+    for name, batch in (("consumer_single", False), ("consumer_batch", True)):
+        if name not in to_run:
+            continue
+        queue_table_md = TableMD(table_md_path=QUEUE_TABLE_METADATA_PATH)
+        pg_hook.execute(SQLGenerator(table_md=queue_table_md).drop_table())
+        with stage(name) as s:
+            consume(broker, messages, args, batch=batch)
+            s.rows = args.rows
+            s.latencies = broker.ack_latencies
+
+    return bench
+
+
+def main(argv: List[str]) -> int:
+    args = parse_args(argv)
+    # the per query debug logging of the loaders would be measured as well
+    logging.getLogger().setLevel(logging.WARNING)
+    with TemporaryDirectory(prefix="benchmark") as tmp_dir:
+        if args.work_dir is None:
+            args.work_dir = tmp_dir
+        bench = run(args)
+
+    output = args.output or join(RESULTS_DIR, f"{datetime.now():%Y%m%dT%H%M%S}.json")
+    bench.save(output)
+    print(f"results saved to {output}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, bench.results(), tolerance=args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+# python scripts/benchmarks/main.py --rows 100000 [--no-db] [--compare benchmarks/results/<previous run>.json]
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
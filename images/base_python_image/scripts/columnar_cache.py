@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+from contextlib import contextmanager
+from dataclasses import dataclass
+from glob import glob
+from json_stream import iter_json_records
+from manifest import file_sha256
+from os.path import dirname, getsize, join
+from pathlib import Path
+from sql_gen import TableMD
+from sys import argv
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional
+
+if TYPE_CHECKING:
+    # read returns the DataFrame built by pyarrow, pandas is not needed before
+    import pandas as pd
+
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+CACHE_SUFFIX = ".arrow"
+# size, mtime and hash of the source files seen by the cache, so that files are only hashed when they change
+HASHES_FILE = "hashes.json"
+# lock file serializing the updates of HASHES_FILE by concurrent loaders
+HASHES_LOCK_FILE = "hashes.lock"
+DEFAULT_MAX_BYTES = 1 << 30
+# amount of records converted to Arrow at once when filling the cache
+BATCH_SIZE = 10000
+
+
+def _import_pyarrow():
+    # pyarrow is an optional dependency, only needed when the cache is enabled
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError as e:
+        raise ImportError(
+            "the columnar cache requires pyarrow, install it with `pip install pyarrow`"
+        ) from e
+    return pyarrow
+
+
+@dataclass
+class ColumnarCache:
+    """
+    On-disk cache of parsed JSON input files, stored in the Arrow IPC format. An entry holds the columns of a
+    table metadata file for one source file and is keyed by the content hash of the source file and the column
+    set, so a changed file or a changed table definition never reads stale data. Entries are read memory-mapped,
+    the least recently used ones are evicted once the cache exceeds max_bytes (the entry being read is never
+    evicted, an entry larger than max_bytes only lives until the next one is written).
+    Values are cached as strings (None stays null), which is how they end up in the CSV/COPY input anyway.
+    :param cache_dir: Directory holding the cache entries
+    :type cache_dir: str
+    :param max_bytes: Size limit of the cache
+    :type max_bytes: int
+    """
+
+    cache_dir: str
+    max_bytes: int = DEFAULT_MAX_BYTES
+
+    def __post_init__(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __read_hashes(self) -> Dict[str, list]:
+        try:
+            with open(join(self.cache_dir, HASHES_FILE), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @contextmanager
+    def __hashes_lock(self) -> Iterator[None]:
+        with open(join(self.cache_dir, HASHES_LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def __source_hash(self, src_path: str) -> str:
+        st = os.stat(src_path)
+        entry = self.__read_hashes().get(src_path)
+        if entry is not None and entry[:2] == [st.st_size, st.st_mtime]:
+            return entry[2]
+        sha256 = file_sha256(src_path)
+        # read again under the lock, the other loaders may have added their files since
+        hashes_path = join(self.cache_dir, HASHES_FILE)
+        with self.__hashes_lock():
+            hashes = self.__read_hashes()
+            hashes[src_path] = [st.st_size, st.st_mtime, sha256]
+            tmp_path = f"{hashes_path}.{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(hashes, f)
+            os.replace(tmp_path, hashes_path)
+        return sha256
+
+    def entry_path(self, src_path: str, columns: List[str]) -> str:
+        columns_hash = hashlib.sha256(",".join(columns).encode("utf-8")).hexdigest()
+        return join(
+            self.cache_dir,
+            f"{self.__source_hash(src_path)[:32]}_{columns_hash[:16]}{CACHE_SUFFIX}",
+        )
+
+    def __write(self, src_path: str, columns: List[str], path: str) -> None:
+        pa = _import_pyarrow()
+        logger.debug(f"caching {src_path} -> {path}")
+        schema = pa.schema([(column, pa.string()) for column in columns])
+        tmp_path = f"{path}.{os.getpid()}"
+        with pa.ipc.new_file(tmp_path, schema) as writer:
+            batch = {column: [] for column in columns}
+            for i, record in enumerate(iter_json_records(src_path), 1):
+                for column in columns:
+                    value = record.get(column)
+                    batch[column].append(None if value is None else str(value))
+                if i % BATCH_SIZE == 0:
+                    writer.write_table(pa.Table.from_pydict(batch, schema=schema))
+                    batch = {column: [] for column in columns}
+            writer.write_table(pa.Table.from_pydict(batch, schema=schema))
+        os.replace(tmp_path, path)
+
+    def __entry(self, src_path: str, columns: List[str]) -> str:
+        """Path of the entry of the columns of a source file, written if it is not cached"""
+        path = self.entry_path(src_path, columns)
+        try:
+            # entries are evicted by modification time, reading one marks it as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            self.__write(src_path, columns, path)
+            self.evict(keep=path)
+        return path
+
+    def read(self, src_path: str, columns: List[str]) -> pd.DataFrame:
+        """
+        Columns of a source file, parsed and cached on first use. The columns are copied out of the memory-mapped
+        entry into the DataFrame, use read_batches to hold one batch of them at a time.
+        :param src_path: Path leading to input JSON file
+        :type src_path: str
+        :param columns: Columns to read (in this order)
+        :type columns: List[str]
+        :return: The columns, one string column (object dtype) each
+        :rtype: pd.DataFrame
+        """
+        pa = _import_pyarrow()
+        with pa.memory_map(self.__entry(src_path, columns), "r") as source:
+            table = pa.ipc.open_file(source).read_all().select(columns)
+            return table.to_pandas()
+
+    def read_batches(self, src_path: str, columns: List[str]) -> Iterator[pd.DataFrame]:
+        """
+        Columns of a source file like read, by batches of at most BATCH_SIZE rows: only the batch being read is
+        copied out of the memory-mapped entry
+        """
+        pa = _import_pyarrow()
+        with pa.memory_map(self.__entry(src_path, columns), "r") as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                if batch.num_rows:
+                    yield batch.select(columns).to_pandas()
+
+    def entries(self) -> List[str]:
+        return glob(join(self.cache_dir, "*" + CACHE_SUFFIX))
+
+    def size(self) -> int:
+        return sum(getsize(path) for path in self.entries())
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Removes the least recently used entries but keep until the cache fits in max_bytes"""
+        entries = sorted(self.entries(), key=os.path.getmtime)
+        size = sum(getsize(path) for path in entries)
+        for path in entries:
+            if size <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            logger.debug(f"evicting {path}")
+            size -= getsize(path)
+            os.remove(path)
+
+    def clear(self) -> None:
+        for path in self.entries() + glob(join(self.cache_dir, HASHES_FILE)):
+            os.remove(path)
+
+    def warm(self, tables_md_dir: str, raw_data_dir: str) -> None:
+        """Caches every input file of every table metadata file (see file_op.import_sources)"""
+        for table_md in os.listdir(tables_md_dir):
+            md = TableMD(table_md_path=join(tables_md_dir, table_md))
+            columns = [col.get("name") for col in md.columns]
+            for src_path in glob(join(raw_data_dir, md.load_prefix, "*.json")):
+                self.read(src_path, columns)
+
+
+# python columnar_cache.py warm|clear, the cache location and size come from the same settings as main.py
+if __name__ == "__main__":
+    root_dir = Path(__file__).parent.absolute()
+    raw_data_dir = join(dirname(root_dir), "raw_data")
+    cache = ColumnarCache(
+        cache_dir=os.environ.get("COLUMNAR_CACHE_DIR", join(raw_data_dir, ".cache")),
+        max_bytes=int(os.environ.get("COLUMNAR_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+    )
+    if argv[1] == "warm":
+        cache.warm(join(root_dir, "table_metadata"), raw_data_dir)
+        print(f"cache holds {len(cache.entries())} entries, {cache.size()} bytes")
+    elif argv[1] == "clear":
+        cache.clear()
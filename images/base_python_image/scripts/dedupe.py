@@ -0,0 +1,374 @@
+import json
+import logging
+import math
+import metrics
+import os
+from datetime import datetime
+from hashlib import blake2b
+from psql_client import PgHook
+from time import monotonic
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Union
+
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+DEDUPE_DUPLICATES = metrics.counter("dedupe_duplicates_total", "Events dropped as already loaded")
+DEDUPE_CHECKS = metrics.counter(
+    "dedupe_checks_total", "Keys looked up in the database after a positive of the filter"
+)
+DEDUPE_FALSE_POSITIVES = metrics.counter(
+    "dedupe_false_positives_total", "Keys reported by the filter that were not loaded"
+)
+
+SNAPSHOT_MAGIC = "bloom-1"
+JOURNAL_SUFFIX = ".journal"
+# keys fetched at once when seeding the filter from the table
+SEED_BATCH_SIZE = 10000
+# rows of a stream deduplicated at once, i.e. looked up in a single query
+ROWS_BATCH_SIZE = 10000
+# columns identifying an event: the id is the id of the user, shared by all the events of a user
+DEFAULT_KEY = ("id", "event_type", "received_at")
+
+
+def key_text(value) -> str:
+    """Text of a key value, timestamps being written the way PostgreSQL casts them to text"""
+    if isinstance(value, datetime):
+        text = value.isoformat(sep=" ")
+        return text.rstrip("0").rstrip(".") if "." in text else text
+    return str(value)
+
+
+def dedupe_key(values: tuple) -> Optional[str]:
+    """
+    Key of the values of the key columns of a row as the filter and the database see it (the text of the value for
+    single column keys), None if a value is missing (never deduplicated)
+    """
+    if any(value is None or value != value for value in values):  # NaN/NaT of the pandas columns
+        return None
+    if len(values) == 1:
+        return key_text(values[0])
+    return json.dumps([key_text(value) for value in values])
+
+
+class BloomFilter:
+    """
+    Bloom filter of string keys: membership tests never miss a key that was added, and report keys that were not
+    added with a probability of error_rate as long as at most capacity keys were added. Its size is fixed by the
+    capacity and the error rate (about 1.8MB for a million keys at 0.1%), adding more keys than the capacity only
+    makes false positives more likely.
+    :param capacity: Number of keys the error rate holds for
+    :type capacity: int
+    :param error_rate: Probability of a false positive at capacity
+    :type error_rate: float
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        if capacity <= 0 or not 0 < error_rate < 1:
+            raise ValueError("a bloom filter needs a positive capacity and an error rate between 0 and 1")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.n_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.count = 0
+
+    def __positions(self, key: str) -> Iterable[int]:
+        # double hashing: the k positions are derived from the two halves of a single digest
+        digest = blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.n_bits for i in range(self.n_hashes))
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.__positions(key))
+
+    def add(self, key: str) -> None:
+        for pos in self.__positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def save(self, path: str) -> None:
+        """Writes the filter to path, atomically"""
+        header = {
+            "magic": SNAPSHOT_MAGIC,
+            "capacity": self.capacity,
+            "error_rate": self.error_rate,
+            "count": self.count,
+        }
+        tmp_path = f"{path}.{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            f.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BloomFilter":
+        """Reads a filter written by save, raises ValueError if the file does not hold one"""
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            if header.get("magic") != SNAPSHOT_MAGIC:
+                raise ValueError(f"{path} is not a bloom filter snapshot")
+            bloom = cls(capacity=header["capacity"], error_rate=header["error_rate"])
+            bits = f.read()
+        if len(bits) != len(bloom.bits):
+            raise ValueError(f"{path} is truncated")
+        bloom.bits = bytearray(bits)
+        bloom.count = header["count"]
+        return bloom
+
+
+class Deduper:
+    """
+    Drops the events whose key (DEFAULT_KEY by default) was already loaded into a table, keeping memory bounded:
+    the loaded keys are tracked by a Bloom filter and only the keys it reports are looked up in the table, which
+    tells the duplicates from the false positives. Keys repeated before their load is committed (within a batch or
+    a file) are dropped from memory, the keys of the files of a delta that is not upserted yet are looked up in
+    staging_table.
+    The filter is seeded from the table on first use, unless a snapshot was saved to snapshot_path: the snapshot
+    is saved every snapshot_interval seconds and on close, and the keys kept since the last one are appended to a
+    journal next to it before being loaded, so a restart after a crash still knows them. A snapshot only knows the
+    keys loaded through its deduper, the table must not be loaded by other writers in between.
+    Usage: mask the rows with keep, load the kept rows and call commit once the load is committed (or stage once
+    it is committed to staging_table).
+    :param schema: Schema of the table
+    :type schema: str
+    :param table_name: Table the events are loaded into (the master table for delta loads)
+    :type table_name: str
+    :param staging_table: Table the events are loaded into before table_name, i.e. the delta table, looked up as well
+    once a load was staged (see stage)
+    :type staging_table: Optional[str]
+    :param key: Column or columns identifying the events, their values must be unique per event: rows sharing a key
+    are dropped as duplicates
+    :type key: Union[str, Sequence[str]]
+    :param capacity: Number of keys the filter is sized for
+    :type capacity: int
+    :param error_rate: False positive rate of the filter at capacity, i.e. the rate of database lookups
+    :type error_rate: float
+    :param snapshot_path: File the filter is saved to, the filter is seeded from the table on every start when not
+    given
+    :type snapshot_path: Optional[str]
+    :param snapshot_interval: Seconds between snapshots
+    :type snapshot_interval: float
+    :param pg_hook: Hook used for looking keys up and seeding the filter
+    :type pg_hook: PgHook
+    """
+
+    def __init__(
+        self,
+        schema: str,
+        table_name: str,
+        key: Union[str, Sequence[str]] = DEFAULT_KEY,
+        staging_table: Optional[str] = None,
+        capacity: int = 1000000,
+        error_rate: float = 0.001,
+        snapshot_path: Optional[str] = None,
+        snapshot_interval: float = 60.0,
+        pg_hook: Optional[PgHook] = None,
+    ):
+        self.schema = schema
+        self.table_name = table_name
+        self.staging_table = staging_table
+        self.columns = [key] if isinstance(key, str) else list(key)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.pg_hook = pg_hook or PgHook()
+        self.bloom: Optional[BloomFilter] = None
+        # kept keys whose load is not committed yet
+        self.pending: Set[str] = set()
+        # whether loads were committed to staging_table since the last commit
+        self._staged = False
+        self._journal = None
+        self._next_snapshot = 0.0
+        self._warned_full = False
+
+    @property
+    def journal_path(self) -> str:
+        return self.snapshot_path + JOURNAL_SUFFIX
+
+    def __load_snapshot(self) -> Optional[BloomFilter]:
+        try:
+            bloom = BloomFilter.load(self.snapshot_path)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.warning(f"ignoring the dedupe snapshot: {e}")
+            return None
+        if (bloom.capacity, bloom.error_rate) != (self.capacity, self.error_rate):
+            logger.warning(f"the dedupe snapshot {self.snapshot_path} was sized differently, ignoring it")
+            return None
+        try:
+            with open(self.journal_path, "r") as f:
+                for line in f:
+                    if line.endswith("\n"):  # a line cut by a crash was never loaded
+                        bloom.add(json.loads(line))
+        except FileNotFoundError:
+            pass
+        logger.info(f"loaded {bloom.count} keys of {self.schema}.{self.table_name} from {self.snapshot_path}")
+        return bloom
+
+    def __seed(self) -> BloomFilter:
+        """New filter holding every key of the table, streamed through a server side cursor"""
+        bloom = BloomFilter(capacity=self.capacity, error_rate=self.error_rate)
+        with self.pg_hook.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT to_regclass(%s)", (f"{self.schema}.{self.table_name}",))
+                exists = cur.fetchone()[0] is not None
+            if exists:
+                with conn.cursor(name=f"dedupe_seed_{self.table_name}") as cur:
+                    cur.itersize = SEED_BATCH_SIZE
+                    cur.execute(
+                        f"SELECT {self.__key_columns()} FROM {self.schema}.{self.table_name} "
+                        f"WHERE {' AND '.join(f'{column} IS NOT NULL' for column in self.columns)}"
+                    )
+                    for values in cur:
+                        bloom.add(dedupe_key(values))
+        logger.info(f"seeded the dedupe filter with {bloom.count} keys of {self.schema}.{self.table_name}")
+        return bloom
+
+    def __open(self) -> None:
+        if self.snapshot_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.snapshot_path)), exist_ok=True)
+            self.bloom = self.__load_snapshot()
+        if self.bloom is None:
+            self.bloom = self.__seed()
+            if self.snapshot_path is not None:
+                # the seeded keys are not journaled
+                self.snapshot()
+        self._next_snapshot = monotonic() + self.snapshot_interval
+
+    def __key_columns(self) -> str:
+        # compared as text, as dedupe_key writes them
+        return ", ".join(f"{column}::text" for column in self.columns)
+
+    def __loaded(self, first_values: List[str]) -> Set[str]:
+        """The keys in the table (and the staged ones) whose first column holds one of first_values"""
+        tables = [self.table_name] + ([self.staging_table] if self._staged else [])
+        loaded = set()
+        with self.pg_hook.session() as cur:
+            for table_name in tables:
+                cur.execute("SELECT to_regclass(%s)", (f"{self.schema}.{table_name}",))
+                if cur.fetchone()[0] is None:
+                    continue
+                cur.execute(
+                    f"SELECT {self.__key_columns()} FROM {self.schema}.{table_name} "
+                    f"WHERE {self.columns[0]}::text = ANY(%s)",
+                    (first_values,),
+                )
+                loaded.update(dedupe_key(values) for values in cur.fetchall())
+        return loaded
+
+    def indexes(self, fields: List[str]) -> List[int]:
+        """Indexes of the key columns in rows of the given fields"""
+        return [fields.index(column) for column in self.columns]
+
+    def keep(self, values: Sequence) -> List[bool]:
+        """
+        Masks the rows of the given keys, True for the rows to load: new keys, the first occurrence of a key
+        repeated within values and rows without a key. The kept keys are remembered (and journaled) right away.
+        :param values: Values of the key columns of every row, a tuple per row (or the value itself for single
+        column keys)
+        :type values: Sequence
+        :return: Whether to load every row
+        :rtype: List[bool]
+        """
+        if self.bloom is None:
+            self.__open()
+        mask = [True] * len(values)
+        new_keys = []
+        candidates: Dict[str, int] = {}
+        first_values = set()
+        for i, value in enumerate(values):
+            value = value if isinstance(value, tuple) else (value,)
+            key = dedupe_key(value)
+            if key is None:
+                continue
+            if key in self.pending or key in candidates:
+                mask[i] = False
+            elif key in self.bloom:
+                candidates[key] = i
+                first_values.add(key_text(value[0]))
+            else:
+                self.pending.add(key)
+                new_keys.append(key)
+        if candidates:
+            DEDUPE_CHECKS.inc(len(candidates))
+            loaded = self.__loaded(sorted(first_values))
+            for key, i in candidates.items():
+                if key in loaded:
+                    mask[i] = False
+                else:
+                    # already in the filter, nothing to remember
+                    DEDUPE_FALSE_POSITIVES.inc()
+                    self.pending.add(key)
+        self.__remember(new_keys)
+        DEDUPE_DUPLICATES.inc(mask.count(False))
+        return mask
+
+    def filter_rows(self, rows: List[tuple], key_indexes: List[int]) -> List[tuple]:
+        """The rows to load (see keep), the key being the columns at key_indexes (see indexes)"""
+        mask = self.keep([tuple(row[i] for i in key_indexes) for row in rows])
+        return [row for row, keep in zip(rows, mask) if keep]
+
+    def iter_rows(
+        self, rows: Iterable[tuple], key_indexes: List[int], batch_size: int = ROWS_BATCH_SIZE
+    ) -> Iterator[tuple]:
+        """Lazy filter_rows, deduplicating batch_size rows at a time"""
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return
+            yield from self.filter_rows(batch, key_indexes)
+
+    def __remember(self, keys: List[str]) -> None:
+        if not keys:
+            return
+        if self.snapshot_path is not None:
+            # journaled before being loaded: a key may be in the filter without having been loaded, never the reverse
+            if self._journal is None:
+                self._journal = open(self.journal_path, "a")
+            self._journal.write("".join(json.dumps(key) + "\n" for key in keys))
+            self._journal.flush()
+        for key in keys:
+            self.bloom.add(key)
+        if self.bloom.count > self.capacity and not self._warned_full:
+            logger.warning(
+                f"the dedupe filter of {self.table_name} holds more than {self.capacity} keys, raise its capacity"
+            )
+            self._warned_full = True
+
+    def stage(self) -> None:
+        """
+        To be called once the kept rows are committed to staging_table: they are looked up there from then on, instead
+        of being held in memory until the whole delta is upserted
+        """
+        if self.staging_table is None:
+            raise ValueError("only dedupers of a staging_table stage their loads")
+        self.pending.clear()
+        self._staged = True
+
+    def commit(self) -> None:
+        """To be called once the kept rows are committed to the table, snapshots the filter when due"""
+        self.pending.clear()
+        self._staged = False
+        if self.snapshot_path is not None and self.bloom is not None and monotonic() >= self._next_snapshot:
+            self.snapshot()
+
+    def snapshot(self) -> None:
+        """Saves the filter to snapshot_path and starts a new journal"""
+        self.bloom.save(self.snapshot_path)
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self.journal_path, "w")
+        self._next_snapshot = monotonic() + self.snapshot_interval
+
+    def close(self) -> None:
+        if self.snapshot_path is not None and self.bloom is not None:
+            self.snapshot()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -0,0 +1,259 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from itertools import chain
+from json_stream import iter_json_records
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple, Union
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+# above this many regions (records of a day scattered all over the file) only the days of the file are indexed
+MAX_REGIONS = 4096
+
+
+def parse_timestamp(value) -> datetime:
+    """Parse a timestamp value, using the fast ISO 8601 parser first and pandas for anything more exotic"""
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        # pandas takes a while to import, the consumers only need it for such values
+        import pandas as pd
+
+        return pd.to_datetime(value).to_pydatetime()
+
+
+def record_days(value) -> List[str]:
+    """
+    Dates (YYYY-MM-DD) whose date filter matches a filter key value. The filter includes both bounds (see
+    file_op.filter_by_date), so a value at midnight also belongs to the day before.
+    """
+    ts = parse_timestamp(value)
+    days = [ts.date().isoformat()]
+    if ts.time() == datetime.min.time():
+        days.append((ts - timedelta(days=1)).date().isoformat())
+    return days
+
+
+@dataclass(frozen=True)
+class LoadWindow:
+    """
+    Range of filter key values to load, both bounds included. An open bound does not limit the range, records
+    without a filter key value are never part of a window.
+    :param start: Smallest value loaded
+    :type start: Optional[datetime]
+    :param end: Largest value loaded
+    :type end: Optional[datetime]
+    """
+
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+
+    @classmethod
+    def for_date(cls, date_filter_val: str) -> "LoadWindow":
+        """Window of a date (YYYY-MM-DD), the midnight of the next day included as the date filter always did"""
+        # this will raise a significant ValueError if format does not correlate
+        start = datetime.strptime(date_filter_val, "%Y-%m-%d")
+        return cls(start=start, end=start + timedelta(days=1))
+
+    @classmethod
+    def for_dates(cls, first_date: str, last_date: str) -> "LoadWindow":
+        """Window of a range of dates (YYYY-MM-DD), both included, for backfills"""
+        window = cls(start=cls.for_date(first_date).start, end=cls.for_date(last_date).end)
+        if window.start > window.end:
+            raise ValueError(f"{first_date} is after {last_date}")
+        return window
+
+    @classmethod
+    def of(cls, date_filter_val: Union[str, "LoadWindow"]) -> "LoadWindow":
+        """Window of a date filter value, either a date (YYYY-MM-DD) or a window"""
+        if isinstance(date_filter_val, LoadWindow):
+            return date_filter_val
+        return cls.for_date(date_filter_val)
+
+    def contains(self, ts: datetime) -> bool:
+        return (self.start is None or self.start <= ts) and (self.end is None or ts <= self.end)
+
+    def overlaps(self, low: datetime, high: datetime) -> bool:
+        """Whether the window holds values of the [low, high] range"""
+        return (self.start is None or self.start <= high) and (self.end is None or low <= self.end)
+
+    def mask(self, values: pd.Series) -> pd.Series:
+        """Rows of a column of timestamps falling in the window, values are left as is"""
+        import pandas as pd
+
+        values = pd.to_datetime(values)
+        mask = values.notna()
+        if self.start is not None:
+            mask &= values >= self.start
+        if self.end is not None:
+            mask &= values <= self.end
+        return mask
+
+    def __str__(self) -> str:
+        return f"[{self.start or '-inf'}, {self.end or '+inf'}]"
+
+
+@dataclass
+class FileIndex:
+    """
+    Sidecar index of a JSON input file ({file}.idx), recording the range of its filter key and the regions (byte
+    offsets of consecutive records) holding each day. Date filtered loads use it to skip the files that can not
+    contain the date and to only parse the relevant regions of the others. The index is rebuilt whenever the size
+    or mtime of the file changed.
+    :param src_path: Path leading to the indexed JSON file
+    :type src_path: str
+    :param key: Filter key (column) the index is built on
+    :type key: str
+    :param size: Size of the file when indexed
+    :type size: int
+    :param mtime: Modification time of the file when indexed
+    :type mtime: float
+    :param min: Smallest filter key value of the file
+    :type min: Optional[str]
+    :param max: Largest filter key value of the file
+    :type max: Optional[str]
+    :param days: Regions ([start, end] byte offsets) of every day, None when the day regions were too scattered
+    to be worth recording
+    :type days: Dict[str, Optional[List[List[int]]]]
+    """
+
+    src_path: str
+    key: str
+    size: int
+    mtime: float
+    min: Optional[str] = None
+    max: Optional[str] = None
+    days: Dict[str, Optional[List[List[int]]]] = field(default_factory=dict)
+
+    @property
+    def index_path(self) -> str:
+        return self.src_path + INDEX_SUFFIX
+
+    @classmethod
+    def build(cls, src_path: str, key: str) -> "FileIndex":
+        """Indexes a file by parsing it once"""
+        logger.debug(f"indexing {src_path} on {key}")
+        st = os.stat(src_path)
+        index = cls(src_path=src_path, key=key, size=st.st_size, mtime=st.st_mtime)
+        low, high = None, None
+        # index of the last record added to the latest region of every day, to extend consecutive runs
+        last_record: Dict[str, int] = {}
+        n_regions = 0
+        for i, (record, start, end) in enumerate(
+            iter_json_records(src_path, with_offsets=True)
+        ):
+            value = record.get(key)
+            if value is None:
+                continue
+            ts = parse_timestamp(value)
+            if low is None or ts < low[0]:
+                low = (ts, value)
+            if high is None or ts > high[0]:
+                high = (ts, value)
+            for day in record_days(value):
+                regions = index.days.setdefault(day, [])
+                if last_record.get(day) == i - 1:
+                    regions[-1][1] = end
+                else:
+                    regions.append([start, end])
+                    n_regions += 1
+                last_record[day] = i
+        if n_regions > MAX_REGIONS:
+            index.days = {day: None for day in index.days}
+        index.min = str(low[1]) if low else None
+        index.max = str(high[1]) if high else None
+        return index
+
+    @classmethod
+    def load(cls, src_path: str, key: str) -> Optional["FileIndex"]:
+        """Reads the index of a file, None when there is none or it is out of date"""
+        try:
+            with open(src_path + INDEX_SUFFIX, "r") as f:
+                content = json.load(f)
+            st = os.stat(src_path)
+        except (OSError, ValueError):
+            return None
+        if (
+            content.pop("version", None) != INDEX_VERSION
+            or content.get("key") != key
+            or (content.get("size"), content.get("mtime")) != (st.st_size, st.st_mtime)
+        ):
+            return None
+        return cls(src_path=src_path, **content)
+
+    def save(self) -> None:
+        """Writes the index next to the file, the file directory being read-only is not an error"""
+        content = {"version": INDEX_VERSION, **asdict(self)}
+        del content["src_path"]
+        tmp_path = f"{self.index_path}.{os.getpid()}"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(content, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            logger.warning(f"could not write the index of {self.src_path}")
+
+    def may_contain(self, date_filter_val: Union[str, LoadWindow]) -> bool:
+        """Whether records of the file may match a date filter value (YYYY-MM-DD) or window"""
+        if not isinstance(date_filter_val, LoadWindow):
+            return date_filter_val in self.days
+        if self.min is None:
+            return False
+        return date_filter_val.overlaps(parse_timestamp(self.min), parse_timestamp(self.max))
+
+    def __window_regions(self, window: LoadWindow) -> Optional[List[Tuple[int, int]]]:
+        """Regions of the days overlapping a window in file order, merged where they overlap, None for the whole file"""
+        regions = []
+        for day, day_regions in self.days.items():
+            day_start = datetime.strptime(day, "%Y-%m-%d")
+            if not window.overlaps(day_start, day_start + timedelta(days=1)):
+                continue
+            if day_regions is None:
+                return None
+            regions += [tuple(region) for region in day_regions]
+        merged = []
+        # a record at midnight belongs to the regions of two days, it must only be parsed once
+        for start, end in sorted(regions):
+            if merged and start < merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def iter_records(self, date_filter_val: Union[str, LoadWindow]) -> Iterator[dict]:
+        """
+        Records of the file that may match a date filter value (YYYY-MM-DD) or window, only the regions of the days
+        concerned are parsed when they are known. The date filter still has to be applied to them.
+        """
+        if not self.may_contain(date_filter_val):
+            return iter(())
+        if isinstance(date_filter_val, LoadWindow):
+            regions = self.__window_regions(date_filter_val)
+        else:
+            regions = self.days[date_filter_val]
+        if regions is None:
+            return iter_json_records(self.src_path)
+        return chain.from_iterable(
+            iter_json_records(self.src_path, start=start, end=end)
+            for start, end in regions
+        )
+
+
+def get_index(src_path: str, key: str) -> FileIndex:
+    """Returns the up to date index of a file, building (and saving) it on first use"""
+    index = FileIndex.load(src_path, key)
+    if index is None:
+        index = FileIndex.build(src_path, key)
+        index.save()
+    return index
@@ -1,86 +1,821 @@
-import pandas as pd
+from __future__ import annotations
+
+import metrics
+import sys
 from os import listdir
-from os.path import join
-from sql_gen import TableMD
-from psql_client import PgHook
+from os.path import getsize, join
+from sql_gen import SQLGenerator, TableMD
+from psql_client import PgHook, CopyStream
+from pgcopy import BinaryCopyStream
+from json_stream import iter_json_records
+from file_index import LoadWindow, get_index, parse_timestamp
+from columnar_cache import ColumnarCache
+from dedupe import Deduper
+from rollup import Rollup
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import replace
+from functools import partial
+from itertools import islice
+from manifest import LoadManifest
+from watermark import Watermarks
 from glob import glob
 from tempfile import TemporaryDirectory
 import logging
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Sequence, Union
+
+if TYPE_CHECKING:
+    # imported by the functions parsing files with pandas, streaming loads do without it
+    import pandas as pd
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+EXTRACT_SECONDS = metrics.histogram("extract_seconds", "Time spent extracting a file into CSV")
+EXTRACT_PARSE_SECONDS = metrics.histogram(
+    "extract_parse_seconds", "Time spent parsing input files in extract_data"
+)
+EXTRACT_ROWS = metrics.counter("extract_rows_total", "Rows written by extract_data")
+EXTRACT_BYTES = metrics.counter("extract_bytes_total", "Bytes of input files read by extract_data")
+IMPORT_SECONDS = metrics.histogram(
+    "import_seconds", "Time spent importing the files of a table metadata file"
+)
+IMPORT_FILES = metrics.counter("import_files_total", "Input files imported by import_sources")
+EXTRACT_CHUNKS = metrics.counter("extract_chunks_total", "Chunks processed by extract_data in chunked mode")
+
+# records sampled from an input file to estimate the memory taken by a record when sizing chunks by memory budget
+CHUNK_SAMPLE_ROWS = 1000
+
+
+def filter_by_date(
+    records: Iterator[dict],
+    date_filter_key: str,
+    date_filter_val: Union[str, LoadWindow],
+) -> Iterator[dict]:
+    """
+    Keep only the records whose date_filter_key falls on date_filter_val, the same way extract_data filters
+    with pandas (both bounds included).
+    :param records: Parsed JSON records
+    :type records: Iterator[dict]
+    :param date_filter_key: Dimension (column) according to which the data should be filtered
+    :type date_filter_key: str
+    :param date_filter_val: The specific date value (YYYY-MM-DD) or window to filter against
+    :type date_filter_val: Union[str, LoadWindow]
+    """
+    window = LoadWindow.of(date_filter_val)
+    for record in records:
+        value = record.get(date_filter_key)
+        if value is None:
+            continue
+        if window.contains(parse_timestamp(value)):
+            yield record
+
+
+def stream_data(
+    src_path: str,
+    table_md: TableMD,
+    date_filter_val: Optional[Union[str, LoadWindow]] = None,
+    cache: Optional[ColumnarCache] = None,
+    copy_format: str = "csv",
+    deduper: Optional[Deduper] = None,
+    rollup: Optional[Rollup] = None,
+) -> Union[CopyStream, BinaryCopyStream]:
+    """
+    Streaming alternative to extract_data. The JSON input file is parsed one object at a time, only the columns
+    listed in the table metadata are kept and rows are encoded into CSV chunks as the COPY command consumes them.
+    Nothing is written to disk and memory stays flat regardless of the size of the input file.
+    :param src_path: Path leading to input JSON file
+    :type src_path: str
+    :param table_md: Parsed YAML file containing table metadata
+    :type table_md: TableMD
+    :param date_filter_val: The specific date value (YYYY-MM-DD) or window to filter against (using the table
+    metadata filter key)
+    :type date_filter_val: Optional[Union[str, LoadWindow]]
+    :param cache: Read the columns from this cache instead of parsing the file
+    :type cache: Optional[ColumnarCache]
+    :param copy_format: "csv" or "binary", binary rows are encoded according to the column types of the table
+    metadata and must be loaded with the matching COPY query (SQLGenerator.copy_query)
+    :type copy_format: str
+    :param deduper: Drops the rows already loaded (see dedupe.Deduper)
+    :type deduper: Optional[Deduper]
+    :param rollup: Aggregates the rows as they are streamed (see rollup.Rollup)
+    :type rollup: Optional[Rollup]
+    :return: File-like object to hand over to PgHook.copy_stream/load_to_table
+    :rtype: Union[CopyStream, BinaryCopyStream]
+    """
+    fields: List[str] = [col.get("name") for col in table_md.columns]
+    if cache is not None:
+        rows = cached_rows(cache, src_path, fields, table_md.filter_key, date_filter_val)
+    else:
+        if table_md.filter_key and date_filter_val:
+            # only the regions of the file holding the date are parsed
+            records = get_index(src_path, table_md.filter_key).iter_records(
+                date_filter_val
+            )
+            records = filter_by_date(records, table_md.filter_key, date_filter_val)
+        else:
+            records = iter_json_records(src_path)
+        extract = table_md.row_codec.extract
+        rows = (extract(record) for record in records)
+    if deduper is not None:
+        rows = deduper.iter_rows(rows, deduper.indexes(fields))
+    if rollup is not None:
+        rows = rollup.observe(rows, fields)
+    if copy_format == "binary":
+        return BinaryCopyStream(
+            rows=rows, column_types=[col.get("type") for col in table_md.columns]
+        )
+    return CopyStream(rows=rows, header=fields, delimiter=table_md.delimiter)
+
+
+def cached_rows(
+    cache: ColumnarCache,
+    src_path: str,
+    fields: List[str],
+    date_filter_key: Optional[str] = None,
+    date_filter_val: Optional[Union[str, LoadWindow]] = None,
+) -> Iterator[tuple]:
+    """Rows of a source file read from the cache a batch at a time, filtered on the date if given"""
+    for df in cache.read_batches(src_path, fields):
+        if date_filter_key and date_filter_val:
+            df = df.loc[date_mask(df[date_filter_key], date_filter_val)]
+        # missing values are written as empty fields
+        df = df.astype(object).where(df.notna(), None)
+        yield from df.itertuples(index=False, name=None)
+
+
+def date_mask(values: pd.Series, date_filter_val: Union[str, LoadWindow]) -> pd.Series:
+    """Rows of a column of timestamps falling on date_filter_val (both bounds included), values are left as is"""
+    return LoadWindow.of(date_filter_val).mask(values)
+
+
+def dedupe_frame(df: pd.DataFrame, deduper: Optional[Deduper]) -> pd.DataFrame:
+    """Rows of a DataFrame that were not loaded yet according to deduper, every row without a deduper"""
+    if deduper is None:
+        return df
+    return df.loc[deduper.keep(list(df[deduper.columns].itertuples(index=False, name=None)))]
+
+
+def rollup_frame(df: pd.DataFrame, rollup: Optional[Rollup]) -> None:
+    """Aggregates the rows of a DataFrame into rollup, if given"""
+    if rollup is not None:
+        rollup.add_rows(df[rollup.columns].itertuples(index=False, name=None), rollup.columns)
+
+
+def record_size(record: dict) -> int:
+    """Approximate number of bytes a parsed JSON record takes in memory (shallow size of the dict and its items)"""
+    return sys.getsizeof(record) + sum(
+        sys.getsizeof(key) + sys.getsizeof(value) for key, value in record.items()
+    )
+
+
+def chunk_rows_for_budget(
+    src_path: str, memory_budget: int, sample_rows: int = CHUNK_SAMPLE_ROWS
+) -> int:
+    """
+    Number of records per chunk keeping a chunk within a memory budget. The size of a record is estimated from the
+    first records of the file, counting both the parsed records and the DataFrame built from them since they are
+    alive at the same time.
+    :param src_path: Path leading to input JSON file
+    :type src_path: str
+    :param memory_budget: Bytes a chunk may take in memory
+    :type memory_budget: int
+    :param sample_rows: Number of records the size of a record is estimated from
+    :type sample_rows: int
+    :return: Records per chunk, at least 1
+    :rtype: int
+    """
+    import pandas as pd
+
+    sample = list(islice(iter_json_records(src_path), sample_rows))
+    if not sample:
+        return 1
+    df = pd.DataFrame.from_records(sample)
+    row_bytes = (
+        sum(record_size(record) for record in sample)
+        + df.memory_usage(index=False, deep=True).sum()
+    ) / len(sample)
+    return max(1, int(memory_budget // row_bytes))
+
+
+def iter_chunks(
+    src_path: str, chunk_rows: int, columns: Optional[List[str]] = None
+) -> Iterator[pd.DataFrame]:
+    """
+    Parses a JSON input file into DataFrames of up to chunk_rows records, only one chunk being in memory at a time.
+    Every chunk has the same columns: the given ones, the columns of the first chunk otherwise (keys only showing up
+    in later records are dropped, missing ones are empty).
+    :param src_path: Path leading to input JSON file
+    :type src_path: str
+    :param chunk_rows: Maximum number of records of a chunk
+    :type chunk_rows: int
+    :param columns: Columns of the chunks
+    :type columns: Optional[List[str]]
+    """
+    import pandas as pd
+
+    records = iter_json_records(src_path)
+    while True:
+        chunk = list(islice(records, chunk_rows))
+        if not chunk:
+            return
+        df = pd.DataFrame.from_records(chunk, columns=columns)
+        if columns is None:
+            columns = list(df.columns)
+        yield df
+
+
+def extract_chunks(
+    src_path: str,
+    dst_path: str,
+    date_filter_key: Optional[str] = None,
+    date_filter_val: Optional[Union[str, LoadWindow]] = None,
+    columns: Optional[List[str]] = None,
+    chunk_rows: Optional[int] = None,
+    chunk_memory: Optional[int] = None,
+    deduper: Optional[Deduper] = None,
+    rollup: Optional[Rollup] = None,
+) -> int:
+    """
+    Chunked mode of extract_data, bounding memory on files too large to be parsed at once. The file is processed
+    chunk_rows records at a time (or as many as fit in chunk_memory bytes), every chunk being filtered on the date
+    with vectorized operations and appended to the CSV output. Values are written as they appear in the input file,
+    the date filter key included, PostgreSQL parses them when copying.
+    :param src_path: Path leading to input JSON file
+    :type src_path: str
+    :param dst_path: Path for output file
+    :type dst_path: str
+    :param date_filter_key: Dimension (column) according to which the data should be filtered
+    :type date_filter_key: Optional[str]
+    :param date_filter_val: The specific date value (YYYY-MM-DD) or window to filter against
+    :type date_filter_val: Optional[Union[str, LoadWindow]]
+    :param columns: Columns to extract, every column of the first chunk when not given
+    :type columns: Optional[List[str]]
+    :param chunk_rows: Maximum number of records of a chunk
+    :type chunk_rows: Optional[int]
+    :param chunk_memory: Bytes a chunk may take in memory, used when chunk_rows is not set
+    :type chunk_memory: Optional[int]
+    :param deduper: Drops the rows already loaded (see dedupe.Deduper)
+    :type deduper: Optional[Deduper]
+    :param rollup: Aggregates the rows written (see rollup.Rollup)
+    :type rollup: Optional[Rollup]
+    :return: Number of rows written
+    :rtype: int
+    """
+    if chunk_rows is None:
+        chunk_rows = chunk_rows_for_budget(src_path, chunk_memory)
+    logger.debug(f"extracting {src_path} by chunks of {chunk_rows} records")
+    rows = 0
+    header = True
+    with open(dst_path, "w") as f:
+        for df in iter_chunks(src_path, chunk_rows, columns):
+            if date_filter_key and date_filter_val:
+                df = df.loc[date_mask(df[date_filter_key], date_filter_val)]
+            df = dedupe_frame(df, deduper)
+            rollup_frame(df, rollup)
+            df.to_csv(f, index=False, header=header)
+            header = False
+            rows += len(df)
+            EXTRACT_CHUNKS.inc()
+    return rows
+
 
 def extract_data(
     src_path: str,
     dst_path: str,
     date_filter_key: Optional[str] = None,
-    date_filter_val: Optional[str] = None,
+    date_filter_val: Optional[Union[str, LoadWindow]] = None,
+    columns: Optional[List[str]] = None,
+    cache: Optional[ColumnarCache] = None,
+    chunk_rows: Optional[int] = None,
+    chunk_memory: Optional[int] = None,
+    deduper: Optional[Deduper] = None,
+    rollup: Optional[Rollup] = None,
 ) -> None:
     """
     Extract data from JSON input file. This function uses the table metadata to decide
     if to filter extracted data according to specific date key.
+    With chunk_rows or chunk_memory set, the file is processed by chunks instead of being parsed at once (see
+    extract_chunks), only the given columns being kept.
     :param src_path: Path leading to input JSON file
     :type src_path: str
     :param dst_path: Path for output file
     :type dst_path: str
     :param date_filter_key: Dimension (column) according to which the data should be filtered
     :type date_filter_key: Optional[str]
-    :param date_filter_val: The specific date value to filter against
-    :type date_filter_val: Optional[str]
+    :param date_filter_val: The specific date value (YYYY-MM-DD) or window to filter against
+    :type date_filter_val: Optional[Union[str, LoadWindow]]
+    :param columns: Columns to extract, required when reading from the cache
+    :type columns: Optional[List[str]]
+    :param cache: Read the columns from this cache instead of parsing the file with pandas
+    :type cache: Optional[ColumnarCache]
+    :param chunk_rows: Maximum number of records processed at once
+    :type chunk_rows: Optional[int]
+    :param chunk_memory: Bytes the records processed at once may take in memory, used when chunk_rows is not set
+    :type chunk_memory: Optional[int]
+    :param deduper: Drops the rows already loaded, after filtering on the date (see dedupe.Deduper)
+    :type deduper: Optional[Deduper]
+    :param rollup: Aggregates the rows written, to be merged once they are loaded (see rollup.Rollup)
+    :type rollup: Optional[Rollup]
+    """
+    if cache is None and (chunk_rows or chunk_memory):
+        with EXTRACT_SECONDS.time():
+            rows = extract_chunks(
+                src_path=src_path,
+                dst_path=dst_path,
+                date_filter_key=date_filter_key,
+                date_filter_val=date_filter_val,
+                columns=columns,
+                chunk_rows=chunk_rows,
+                chunk_memory=chunk_memory,
+                deduper=deduper,
+                rollup=rollup,
+            )
+        EXTRACT_ROWS.inc(rows)
+        if metrics.enabled():
+            EXTRACT_BYTES.inc(getsize(src_path))
+        return
+
+    with EXTRACT_SECONDS.time():
+        if cache is not None:
+            with EXTRACT_PARSE_SECONDS.time():
+                df = cache.read(src_path, columns)
+            if date_filter_key and date_filter_val:
+                df = df.loc[date_mask(df[date_filter_key], date_filter_val)]
+        else:
+            import pandas as pd
+
+            with EXTRACT_PARSE_SECONDS.time():
+                df = pd.read_json(path_or_buf=src_path)
+            if date_filter_key and date_filter_val:
+                # ensure that pandas column is in correct datetime format for filtering
+                df[date_filter_key] = pd.to_datetime(df[date_filter_key])
+                df = df.loc[date_mask(df[date_filter_key], date_filter_val)]
+        df = dedupe_frame(df, deduper)
+        rollup_frame(df, rollup)
+        df.to_csv(dst_path, index=False)
+    EXTRACT_ROWS.inc(len(df))
+    if metrics.enabled():
+        EXTRACT_BYTES.inc(getsize(src_path))
+
+
+def partition_bounds(
+    table_md: TableMD, src_path: str, date_filter_val: Optional[Union[str, LoadWindow]] = None
+) -> List[datetime]:
+    """
+    Lower bounds of the partitions the records of a file fall in, read from its index on the partition key (see
+    file_index.get_index). Only tables partitioned themselves have any, the partitions of a master table are created
+    when the delta is upserted into it.
+    :param table_md: Parsed YAML file containing table metadata
+    :type table_md: TableMD
+    :param src_path: Path leading to input JSON file
+    :type src_path: str
+    :param date_filter_val: The specific date value (YYYY-MM-DD) or window the file is filtered on
+    :type date_filter_val: Optional[Union[str, LoadWindow]]
+    :return: Sorted lower bounds (see SQLGenerator.partition_lower_bound)
+    :rtype: List[datetime]
+    """
+    if not table_md.partitioning or table_md.delta_params:
+        return []
+    days = get_index(src_path, table_md.partitioning["key"]).days
+    if date_filter_val is not None:
+        window = LoadWindow.of(date_filter_val)
+        days = [
+            day
+            for day in days
+            if window.overlaps(datetime.fromisoformat(day), datetime.fromisoformat(day) + timedelta(days=1))
+        ]
+    sql_generator = SQLGenerator(table_md=table_md)
+    return sorted({sql_generator.partition_lower_bound(day) for day in days})
+
+
+def load_file(
+    table_md: TableMD,
+    src_file_path: str,
+    dst_file_path: str,
+    date_filter_val: Optional[Union[str, LoadWindow]] = None,
+    streaming: bool = False,
+    create_table: bool = True,
+    upsert: bool = True,
+    pg_hook: Optional[PgHook] = None,
+    after_load: Optional[Callable] = None,
+    cache: Optional[ColumnarCache] = None,
+    copy_format: str = "csv",
+    chunk_rows: Optional[int] = None,
+    chunk_memory: Optional[int] = None,
+    deduper: Optional[Deduper] = None,
+    rollup: Optional[Rollup] = None,
+    create_partitions: bool = True,
+) -> None:
+    """
+    Extract a single JSON file and load it into the table described by the table metadata.
+    :param table_md: Parsed YAML file containing table metadata
+    :type table_md: TableMD
+    :param src_file_path: Path leading to input JSON file
+    :type src_file_path: str
+    :param dst_file_path: Path for the intermediate CSV file (unused when streaming)
+    :type dst_file_path: str
+    :param date_filter_val: The specific date value (YYYY-MM-DD) or window to filter against
+    :type date_filter_val: Optional[Union[str, LoadWindow]]
+    :param streaming: Stream parsed rows straight into COPY instead of going through pandas and a temporary CSV
+    :type streaming: bool
+    :param create_table: Drop and recreate the table before loading
+    :type create_table: bool
+    :param upsert: Upsert into the master table after loading (when delta_params are set)
+    :type upsert: bool
+    :param pg_hook: Hook used for loading, a new one is created when not given
+    :type pg_hook: Optional[PgHook]
+    :param after_load: Called with the loading cursor before the load commits (see PgHook.load_to_table)
+    :type after_load: Optional[Callable]
+    :param cache: Columnar cache of parsed input files
+    :type cache: Optional[ColumnarCache]
+    :param copy_format: "csv" or "binary", binary loads are always streamed
+    :type copy_format: str
+    :param chunk_rows: Extract the file by chunks of this many records (see extract_data)
+    :type chunk_rows: Optional[int]
+    :param chunk_memory: Extract the file by chunks taking up to this many bytes (see extract_data)
+    :type chunk_memory: Optional[int]
+    :param deduper: Drops the rows already loaded (see dedupe.Deduper), committed (or staged, for a delta table that
+    is not upserted) once the file is loaded
+    :type deduper: Optional[Deduper]
+    :param rollup: Aggregates the rows loaded (see rollup.Rollup), merging the aggregates is left to the caller
+    :type rollup: Optional[Rollup]
+    :param create_partitions: Create the partitions of the records of the file (see partition_bounds) in the
+    loading transaction, when the table is partitioned
+    :type create_partitions: bool
     """
-    df = pd.read_json(path_or_buf=src_path)
-    if date_filter_key and date_filter_val:
-        # ensure that pandas column is in correct datetime format for filtering
-        df[date_filter_key] = pd.to_datetime(df[date_filter_key])
-        # this will raise a significant ValueError if format does not correlate
-        start_date = datetime.strptime(date_filter_val, "%Y-%m-%d")
-        end_date = start_date + timedelta(days=1)
-        df = df.loc[df[date_filter_key].between(start_date, end_date)]
-    df.to_csv(dst_path, index=False)
+    if pg_hook is None:
+        pg_hook = PgHook()
+    partitions = partition_bounds(table_md, src_file_path, date_filter_val) if create_partitions else []
+    logger.debug(f"src_file_path is {src_file_path}")
+    if streaming or copy_format == "binary":
+        logger.debug(f"streaming JSON formatted data into COPY: {src_file_path}")
+        pg_hook.load_to_table(
+            table_md=table_md,
+            src_stream=stream_data(
+                src_path=src_file_path,
+                table_md=table_md,
+                date_filter_val=date_filter_val,
+                cache=cache,
+                copy_format=copy_format,
+                deduper=deduper,
+                rollup=rollup,
+            ),
+            create_table=create_table,
+            upsert=upsert,
+            after_load=after_load,
+            copy_format=copy_format,
+            partitions=partitions,
+        )
+    else:
+        logger.debug(
+            f"converting JSON formatted data into CSV: {src_file_path} -> {dst_file_path}"
+        )
+        extract_data(
+            src_path=src_file_path,
+            dst_path=dst_file_path,
+            date_filter_key=table_md.filter_key,
+            date_filter_val=date_filter_val,
+            columns=[col.get("name") for col in table_md.columns],
+            cache=cache,
+            chunk_rows=chunk_rows,
+            chunk_memory=chunk_memory,
+            deduper=deduper,
+            rollup=rollup,
+        )
+        pg_hook.load_to_table(
+            table_md=table_md,
+            src_path=dst_file_path,
+            create_table=create_table,
+            upsert=upsert,
+            after_load=after_load,
+            partitions=partitions,
+        )
+    if deduper is not None:
+        # the rows of the file are committed, to the delta table until it is upserted
+        if upsert or not table_md.delta_params:
+            deduper.commit()
+        else:
+            deduper.stage()
+
+
+def run_jobs(
+    jobs: List[Dict], pg_hook: PgHook, executor: Optional[Executor] = None
+) -> None:
+    """
+    Load files into an existing table, without recreating it nor upserting, either one after another or using
+    the worker processes of an executor.
+    :param jobs: Keyword arguments of load_file, one dict per file
+    :type jobs: List[Dict]
+    :param pg_hook: Hook used for loading
+    :type pg_hook: PgHook
+    :param executor: Executor running the per file loads, files are loaded in this process when not given
+    :type executor: Optional[Executor]
+    """
+    if executor is None:
+        for job in jobs:
+            load_file(create_table=False, upsert=False, pg_hook=pg_hook, **job)
+        return
+
+    # the partitions of every file are created up front, workers creating them in their loads would wait for
+    # each other until the end of their transactions
+    partitions = sorted(
+        {
+            lower_bound
+            for job in jobs
+            for lower_bound in partition_bounds(job["table_md"], job["src_file_path"], job.get("date_filter_val"))
+        }
+    )
+    if partitions:
+        sql_generator = SQLGenerator(table_md=jobs[0]["table_md"])
+        pg_hook.execute([sql_generator.create_partition_query(lower_bound) for lower_bound in partitions])
+
+    # the pool is resolved inside every worker process, so each one keeps a single connection between files
+    worker_hook = replace(pg_hook, pool="process", minconn=1, maxconn=1)
+    futures = [
+        executor.submit(
+            load_file,
+            create_table=False,
+            upsert=False,
+            pg_hook=worker_hook,
+            create_partitions=False,
+            **job,
+        )
+        for job in jobs
+    ]
+    for future in futures:
+        # re-raises the exception of a failed file, the master table is left untouched in that case
+        future.result()
+
+
+def load_files_parallel(
+    executor: Executor, table_md: TableMD, jobs: List[Dict], pg_hook: PgHook
+) -> None:
+    """
+    Load several files into the same table using worker processes. The table is recreated once up front, each
+    worker parses its files and streams them through its own pooled connection, and the upsert into the master
+    table runs once every file is in.
+    :param executor: Executor running the per file loads
+    :type executor: Executor
+    :param table_md: Parsed YAML file containing table metadata
+    :type table_md: TableMD
+    :param jobs: Keyword arguments of load_file, one dict per file
+    :type jobs: List[Dict]
+    :param pg_hook: Hook used for recreating the table and upserting
+    :type pg_hook: PgHook
+    """
+    sql_generator = SQLGenerator(table_md=table_md)
+    pg_hook.execute([sql_generator.drop_table(), sql_generator.create_table_query()])
+
+    run_jobs(jobs=jobs, pg_hook=pg_hook, executor=executor)
+
+    if table_md.delta_params:
+        pg_hook.execute(
+            sql_generator.upsert_on_id(server_version=pg_hook.server_version())
+        )
+
+
+def load_files_with_manifest(
+    table_md: TableMD,
+    jobs: List[Dict],
+    pg_hook: PgHook,
+    executor: Optional[Executor] = None,
+    after_load: Optional[Callable] = None,
+) -> None:
+    """
+    Load only the files that are new or changed since the last run, according to the load manifest of the table
+    (see manifest.LoadManifest). Every file is recorded as staged in the transaction copying it, so a run
+    interrupted partway through a directory resumes where it stopped, and the upsert into the master table marks
+    them all as loaded.
+    :param table_md: Parsed YAML file containing table metadata
+    :type table_md: TableMD
+    :param jobs: Keyword arguments of load_file, one dict per file
+    :type jobs: List[Dict]
+    :param pg_hook: Hook used for the manifest, recreating the table and upserting
+    :type pg_hook: PgHook
+    :param executor: Executor running the per file loads, files are loaded in this process when not given
+    :type executor: Optional[Executor]
+    :param after_load: Called with the cursor of the upsert once the files are loaded, before it commits
+    :type after_load: Optional[Callable]
+    """
+    manifest = LoadManifest(
+        schema=table_md.schema_name, table_name=table_md.table_name, pg_hook=pg_hook
+    )
+    delta = bool(table_md.delta_params)
+    plan = manifest.plan([job["src_file_path"] for job in jobs], delta=delta)
+    if plan.up_to_date:
+        logger.info(f"{table_md.table_name} is up to date, no file to load")
+        return
+    if plan.resumed:
+        logger.info(f"resuming load of {table_md.table_name}, already staged: {plan.resumed}")
+
+    sql_generator = SQLGenerator(table_md=table_md)
+    if plan.recreate_table:
+        with pg_hook.session() as cur:
+            cur.execute(sql_generator.drop_table())
+            cur.execute(sql_generator.create_table_query())
+            manifest.reset(cur, keep_loaded=delta)
+
+    jobs_by_path = {job["src_file_path"]: job for job in jobs}
+    run_jobs(
+        jobs=[
+            dict(
+                jobs_by_path[fingerprint.path],
+                after_load=partial(manifest.mark_staged, fingerprint),
+            )
+            for fingerprint in plan.to_load
+        ],
+        pg_hook=pg_hook,
+        executor=executor,
+    )
+
+    with pg_hook.session() as cur:
+        if delta:
+            cur.execute(
+                sql_generator.upsert_on_id(server_version=cur.connection.server_version)
+            )
+        manifest.mark_loaded(cur)
+        if after_load is not None:
+            after_load(cur)
 
 
 def import_sources(
     tables_md_dir: str,
     raw_data_dir: str,
-    date_filter_val: Optional[str] = None,
+    date_filter_val: Optional[Union[str, LoadWindow]] = None,
+    streaming: bool = False,
+    workers: int = 1,
+    use_manifest: bool = False,
+    cache: Optional[ColumnarCache] = None,
+    copy_format: str = "csv",
+    chunk_rows: Optional[int] = None,
+    chunk_memory: Optional[int] = None,
+    incremental: bool = False,
+    lateness: timedelta = timedelta(0),
+    dedupe_key: Optional[Union[str, Sequence[str]]] = None,
+    dedupe_capacity: int = 1000000,
+    dedupe_error_rate: float = 0.001,
+    rollup: Optional[Rollup] = None,
+    notify_loaded: bool = False,
 ) -> None:
     """
     This function iterates over table metadata files in a specific directory path, importing
     all of them and loading them to a PostgreSQL database. Glob is used to load several files (if relevant)
     using file prefix. Note that files must end with a .json suffix.
+    All the files of a prefix are loaded into the same table: it is recreated before the first file and upserted
+    into the master table after the last one.
     :param tables_md_dir: Path leading to table metadata directory
     :type tables_md_dir: str
     :param raw_data_dir: Path leading to raw output to extract data from
     :type raw_data_dir: str
-    :param date_filter_val: The specific date value to filter against
-    :type date_filter_val: Optional[str]
-    """
-    for table_md in listdir(tables_md_dir):
-        md = TableMD(table_md_path=join(tables_md_dir, table_md))
-        logger.debug(f"processing data for table {md.table_name}")
-        src_dir_path = join(raw_data_dir, md.load_prefix)
-        logger.debug(f"src_dir_path is {src_dir_path}")
-
-        with TemporaryDirectory(dir="/tmp", prefix=md.load_prefix) as tmpdir:
-            input_data = glob(join(src_dir_path, "*.json"))
-            if not input_data:
-                logger.info(f"no files were found in {src_dir_path}")
-
-            for i, file in enumerate(input_data):
-                src_file_path = join(src_dir_path, file)
-                logger.debug(f"src_file_path is {src_file_path}")
-                dst_file_path = join(tmpdir, md.load_prefix + str(i))
-                logger.debug(
-                    f"converting JSON formatted data into CSV: {src_file_path} -> {dst_file_path}"
-                )
-                extract_data(
-                    src_path=src_file_path,
-                    dst_path=dst_file_path,
-                    date_filter_key=md.filter_key,
-                    date_filter_val=date_filter_val,
+    :param date_filter_val: The specific date value (YYYY-MM-DD) or window to filter against
+    :type date_filter_val: Optional[Union[str, LoadWindow]]
+    :param streaming: Stream parsed rows straight into COPY instead of going through pandas and a temporary CSV
+    :type streaming: bool
+    :param workers: Number of worker processes loading files in parallel (1 loads them one after another)
+    :type workers: int
+    :param use_manifest: Skip the files loaded by previous runs (see load_files_with_manifest), only applies to
+    loads without a date filter
+    :type use_manifest: bool
+    :param cache: Columnar cache of parsed input files, files are parsed on every load when not given
+    :type cache: Optional[ColumnarCache]
+    :param copy_format: "csv" or "binary" (see stream_data)
+    :type copy_format: str
+    :param chunk_rows: Extract files by chunks of this many records (see extract_data)
+    :type chunk_rows: Optional[int]
+    :param chunk_memory: Extract files by chunks taking up to this many bytes (see extract_data)
+    :type chunk_memory: Optional[int]
+    :param incremental: Only load the records of the tables with a filter key from their high watermark on, the
+    watermark moving up to the largest value loaded (see watermark.Watermarks). Replaces date_filter_val.
+    :type incremental: bool
+    :param lateness: How far back from the watermark records are loaded again in incremental mode, to catch the
+    records arriving late
+    :type lateness: timedelta
+    :param dedupe_key: Drop the records of the tables having this column (or these columns) whose values were already
+    loaded into the table (the master table of deltas) or appear in an earlier file, see dedupe.Deduper. The values
+    must identify a record, records sharing them are dropped. Only loads files one after another.
+    :type dedupe_key: Optional[Union[str, Sequence[str]]]
+    :param dedupe_capacity: Number of keys the filter of every deduplicated table is sized for
+    :type dedupe_capacity: int
+    :param dedupe_error_rate: False positive rate of the filters, i.e. the rate of keys looked up in the database
+    :type dedupe_error_rate: float
+    :param rollup: Aggregates the records of the tables having the rollup columns and the dedupe_key columns (see
+    rollup.Rollup), merged into the rollup tables in the transaction upserting the last file of a table. Requires
+    dedupe_key, records loaded again would be counted again, and only loads files one after another.
+    :type rollup: Optional[Rollup]
+    :param notify_loaded: Notify every table loaded on sql_gen.TABLE_LOADED_CHANNEL, for the caches of the tables
+    (e.g. the organizations of the consumers) to reload them
+    :type notify_loaded: bool
+    """
+    if (dedupe_key or rollup is not None) and workers > 1:
+        raise ValueError("deduplication and rollups only work with files loaded one after another (workers=1)")
+    if rollup is not None and not dedupe_key:
+        raise ValueError("rollups count the records loaded again as well, they require deduplication (dedupe_key)")
+    dedupe_columns = [dedupe_key] if isinstance(dedupe_key, str) else list(dedupe_key or ())
+    pg_hook = PgHook()
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for table_md in listdir(tables_md_dir):
+            md = TableMD(table_md_path=join(tables_md_dir, table_md))
+            logger.debug(f"processing data for table {md.table_name}")
+            src_dir_path = join(raw_data_dir, md.load_prefix)
+            logger.debug(f"src_dir_path is {src_dir_path}")
+            watermarks = None
+            md_filter_val = date_filter_val
+            if incremental and md.filter_key:
+                watermarks = Watermarks(schema=md.schema_name, pg_hook=pg_hook)
+                md_filter_val = watermarks.window(md.table_name, lateness)
+                logger.info(f"loading {md.table_name} incrementally, {md.filter_key} in {md_filter_val}")
+            deduper = None
+            if dedupe_key and set(dedupe_columns) <= {col.get("name") for col in md.columns}:
+                # seeded from the table on every run, other writers (e.g. the consumers) may have loaded it since
+                deduper = Deduper(
+                    schema=md.schema_name,
+                    table_name=SQLGenerator(table_md=md).partitioned_table(),
+                    key=dedupe_columns,
+                    staging_table=md.table_name if md.delta_params else None,
+                    capacity=dedupe_capacity,
+                    error_rate=dedupe_error_rate,
+                    pg_hook=pg_hook,
                 )
-                pg_hook = PgHook()
-                pg_hook.load_to_table(table_md=md, src_path=dst_file_path)
+            md_rollup = None
+            if deduper is not None and rollup is not None and set(rollup.columns) <= {
+                col.get("name") for col in md.columns
+            }:
+                md_rollup = rollup
+
+            with TemporaryDirectory(
+                dir="/tmp", prefix=md.load_prefix
+            ) as tmpdir, IMPORT_SECONDS.time():
+                input_data = glob(join(src_dir_path, "*.json"))
+                if not input_data:
+                    logger.info(f"no files were found in {src_dir_path}")
+                    continue
+                if md.filter_key and md_filter_val:
+                    # files whose index shows no record of the date are not opened at all
+                    input_data = [
+                        path
+                        for path in input_data
+                        if get_index(path, md.filter_key).may_contain(md_filter_val)
+                    ]
+                    if not input_data:
+                        logger.info(f"no file of {src_dir_path} holds {md_filter_val}")
+                        sql_generator = SQLGenerator(table_md=md)
+                        pg_hook.execute(
+                            [sql_generator.drop_table(), sql_generator.create_table_query()]
+                        )
+                        continue
+
+                IMPORT_FILES.inc(len(input_data))
+                jobs = [
+                    dict(
+                        table_md=md,
+                        src_file_path=join(src_dir_path, file),
+                        dst_file_path=join(tmpdir, md.load_prefix + str(i)),
+                        date_filter_val=md_filter_val,
+                        streaming=streaming,
+                        cache=cache,
+                        copy_format=copy_format,
+                        chunk_rows=chunk_rows,
+                        chunk_memory=chunk_memory,
+                        deduper=deduper,
+                        rollup=md_rollup,
+                    )
+                    for i, file in enumerate(input_data)
+                ]
+                if use_manifest and md_filter_val is None:
+                    load_files_with_manifest(
+                        table_md=md,
+                        jobs=jobs,
+                        pg_hook=pg_hook,
+                        executor=executor,
+                        after_load=None if md_rollup is None else md_rollup.merge,
+                    )
+                elif executor is not None:
+                    load_files_parallel(
+                        executor=executor, table_md=md, jobs=jobs, pg_hook=pg_hook
+                    )
+                else:
+                    for i, job in enumerate(jobs):
+                        last = i == len(jobs) - 1
+                        load_file(
+                            create_table=i == 0,
+                            upsert=last,
+                            pg_hook=pg_hook,
+                            # the rollup commits along with the upsert, the records are never counted unless loaded
+                            after_load=md_rollup.merge if md_rollup is not None and last else None,
+                            **job,
+                        )
+                if deduper is not None:
+                    deduper.commit()
+                if watermarks is not None:
+                    # after the upsert: should the run stop in between, the next one loads the same records again
+                    with pg_hook.session() as cur:
+                        watermarks.advance(
+                            cur, md.table_name, loaded_table=md.table_name, key=md.filter_key
+                        )
+                if notify_loaded:
+                    pg_hook.execute(SQLGenerator(table_md=md).notify_loaded_query())
+    finally:
+        if executor is not None:
+            executor.shutdown()
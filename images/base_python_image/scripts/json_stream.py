@@ -0,0 +1,113 @@
+import codecs
+import json
+import re
+from typing import BinaryIO, Iterator, Optional, Tuple, Union
+
+
+# amount of bytes read from the input file whenever the streaming parser runs out of buffered data
+READ_SIZE = 1 << 16
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class _Window:
+    """
+    Window of decoded text over a binary file, keeping track of the byte offset of every position in the window
+    so that records can be located in the file (see iter_json_records with_offsets).
+    """
+
+    def __init__(self, f: BinaryIO, read_size: int, offset: int = 0):
+        self.f = f
+        self.read_size = read_size
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.eof = False
+        # byte offset of a position of the window, advanced as positions are asked for
+        self._pos, self._offset = 0, offset
+
+    def fill(self, pos: int) -> int:
+        """Drops the window up to pos and reads more data, returns the position pos moved to"""
+        self._offset, self._pos = self.offset(pos), 0
+        more = self.f.read(self.read_size)
+        self.buf = self.buf[pos:] + self.decoder.decode(more, final=not more)
+        self.eof = not more
+        return 0
+
+    def offset(self, pos: int) -> int:
+        """Byte offset in the file of a position of the window, positions must be asked for in order"""
+        self._offset += len(self.buf[self._pos : pos].encode("utf-8"))
+        self._pos = pos
+        return self._offset
+
+
+def iter_json_records(
+    src_path: str,
+    read_size: int = READ_SIZE,
+    with_offsets: bool = False,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+) -> Iterator[Union[dict, Tuple[dict, int, int]]]:
+    """
+    Lazily parse a JSON file containing either a list of objects or a single object, yielding one object at a
+    time. Only a small window of the file is kept in memory, regardless of the size of the file.
+    :param src_path: Path leading to input JSON file
+    :type src_path: str
+    :param read_size: Amount of bytes read from the file at once
+    :type read_size: int
+    :param with_offsets: Yield (record, start, end) tuples holding the byte offsets of every record in the file
+    :type with_offsets: bool
+    :param start: Byte offset of a record of the list to start parsing from (as reported with with_offsets)
+    :type start: Optional[int]
+    :param end: Byte offset to stop at, records starting at or after it are not parsed
+    :type end: Optional[int]
+    """
+    decoder = json.JSONDecoder()
+    with open(src_path, "rb") as f:
+        if start is not None:
+            f.seek(start)
+        window = _Window(f, read_size, offset=start or 0)
+        pos = 0
+        if start is None:
+            while True:
+                pos = WHITESPACE.match(window.buf, pos).end()
+                if pos < len(window.buf) or window.eof:
+                    break
+                pos = window.fill(pos)
+            if pos == len(window.buf):
+                return
+            if window.buf[pos] != "[":
+                # a single object is bounded in size, there is nothing to stream
+                record = json.loads(
+                    window.buf[pos:] + window.decoder.decode(f.read(), final=True)
+                )
+                yield (record, window.offset(pos), f.tell()) if with_offsets else record
+                return
+            pos += 1
+
+        while True:
+            pos = WHITESPACE.match(window.buf, pos).end()
+            if end is not None and window.offset(pos) >= end:
+                return
+            if pos < len(window.buf) and window.buf[pos] == "]":
+                return
+            if pos < len(window.buf) and window.buf[pos] == ",":
+                pos += 1
+                continue
+            record, record_end = None, None
+            if pos < len(window.buf):
+                try:
+                    record, record_end = decoder.raw_decode(window.buf, pos)
+                except json.JSONDecodeError:
+                    if window.eof:
+                        raise
+            # a value ending with the window might continue in the next one (e.g. a number), so it is only
+            # accepted once the following character was read
+            if record_end is not None and (record_end < len(window.buf) or window.eof):
+                if with_offsets:
+                    yield record, window.offset(pos), window.offset(record_end)
+                else:
+                    yield record
+                pos = record_end
+                continue
+            if window.eof:
+                raise ValueError(f"unexpected end of file in {src_path}")
+            pos = window.fill(pos)
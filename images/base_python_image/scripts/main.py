@@ -1,33 +1,90 @@
-from datetime import datetime
-from file_op import import_sources
-import pyfiglet
-from termcolor import colored
+from datetime import datetime, timedelta
+from columnar_cache import ColumnarCache, DEFAULT_MAX_BYTES
+import metrics
 from pathlib import Path
 from os.path import join
 from psql_client import PgHook
-from typing import Union
+from typing import List, Optional, Union
 from os.path import dirname
+from os import environ
+from sys import argv
+from file_index import LoadWindow
 
 
 ROOT_DIR = Path(__file__).parent.absolute()
 TABLE_METADATA_DIR = join(ROOT_DIR, "table_metadata")
 SQL_MODELLING_DIR = join(ROOT_DIR, "modelling")
 RAW_DATA_DIR = join(dirname(ROOT_DIR), "raw_data")
+# number of processes loading files in parallel, 1 loads them one after another
+IMPORT_WORKERS = int(environ.get("IMPORT_WORKERS", "1"))
+# skip the files loaded by previous runs when loading all events (see manifest.py), off so that loading all events
+# reloads every file
+LOAD_MANIFEST = environ.get("LOAD_MANIFEST", "false").lower() == "true"
+# columnar cache of parsed input files (requires pyarrow), warm or clear it with python columnar_cache.py warm|clear
+COLUMNAR_CACHE = environ.get("COLUMNAR_CACHE", "false").lower() == "true"
+COLUMNAR_CACHE_DIR = environ.get("COLUMNAR_CACHE_DIR", join(RAW_DATA_DIR, ".cache"))
+COLUMNAR_CACHE_MAX_BYTES = int(environ.get("COLUMNAR_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+# stream the parsed records straight into COPY instead of going through pandas and a temporary CSV file, so that
+# memory does not grow with the size of the files
+IMPORT_STREAMING = environ.get("IMPORT_STREAMING", "false").lower() == "true"
+# "csv" or "binary", binary COPY encodes rows according to the column types of the table metadata
+IMPORT_COPY_FORMAT = environ.get("IMPORT_COPY_FORMAT", "csv")
+# extract files by chunks of EXTRACT_CHUNK_ROWS records, or of as many records as fit in EXTRACT_CHUNK_MEMORY_MB, to
+# bound the memory taken by large files (0 parses every file at once)
+EXTRACT_CHUNK_ROWS = int(environ.get("EXTRACT_CHUNK_ROWS", "0")) or None
+EXTRACT_CHUNK_MEMORY = int(float(environ.get("EXTRACT_CHUNK_MEMORY_MB", "0")) * (1 << 20)) or None
+# incremental loads go back this many minutes before the high watermark, to catch the events arriving late
+LOAD_LATENESS = timedelta(minutes=float(environ.get("LOAD_LATENESS_MINUTES", "0")))
+# drop the events whose DEDUPE_KEY (comma separated columns identifying an event) was already loaded, using a filter
+# sized for DEDUPE_CAPACITY keys (see dedupe.py)
+DEDUPE = environ.get("DEDUPE", "false").lower() == "true"
+DEDUPE_KEY = environ.get("DEDUPE_KEY", "id,event_type,received_at").split(",")
+DEDUPE_CAPACITY = int(environ.get("DEDUPE_CAPACITY", "1000000"))
+DEDUPE_ERROR_RATE = float(environ.get("DEDUPE_ERROR_RATE", "0.001"))
+# aggregate the events into modelled.events_rollup(_users) while loading them (see rollup.py), requires DEDUPE=true
+ROLLUP = environ.get("ROLLUP", "false").lower() == "true"
+# notify the tables loaded on the table_loaded channel, the consumers caching the organizations reload them
+NOTIFY_LOADED = environ.get("NOTIFY_LOADED", "true").lower() == "true"
+# "incremental" recomputes only the dates of the latest delta load, "full" rebuilds modelled.fact_events and "auto"
+# recomputes incrementally after every load but the load of all events
+MODELLING_MODE = environ.get("MODELLING_MODE", "auto")
+# counters and latency histograms of the pipeline stages, served to Prometheus on METRICS_PORT (0 does not serve
+# them) and logged every METRICS_LOG_INTERVAL seconds (0 does not log them)
+METRICS = environ.get("METRICS", "false").lower() == "true"
+METRICS_PORT = int(environ.get("METRICS_PORT", "0"))
+METRICS_LOG_INTERVAL = float(environ.get("METRICS_LOG_INTERVAL", "60"))
 
 
-def cli() -> Union[str, None]:
+# choices of the cli besides the date filter values
+INCREMENTAL = "incremental"
+EXIT = "exit"
+
+
+def cli() -> Union[str, LoadWindow, None]:
+    """
+    Asks which events to load
+    :return: None to load all events, a date (YYYY-MM-DD) or a window of dates to load, INCREMENTAL to load the
+    events newer than the watermark or EXIT
+    :rtype: Union[str, LoadWindow, None]
+    """
+    # only the interactive mode needs them, scheduled runs start without
+    import pyfiglet
+    from termcolor import colored
+
     print(colored(pyfiglet.figlet_format("WELCOME"), "green"))
     print(
         """Choose one of the following: \n
     (1) load all events 
     (2) load specific date from events
-    (3) exit
+    (3) load a range of dates from events (backfill)
+    (4) load new events since the last incremental load
+    (5) exit
     ** Organizations related data is loaded in full in either of the choices
     """
     )
     while True:
         choice = input("Your choice: ")
-        if choice in ["1", "2", "3"]:
+        if choice in ["1", "2", "3", "4", "5"]:
             break
         print("Invalid selection, please choose again")
     while True:
@@ -45,27 +102,112 @@ def cli() -> Union[str, None]:
                     "Invalid date format, please enter a date that is in YYYY-MM-DD format"
                 )
         elif choice == "3":
-            return "3"
+            first_date = input("Please insert the first date in YYYY-MM-DD format: ")
+            last_date = input("Please insert the last date in YYYY-MM-DD format: ")
+            try:
+                window = LoadWindow.for_dates(first_date, last_date)
+                print(colored(f"Loading data from {first_date} to {last_date}", "green"))
+                return window
+            except ValueError as e:
+                print(f"Invalid dates ({e}), please enter dates that are in YYYY-MM-DD format")
+        elif choice == "4":
+            print(colored("Loading new data", "green"))
+            return INCREMENTAL
+        elif choice == "5":
+            return EXIT
 
 
-def main(table_metadata_dir: str, raw_data_dir: str) -> None:
-    while True:
-        val = cli()
-        if val == "3":
-            break
-        import_sources(
-            tables_md_dir=table_metadata_dir,
-            raw_data_dir=raw_data_dir,
-            date_filter_val=val,
+def run_modelling(incremental: bool = True) -> None:
+    """
+    Runs the SQL modelling of the events. The incremental script only recomputes the received_at dates present in
+    the delta table, the full script rebuilds the fact table from the whole history.
+    :param incremental: Run the incremental script instead of the full rebuild
+    :type incremental: bool
+    """
+    sql_file = "fact_events_incremental.sql" if incremental else "fact_events.sql"
+    with open(join(SQL_MODELLING_DIR, sql_file), "r") as f:
+        sql = f.read()
+
+    pg_hook = PgHook()
+    pg_hook.execute(sql)
+
+
+def parse_args(args: List[str]) -> Union[str, LoadWindow, None]:
+    """
+    Choice of a non-interactive run, for scheduled jobs: "incremental" loads the events newer than the watermark,
+    "backfill <first date> [<last date>]" a range of dates and "all" every event
+    """
+    if args[0] == "incremental":
+        return INCREMENTAL
+    if args[0] == "backfill" and len(args) in (2, 3):
+        return LoadWindow.for_dates(args[1], args[-1])
+    if args[0] == "all":
+        return None
+    raise ValueError(f"usage: main.py [incremental | backfill <first date> [<last date>] | all], got {args}")
+
+
+def load(
+    val: Union[str, LoadWindow, None],
+    table_metadata_dir: str,
+    raw_data_dir: str,
+    incremental_modelling: Optional[bool] = None,
+) -> None:
+    """
+    Loads the events chosen (see cli) and runs the modelling, incrementally after every load of a date, a range of
+    dates or new events (the dates of the delta are recomputed) unless incremental_modelling says otherwise
+    """
+    # the loading modules (pandas above all) are imported once a load was chosen, the menu shows up right away
+    from file_op import import_sources
+    from rollup import Rollup
+
+    incremental = val == INCREMENTAL
+    import_sources(
+        tables_md_dir=table_metadata_dir,
+        raw_data_dir=raw_data_dir,
+        date_filter_val=None if incremental else val,
+        incremental=incremental,
+        lateness=LOAD_LATENESS,
+        streaming=IMPORT_STREAMING,
+        workers=IMPORT_WORKERS,
+        use_manifest=LOAD_MANIFEST,
+        cache=ColumnarCache(
+            cache_dir=COLUMNAR_CACHE_DIR, max_bytes=COLUMNAR_CACHE_MAX_BYTES
         )
+        if COLUMNAR_CACHE
+        else None,
+        copy_format=IMPORT_COPY_FORMAT,
+        chunk_rows=EXTRACT_CHUNK_ROWS,
+        chunk_memory=EXTRACT_CHUNK_MEMORY,
+        dedupe_key=DEDUPE_KEY if DEDUPE else None,
+        dedupe_capacity=DEDUPE_CAPACITY,
+        dedupe_error_rate=DEDUPE_ERROR_RATE,
+        rollup=Rollup() if ROLLUP else None,
+        notify_loaded=NOTIFY_LOADED,
+    )
+    run_modelling(incremental=val is not None if incremental_modelling is None else incremental_modelling)
 
-        with open(join(SQL_MODELLING_DIR, "fact_events.sql"), "r") as f:
-            sql = f.read()
 
-        pg_hook = PgHook()
-        pg_hook.execute(sql)
+def main(
+    table_metadata_dir: str,
+    raw_data_dir: str,
+    incremental_modelling: Optional[bool] = None,
+    args: Optional[List[str]] = None,
+) -> None:
+    if args:
+        load(parse_args(args), table_metadata_dir, raw_data_dir, incremental_modelling)
+        return
+    while True:
+        val = cli()
+        if val == EXIT:
+            break
+        load(val, table_metadata_dir, raw_data_dir, incremental_modelling)
 
 
 if __name__ == "__main__":
+    metrics.configure(
+        enable=METRICS, port=METRICS_PORT, stats_interval=METRICS_LOG_INTERVAL
+    )
     main(table_metadata_dir=TABLE_METADATA_DIR,
-         raw_data_dir=RAW_DATA_DIR)
+         raw_data_dir=RAW_DATA_DIR,
+         incremental_modelling={"incremental": True, "full": False}.get(MODELLING_MODE),
+         args=argv[1:])
@@ -0,0 +1,194 @@
+import hashlib
+import logging
+import psycopg2.extensions
+from dataclasses import dataclass, field
+from os import stat
+from typing import Dict, List, Optional, Tuple
+from psql_client import PgHook
+
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+HASH_READ_SIZE = 1 << 20
+
+# manifest entry statuses: staged files were copied into the table but not upserted into the master table yet
+STAGED = "staged"
+LOADED = "loaded"
+
+CREATE_MANIFEST_SQL = """
+CREATE TABLE IF NOT EXISTS {schema}.load_manifest (
+    table_name varchar(300) NOT NULL,
+    file_path varchar(1000) NOT NULL,
+    size bigint NOT NULL,
+    mtime double precision NOT NULL,
+    sha256 char(64) NOT NULL,
+    status varchar(10) NOT NULL,
+    updated_at timestamp NOT NULL DEFAULT now(),
+    PRIMARY KEY (table_name, file_path)
+);
+"""
+
+
+def file_sha256(path: str) -> str:
+    """Hex SHA-256 digest of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_READ_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass(frozen=True)
+class FileFingerprint:
+    """Identity of a source file's content at the time it was seen"""
+
+    path: str
+    size: int
+    mtime: float
+    sha256: str
+
+
+@dataclass
+class LoadPlan:
+    """
+    Files of a table that need loading, as decided by LoadManifest.plan
+    :param to_load: Files to copy into the table
+    :type to_load: List[FileFingerprint]
+    :param recreate_table: Drop and recreate the table before loading (resetting its manifest entries)
+    :type recreate_table: bool
+    :param resumed: Files already copied into the table by an interrupted run, they are not loaded again
+    :type resumed: List[str]
+    """
+
+    to_load: List[FileFingerprint] = field(default_factory=list)
+    recreate_table: bool = False
+    resumed: List[str] = field(default_factory=list)
+
+    @property
+    def up_to_date(self) -> bool:
+        return not self.to_load and not self.resumed
+
+
+@dataclass
+class LoadManifest:
+    """
+    Bookkeeping of the files loaded into a table, kept in {schema}.load_manifest next to the table itself. Every
+    file is recorded with its size, mtime and content hash, first as staged when it was copied into the table and
+    as loaded once the load of the whole directory completed (after the upsert for delta tables). Repeated runs
+    only load new or changed files and an interrupted run is resumed from the files it already staged.
+    Files are hashed only when their size or mtime differ from the recorded ones.
+    :param schema: Schema of the table, holding the manifest
+    :type schema: str
+    :param table_name: Table the files are loaded into
+    :type table_name: str
+    :param pg_hook: Hook used for reading the manifest
+    :type pg_hook: PgHook
+    """
+
+    schema: str
+    table_name: str
+    pg_hook: PgHook = field(default_factory=PgHook)
+
+    def create_table_query(self) -> str:
+        return CREATE_MANIFEST_SQL.format(schema=self.schema)
+
+    def entries(self) -> Dict[str, Tuple[int, float, str, str]]:
+        """Recorded files of the table: file path -> (size, mtime, sha256, status)"""
+        with self.pg_hook.session() as cur:
+            cur.execute(self.create_table_query())
+            cur.execute(
+                f"SELECT file_path, size, mtime, sha256, status FROM {self.schema}.load_manifest "
+                f"WHERE table_name = %s",
+                (self.table_name,),
+            )
+            return {path: tuple(entry) for path, *entry in cur.fetchall()}
+
+    @staticmethod
+    def fingerprint(
+        path: str, entry: Optional[Tuple[int, float, str, str]] = None
+    ) -> FileFingerprint:
+        """Fingerprints a file, reusing the recorded hash when its size and mtime did not change"""
+        st = stat(path)
+        if entry is not None and (entry[0], entry[1]) == (st.st_size, st.st_mtime):
+            sha256 = entry[2]
+        else:
+            logger.debug(f"hashing {path}")
+            sha256 = file_sha256(path)
+        return FileFingerprint(path, st.st_size, st.st_mtime, sha256)
+
+    def plan(self, paths: List[str], delta: bool) -> LoadPlan:
+        """
+        Decides which files to load. Delta tables only receive new and changed files, which are upserted into the
+        master table. Other tables hold the full content of the directory and are rebuilt from every file as soon
+        as a loaded file changed or disappeared.
+        :param paths: Source files currently in the directory
+        :type paths: List[str]
+        :param delta: The table is a delta table (delta_params are set)
+        :type delta: bool
+        """
+        entries = self.entries()
+        new, changed, staged, loaded, stale_staged = [], [], [], [], []
+        fingerprints = []
+        for path in paths:
+            entry = entries.get(path)
+            fingerprint = self.fingerprint(path, entry)
+            fingerprints.append(fingerprint)
+            if entry is None:
+                new.append(fingerprint)
+            elif entry[2] != fingerprint.sha256:
+                changed.append(fingerprint)
+                if entry[3] == STAGED:
+                    stale_staged.append(path)
+            elif entry[3] == STAGED:
+                staged.append(path)
+            else:
+                loaded.append(path)
+        missing = [path for path in entries if path not in paths]
+        stale_staged += [path for path in missing if entries[path][3] == STAGED]
+
+        if stale_staged or (not delta and (changed or missing or (loaded and new))):
+            # rows of files that changed since are in the table, it has to be rebuilt
+            if delta:
+                return LoadPlan(
+                    [fp for fp in fingerprints if fp.path not in loaded],
+                    recreate_table=True,
+                )
+            return LoadPlan(fingerprints, recreate_table=True)
+        if staged:
+            return LoadPlan(new + changed, recreate_table=False, resumed=staged)
+        return LoadPlan(new + changed, recreate_table=bool(new + changed))
+
+    def reset(self, cur: psycopg2.extensions.cursor, keep_loaded: bool) -> None:
+        """Forgets the entries of the table, on the cursor recreating it"""
+        query = f"DELETE FROM {self.schema}.load_manifest WHERE table_name = %s"
+        if keep_loaded:
+            query += f" AND status = '{STAGED}'"
+        cur.execute(query, (self.table_name,))
+
+    def mark_staged(
+        self, fingerprint: FileFingerprint, cur: psycopg2.extensions.cursor
+    ) -> None:
+        """Records a file as copied into the table, on the cursor (transaction) that copied it"""
+        cur.execute(
+            f"""INSERT INTO {self.schema}.load_manifest (table_name, file_path, size, mtime, sha256, status)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (table_name, file_path) DO UPDATE SET size = EXCLUDED.size, mtime = EXCLUDED.mtime,
+            sha256 = EXCLUDED.sha256, status = EXCLUDED.status, updated_at = now()""",
+            (
+                self.table_name,
+                fingerprint.path,
+                fingerprint.size,
+                fingerprint.mtime,
+                fingerprint.sha256,
+                STAGED,
+            ),
+        )
+
+    def mark_loaded(self, cur: psycopg2.extensions.cursor) -> None:
+        """Records every staged file of the table as loaded"""
+        cur.execute(
+            f"UPDATE {self.schema}.load_manifest SET status = '{LOADED}', updated_at = now() "
+            f"WHERE table_name = %s AND status = '{STAGED}'",
+            (self.table_name,),
+        )
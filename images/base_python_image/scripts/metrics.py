@@ -0,0 +1,240 @@
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple, Union
+
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+PREFIX = "dataproc_"
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# instruments only record anything once enabled (see configure), until then every call returns straight away
+_enabled = False
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, histogram: "Histogram"):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.start)
+        return False
+
+
+class Counter:
+    """
+    Monotonically increasing count (rows, bytes, messages...)
+    :param name: Name of the metric, exposed with the PREFIX prefix
+    :type name: str
+    :param documentation: Help text of the metric
+    :type documentation: str
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: Union[int, float] = 1) -> None:
+        if not _enabled:
+            return
+        with self._lock:
+            self.value += amount
+
+    def samples(self) -> List[Tuple[str, Union[int, float]]]:
+        return [(self.name, self.value)]
+
+    def summary(self) -> Optional[str]:
+        return f"{self.name}={self.value}" if self.value else None
+
+
+class Histogram:
+    """
+    Distribution of observed values, latencies in seconds by default. Time a block with ``with histogram.time():``.
+    :param name: Name of the metric, exposed with the PREFIX prefix
+    :type name: str
+    :param documentation: Help text of the metric
+    :type documentation: str
+    :param buckets: Upper bounds of the buckets, in increasing order
+    :type buckets: Tuple[float, ...]
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # the last count holds the values above every bucket (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        if not _enabled:
+            return
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> Union[_Timer, _NullTimer]:
+        return _Timer(self) if _enabled else _NULL_TIMER
+
+    def samples(self) -> List[Tuple[str, Union[int, float]]]:
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            samples.append((f'{self.name}_bucket{{le="{bound}"}}', cumulative))
+        samples.append((f'{self.name}_bucket{{le="+Inf"}}', self.count))
+        samples.append((f"{self.name}_sum", self.sum))
+        samples.append((f"{self.name}_count", self.count))
+        return samples
+
+    def summary(self) -> Optional[str]:
+        if not self.count:
+            return None
+        return f"{self.name}={self.count}x{self.sum / self.count * 1000:.1f}ms"
+
+
+class Registry:
+    """Metrics of the process, by name. Registering an existing name returns the existing metric."""
+
+    def __init__(self):
+        self.metrics: Dict[str, Union[Counter, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def __register(self, metric: Union[Counter, Histogram]) -> Union[Counter, Histogram]:
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self.__register(Counter(name, documentation))
+
+    def histogram(
+        self, name: str, documentation: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self.__register(Histogram(name, documentation, buckets))
+
+    def render(self) -> str:
+        """Metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines += [f"{name} {value}" for name, value in metric.samples()]
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Single line stats of the metrics recorded so far (counts and mean latencies)"""
+        return " ".join(
+            summary
+            for summary in (metric.summary() for metric in self.metrics.values())
+            if summary
+        )
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str) -> Counter:
+    return REGISTRY.counter(name, documentation)
+
+
+def histogram(
+    name: str, documentation: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS
+) -> Histogram:
+    return REGISTRY.histogram(name, documentation, buckets)
+
+
+def start_http_server(port: int, registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """Serves the metrics to Prometheus on http://0.0.0.0:{port}/metrics from a daemon thread"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes are not worth a log line each
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"serving metrics on port {server.server_address[1]}")
+    return server
+
+
+def start_stats_log(interval: float, registry: Registry = REGISTRY) -> threading.Event:
+    """Logs the stats line of the metrics every interval seconds from a daemon thread, set the event to stop"""
+    stop = threading.Event()
+
+    def log_stats():
+        while not stop.wait(interval):
+            stats = registry.summary()
+            if stats:
+                logger.info(f"stats: {stats}")
+
+    threading.Thread(target=log_stats, daemon=True).start()
+    return stop
+
+
+def configure(enable: bool, port: int = 0, stats_interval: float = 0) -> None:
+    """
+    Turns the instrumentation on or off for the process. When disabled, instruments only cost a flag check.
+    :param enable: Record metrics
+    :type enable: bool
+    :param port: Port of the Prometheus endpoint, 0 does not serve the metrics
+    :type port: int
+    :param stats_interval: Seconds between stats log lines, 0 does not log them
+    :type stats_interval: float
+    """
+    global _enabled
+    _enabled = enable
+    if not enable:
+        return
+    if port:
+        start_http_server(port)
+    if stats_interval:
+        start_stats_log(stats_interval)
@@ -0,0 +1,182 @@
+import struct
+from datetime import date, datetime, timezone
+from file_index import parse_timestamp
+from psql_client import COPY_CHUNK_SIZE
+from typing import Callable, Iterable, List, Sequence
+
+
+# PGCOPY binary format: signature, flags and header extension length, then one tuple per row and a -1 trailer
+HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+TRAILER = struct.pack(">h", -1)
+NULL = struct.pack(">i", -1)
+
+PG_EPOCH_ORDINAL = datetime(2000, 1, 1).toordinal()
+
+_FIELD_COUNT = struct.Struct(">h")
+_LENGTH = struct.Struct(">i")
+_INT2 = struct.Struct(">ih")
+_INT4 = struct.Struct(">ii")
+_INT8 = struct.Struct(">iq")
+_FLOAT4 = struct.Struct(">if")
+_FLOAT8 = struct.Struct(">id")
+_TRUE = _LENGTH.pack(1) + b"\x01"
+_FALSE = _LENGTH.pack(1) + b"\x00"
+_TRUE_VALUES = {"t", "true", "y", "yes", "on", "1"}
+
+
+def encode_text(value) -> bytes:
+    data = (value if isinstance(value, str) else str(value)).encode("utf-8")
+    return _LENGTH.pack(len(data)) + data
+
+
+def as_datetime(value) -> datetime:
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    return parse_timestamp(value)
+
+
+def _microseconds(dt: datetime) -> int:
+    """Microseconds between the Postgres epoch and the wall clock time of dt"""
+    days = dt.toordinal() - PG_EPOCH_ORDINAL
+    seconds = days * 86400 + dt.hour * 3600 + dt.minute * 60 + dt.second
+    return seconds * 1000000 + dt.microsecond
+
+
+def encode_timestamp(value) -> bytes:
+    # a timestamp without time zone keeps the wall clock time of the value, like the text input does
+    return _INT8.pack(8, _microseconds(as_datetime(value)))
+
+
+def encode_timestamptz(value) -> bytes:
+    dt = as_datetime(value)
+    if dt.tzinfo is None:
+        # the text input would use the session time zone, binary values are always UTC
+        raise ValueError(f"timestamp {value} has no time zone")
+    return _INT8.pack(8, _microseconds(dt.astimezone(timezone.utc)))
+
+
+def encode_date(value) -> bytes:
+    if not isinstance(value, date):
+        value = as_datetime(value)
+    return _INT4.pack(4, value.toordinal() - PG_EPOCH_ORDINAL)
+
+
+def encode_bool(value) -> bytes:
+    if isinstance(value, str):
+        value = value.strip().lower() in _TRUE_VALUES
+    return _TRUE if value else _FALSE
+
+
+# encoders of the column types of the table metadata, values are encoded with their length prefix
+ENCODERS = {
+    "varchar": encode_text,
+    "character varying": encode_text,
+    "text": encode_text,
+    "char": encode_text,
+    "character": encode_text,
+    "timestamp": encode_timestamp,
+    "timestamp without time zone": encode_timestamp,
+    "timestamptz": encode_timestamptz,
+    "timestamp with time zone": encode_timestamptz,
+    "date": encode_date,
+    "smallint": lambda value: _INT2.pack(2, int(value)),
+    "int2": lambda value: _INT2.pack(2, int(value)),
+    "integer": lambda value: _INT4.pack(4, int(value)),
+    "int": lambda value: _INT4.pack(4, int(value)),
+    "int4": lambda value: _INT4.pack(4, int(value)),
+    "bigint": lambda value: _INT8.pack(8, int(value)),
+    "int8": lambda value: _INT8.pack(8, int(value)),
+    "real": lambda value: _FLOAT4.pack(4, float(value)),
+    "float4": lambda value: _FLOAT4.pack(4, float(value)),
+    "double precision": lambda value: _FLOAT8.pack(8, float(value)),
+    "float8": lambda value: _FLOAT8.pack(8, float(value)),
+    "boolean": encode_bool,
+    "bool": encode_bool,
+}
+
+
+def row_encoder(column_types: List[str]) -> Callable[[Sequence], bytes]:
+    """
+    Builds the function encoding a row into a PGCOPY tuple, the encoder of every column is looked up once.
+    :param column_types: Type of every column, as declared in the table metadata
+    :type column_types: List[str]
+    :return: Function encoding a row (values ordered like the columns, None for NULL)
+    :rtype: Callable[[Sequence], bytes]
+    """
+    encoders = []
+    for column_type in column_types:
+        encoder = ENCODERS.get(column_type.strip().lower())
+        if encoder is None:
+            raise ValueError(
+                f"binary COPY does not support the {column_type} type, use the csv format"
+            )
+        encoders.append(encoder)
+    field_count = _FIELD_COUNT.pack(len(encoders))
+
+    def encode_row(row: Sequence) -> bytes:
+        return field_count + b"".join(
+            [
+                NULL if value is None else encode(value)
+                for encode, value in zip(encoders, row)
+            ]
+        )
+
+    return encode_row
+
+
+class BinaryCopyStream:
+    """
+    File-like adapter turning an iterable of rows into the PGCOPY binary format for ``cursor.copy_expert`` with
+    a COPY ... WITH (FORMAT binary) query (see SQLGenerator.copy_query). Postgres does not have to parse the
+    values, they are encoded according to the column types. Rows are pulled lazily, like CopyStream does.
+    :param rows: Iterable of rows, each row being a sequence of values ordered like the COPY column list
+    :type rows: Iterable[Sequence]
+    :param column_types: Type of every column, as declared in the table metadata
+    :type column_types: List[str]
+    :param chunk_size: Minimal amount of bytes encoded at once
+    :type chunk_size: int
+    """
+
+    def __init__(
+        self,
+        rows: Iterable[Sequence],
+        column_types: List[str],
+        chunk_size: int = COPY_CHUNK_SIZE,
+    ):
+        self.rows = iter(rows)
+        self.chunk_size = chunk_size
+        self.rows_written = 0
+        self._encode_row = row_encoder(column_types)
+        self._pending = bytearray(HEADER)
+        self._exhausted = False
+
+    def _fill(self) -> None:
+        chunk = []
+        size = 0
+        for row in self.rows:
+            encoded = self._encode_row(row)
+            chunk.append(encoded)
+            size += len(encoded)
+            self.rows_written += 1
+            if size >= self.chunk_size:
+                break
+        else:
+            self._exhausted = True
+            chunk.append(TRAILER)
+        self._pending += b"".join(chunk)
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            while not self._exhausted:
+                self._fill()
+            size = len(self._pending)
+        while not self._exhausted and len(self._pending) < size:
+            self._fill()
+        chunk = bytes(self._pending[:size])
+        del self._pending[:size]
+        return chunk
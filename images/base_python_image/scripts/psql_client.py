@@ -1,10 +1,17 @@
 import psycopg2
 import psycopg2.extras
 import psycopg2.extensions
-from contextlib import closing
-from typing import List
+import psycopg2.pool
+import csv
+import io
+import os
+import threading
+from contextlib import closing, contextmanager
+from typing import IO, Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
 from dataclasses import dataclass
+from datetime import datetime
 import logging
+import metrics
 from sql_gen import SQLGenerator, TableMD
 from typing import Optional, Union
 from os.path import isfile, expandvars
@@ -13,6 +20,157 @@ from os.path import isfile, expandvars
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# number of characters handed over to psycopg2 on every read of a COPY stream
+COPY_CHUNK_SIZE = 1 << 16
+
+DB_QUERIES = metrics.counter("db_queries_total", "Queries executed by PgHook.execute")
+DB_QUERY_SECONDS = metrics.histogram(
+    "db_query_seconds", "Time spent executing queries with PgHook.execute"
+)
+DB_COPY_SECONDS = metrics.histogram("db_copy_seconds", "Time spent in COPY commands")
+DB_COPY_BYTES = metrics.counter("db_copy_bytes_total", "Bytes of CSV files loaded with COPY")
+
+
+class BlockingThreadedConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """
+    Thread-safe pool that makes callers wait for a free connection instead of raising PoolError once maxconn
+    connections are checked out.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, *args, **kwargs):
+        self._slots = threading.BoundedSemaphore(maxconn)
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def getconn(self, key=None):
+        self._slots.acquire()
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+
+# "threaded" can be shared by every thread of a process, "process" is a cheaper lock-free pool for processes that
+# only use the database from a single thread (e.g. the consumer or import worker processes)
+POOL_TYPES = {
+    "threaded": BlockingThreadedConnectionPool,
+    "process": psycopg2.pool.SimpleConnectionPool,
+}
+
+_pools: Dict[Tuple, psycopg2.pool.AbstractConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(
+    pool_type: str, minconn: int, maxconn: int, **conn_params
+) -> psycopg2.pool.AbstractConnectionPool:
+    """
+    Returns the process-wide connection pool matching the pool type and connection parameters, creating it on
+    first use. Pools are registered per process id, so a forked child never reuses the sockets of its parent.
+    :param pool_type: One of POOL_TYPES ("threaded" or "process")
+    :type pool_type: str
+    :param minconn: Connections opened when the pool is created
+    :type minconn: int
+    :param maxconn: Upper bound of connections opened by the pool
+    :type maxconn: int
+    :return: A psycopg2 connection pool
+    :rtype: psycopg2.pool.AbstractConnectionPool
+    """
+    if pool_type not in POOL_TYPES:
+        raise ValueError(
+            f"unknown pool type {pool_type}, expected one of {list(POOL_TYPES)}"
+        )
+    key = (os.getpid(), pool_type, minconn, maxconn, tuple(sorted(conn_params.items())))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            logger.debug(f"creating {pool_type} connection pool ({minconn}-{maxconn})")
+            pool = POOL_TYPES[pool_type](minconn, maxconn, **conn_params)
+            _pools[key] = pool
+    return pool
+
+
+def close_pools() -> None:
+    """Closes every connection pool opened by the current process"""
+    pid = os.getpid()
+    with _pools_lock:
+        for key in [key for key in _pools if key[0] == pid]:
+            _pools.pop(key).closeall()
+
+
+class CopyStream:
+    """
+    File-like adapter turning an iterable of rows into CSV text for ``cursor.copy_expert``. Rows are only pulled
+    from the iterable when psycopg2 asks for more data, so memory stays bounded by the chunk size instead of
+    the size of the dataset. None values are written as empty unquoted fields, which COPY reads as NULL.
+    :param rows: Iterable of rows, each row being a sequence of values ordered like the COPY column list
+    :type rows: Iterable[Sequence]
+    :param header: Column names written as the first line (COPY queries are generated with CSV HEADER)
+    :type header: Optional[Sequence[str]]
+    :param delimiter: CSV delimiter
+    :type delimiter: str
+    :param chunk_size: Minimal amount of characters encoded at once
+    :type chunk_size: int
+    """
+
+    def __init__(
+        self,
+        rows: Iterable[Sequence],
+        header: Optional[Sequence[str]] = None,
+        delimiter: str = ",",
+        chunk_size: int = COPY_CHUNK_SIZE,
+    ):
+        self.rows = iter(rows)
+        self.chunk_size = chunk_size
+        self.rows_written = 0
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(
+            self._buffer, delimiter=delimiter, lineterminator="\n"
+        )
+        self._pending = ""
+        self._exhausted = False
+        if header:
+            self._writer.writerow(header)
+
+    def _fill(self) -> None:
+        for row in self.rows:
+            self._writer.writerow(row)
+            self.rows_written += 1
+            if self._buffer.tell() >= self.chunk_size:
+                break
+        else:
+            self._exhausted = True
+        self._pending += self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+    def read(self, size: int = -1) -> str:
+        if size is None or size < 0:
+            while not self._exhausted:
+                self._fill()
+            chunk, self._pending = self._pending, ""
+            return chunk
+        while not self._exhausted and len(self._pending) < size:
+            self._fill()
+        chunk, self._pending = self._pending[:size], self._pending[size:]
+        return chunk
+
+    def readline(self) -> str:
+        while not self._exhausted and "\n" not in self._pending:
+            self._fill()
+        end = self._pending.find("\n") + 1 or len(self._pending)
+        line, self._pending = self._pending[:end], self._pending[end:]
+        return line
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.readline, "")
+
 
 @dataclass
 class PgHook:
@@ -29,6 +187,13 @@ class PgHook:
     :type host: str
     :param port: port exposed by postgres to connect through (default 5432)
     :type port: str
+    :param pool: Borrow connections from a process-wide pool ("threaded" or "process") instead of connecting
+        on every call, see POOL_TYPES
+    :type pool: Optional[str]
+    :param minconn: Connections opened when the pool is created
+    :type minconn: int
+    :param maxconn: Upper bound of connections opened by the pool
+    :type maxconn: int
     """
 
     database: str = expandvars("$POSTGRES_DB")
@@ -36,6 +201,9 @@ class PgHook:
     password: str = expandvars("$POSTGRES_PASSWORD")
     host: str = expandvars("$POSTGRES_HOST")
     port: str = expandvars("$POSTGRES_PORT")
+    pool: Optional[str] = None
+    minconn: int = 1
+    maxconn: int = 10
 
     def get_conn(self) -> psycopg2.extensions.connection:
         """
@@ -54,6 +222,61 @@ class PgHook:
             port=self.port,
         )
 
+    def get_pool(self) -> psycopg2.pool.AbstractConnectionPool:
+        """Returns the process-wide pool this hook borrows connections from"""
+        return get_pool(
+            self.pool,
+            self.minconn,
+            self.maxconn,
+            database=self.database,
+            user=self.user,
+            password=self.password,
+            host=self.host,
+            port=self.port,
+        )
+
+    @contextmanager
+    def connection(self) -> Iterator[psycopg2.extensions.connection]:
+        """
+        Context manager handing out a connection for a single transaction. The transaction is committed when the
+        block exits and rolled back on error. Pooled connections are returned to the pool, others are closed.
+        """
+        if not self.pool:
+            with closing(self.get_conn()) as conn:
+                yield conn
+                conn.commit()
+            return
+
+        pool = self.get_pool()
+        conn = pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            # broken connections are discarded so that the next caller gets a fresh one
+            pool.putconn(conn, close=bool(conn.closed))
+
+    @contextmanager
+    def session(self) -> Iterator[psycopg2.extensions.cursor]:
+        """
+        Context manager running several statements on one connection and in one transaction, e.g.
+        with hook.session() as cur:
+            cur.execute(...)
+            cur.copy_expert(...)
+        """
+        with self.connection() as conn:
+            with closing(conn.cursor()) as cur:
+                yield cur
+
+    def server_version(self) -> int:
+        """Version number of the server, e.g. 150004 for PostgreSQL 15.4"""
+        with self.connection() as conn:
+            return conn.server_version
+
     def execute(self, queries: Union[List[str], str]) -> None:
         """Executes a singular query or several queries against a PostgreSQL database
         :param queries: A single string query or a list of queries to execute
@@ -61,12 +284,12 @@ class PgHook:
         """
         if isinstance(queries, str):
             queries = [queries]
-        with closing(self.get_conn()) as conn:
-            with closing(conn.cursor()) as cur:
-                for query in queries:
-                    logger.debug(f"executing query: {query}")
+        with self.session() as cur:
+            for query in queries:
+                logger.debug(f"executing query: {query}")
+                with DB_QUERY_SECONDS.time():
                     cur.execute(query)
-            conn.commit()
+                DB_QUERIES.inc()
 
     def copy_expert(self, query: str, src_path: str) -> None:
         """Load data from a specific CSV file using a COPY command. Note, the psycopg2 given method
@@ -81,37 +304,122 @@ class PgHook:
 
         logger.info(f"copying file from: {src_path}")
         with open(src_path, "r") as f:
-            with closing(self.get_conn()) as conn:
-                with closing(conn.cursor()) as cur:
-                    cur.copy_expert(query, f)
-                conn.commit()
+            with self.session() as cur, DB_COPY_SECONDS.time():
+                cur.copy_expert(query, f)
+        if metrics.enabled():
+            DB_COPY_BYTES.inc(os.path.getsize(src_path))
+
+    def copy_stream(
+        self,
+        query: str,
+        stream: IO,
+        size: int = COPY_CHUNK_SIZE,
+        after_load: Optional[Callable[[psycopg2.extensions.cursor], None]] = None,
+    ) -> None:
+        """Load data from a file-like object (e.g. CopyStream) using a COPY command, without going through
+        a file on disk.
+        :param query: SQL COPY query
+        :type query: str
+        :param stream: File-like object exposing a read method
+        :type stream: IO
+        :param size: Size of the chunks read from the stream on every round trip
+        :type size: int
+        :param after_load: Called with the loading cursor once the data is in, before the transaction commits
+        :type after_load: Optional[Callable[[psycopg2.extensions.cursor], None]]
+        """
+        logger.info(f"copying data from stream: {stream}")
+        with self.session() as cur:
+            with DB_COPY_SECONDS.time():
+                cur.copy_expert(query, stream, size=size)
+            if after_load is not None:
+                after_load(cur)
 
     def load_to_table(
         self,
-        src_path: str,
+        src_path: Optional[str] = None,
         table_md: Optional[TableMD] = None,
         table_md_path: Optional[str] = None,
+        src_stream: Optional[IO] = None,
+        create_table: bool = True,
+        upsert: bool = True,
+        after_load: Optional[Callable[[psycopg2.extensions.cursor], None]] = None,
+        copy_format: str = "csv",
+        partitions: Iterable[datetime] = (),
     ) -> None:
-        """Load data to a designated table using table metadata yaml file to construct the table. Only CSV format
-        is valid.
+        """Load data to a designated table using table metadata yaml file to construct the table. Files must be in
+        CSV format, streams either in CSV or binary COPY format. Data is read either from a file (src_path) or from a
+        file-like object (src_stream).
+        Loading several files into the same table is done by recreating the table only for the first one and
+        upserting (if delta_params are set) only after the last one.
         :param src_path: Path to the file to load into the database (singular file)
-        :type src_path: str
+        :type src_path: Optional[str]
         :param table_md: Parsed YAML file containing table metadata
         :type table_md: Optional[TableMD]
         :param table_md_path: Path to a table metadata YAML file
         :type table_md_path: Optional[str]
+        :param src_stream: File-like object containing CSV data, used instead of src_path
+        :type src_stream: Optional[IO]
+        :param create_table: Drop and recreate the table before loading
+        :type create_table: bool
+        :param upsert: Upsert the loaded data into the master table afterwards (when delta_params are set)
+        :type upsert: bool
+        :param after_load: Called with the loading cursor once the data is in, before the transaction commits
+        :type after_load: Optional[Callable[[psycopg2.extensions.cursor], None]]
+        :param copy_format: Format of src_stream, "csv" or "binary" (e.g. pgcopy.BinaryCopyStream)
+        :type copy_format: str
+        :param partitions: Lower bounds of the partitions the data falls in (see SQLGenerator.partition_lower_bound),
+        created before copying when the table is partitioned, rows outside of them land in the default partition
+        :type partitions: Iterable[datetime]
         """
         if not table_md:
             table_md = TableMD(table_md_path=table_md_path)
+        if src_stream is None and not isfile(src_path):
+            raise FileNotFoundError(f"{src_path} not found")
         sql_generator = SQLGenerator(table_md=table_md)
-        queries = [
-            sql_generator.drop_table(),
-            sql_generator.create_table_query(),
-        ]
-        self.execute(queries)
+        queries = []
+        if create_table:
+            queries += [
+                sql_generator.drop_table(),
+                sql_generator.create_table_query(),
+            ]
+        queries += [sql_generator.create_partition_query(lower_bound) for lower_bound in partitions]
+        # the whole load runs in a single transaction, readers never see a dropped or half loaded table
+        with self.session() as cur:
+            if upsert and table_md.delta_params:
+                queries_after_copy = [
+                    sql_generator.upsert_on_id(
+                        server_version=cur.connection.server_version
+                    )
+                ]
+            else:
+                queries_after_copy = []
+
+            for query in queries:
+                logger.debug(f"executing query: {query}")
+                with DB_QUERY_SECONDS.time():
+                    cur.execute(query)
+                DB_QUERIES.inc()
 
-        self.copy_expert(src_path=src_path, query=sql_generator.copy_query())
+            if src_stream is not None:
+                logger.info(f"copying data from stream: {src_stream}")
+                with DB_COPY_SECONDS.time():
+                    cur.copy_expert(
+                        sql_generator.copy_query(copy_format),
+                        src_stream,
+                        size=COPY_CHUNK_SIZE,
+                    )
+            else:
+                logger.info(f"copying file from: {src_path}")
+                with open(src_path, "r") as f, DB_COPY_SECONDS.time():
+                    cur.copy_expert(sql_generator.copy_query(), f)
+                if metrics.enabled():
+                    DB_COPY_BYTES.inc(os.path.getsize(src_path))
 
-        if table_md.delta_params:
-            self.execute(sql_generator.upsert_on_id())
+            for query in queries_after_copy:
+                logger.debug(f"executing query: {query}")
+                with DB_QUERY_SECONDS.time():
+                    cur.execute(query)
+                DB_QUERIES.inc()
 
+            if after_load is not None:
+                after_load(cur)
@@ -0,0 +1,60 @@
+import asyncio
+import pika
+from typing import Optional
+from pika.adapters.asyncio_connection import AsyncioConnection
+from pika.channel import Channel
+
+
+# pika's asyncio adapter is callback based, these helpers turn its callbacks into awaitables
+
+
+async def open_connection(
+    host: str, on_close_callback=None, loop: Optional[asyncio.AbstractEventLoop] = None
+) -> AsyncioConnection:
+    """
+    Opens a RabbitMQ connection running on the given (or current) event loop
+    :param host: Host name of the RabbitMQ broker (e.g. localhost/container name)
+    :type host: str
+    :param on_close_callback: Called with (connection, exception) once the connection is closed
+    :param loop: Event loop driving the connection
+    :type loop: Optional[asyncio.AbstractEventLoop]
+    :return: An open connection
+    :rtype: AsyncioConnection
+    """
+    loop = loop or asyncio.get_event_loop()
+    opened = loop.create_future()
+
+    def on_open_error(connection, error):
+        if not opened.done():
+            opened.set_exception(
+                error if isinstance(error, BaseException) else ConnectionError(error)
+            )
+
+    AsyncioConnection(
+        pika.ConnectionParameters(host=host),
+        on_open_callback=lambda connection: opened.set_result(connection),
+        on_open_error_callback=on_open_error,
+        on_close_callback=on_close_callback,
+        custom_ioloop=loop,
+    )
+    return await opened
+
+
+async def open_channel(connection: AsyncioConnection, queue: str) -> Channel:
+    """Opens a channel on the connection and declares the queue that is used on it"""
+    loop = asyncio.get_event_loop()
+    opened = loop.create_future()
+    connection.channel(on_open_callback=opened.set_result)
+    channel = await opened
+
+    declared = loop.create_future()
+    channel.queue_declare(queue=queue, callback=declared.set_result)
+    await declared
+    return channel
+
+
+async def set_prefetch(channel: Channel, prefetch_count: int) -> None:
+    """Limits the number of unacknowledged messages the broker pushes onto the channel"""
+    done = asyncio.get_event_loop().create_future()
+    channel.basic_qos(prefetch_count=prefetch_count, callback=done.set_result)
+    await done
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Optional, Set
+from sql_gen import TableMD, SQLGenerator
+from psql_client import PgHook
+from queue_implementation.aio import open_connection, open_channel, set_prefetch
+from queue_implementation.codec import unpack_events
+from queue_implementation.dimension import DimensionCache
+
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class AsyncConsumer:
+    """
+    Asyncio based consumer. Instead of handling one message at a time, up to prefetch_count unacknowledged
+    messages (each holding one or several packed events) are delivered by the broker and written to the
+    database concurrently through a pool of `concurrency` connections. A message is acknowledged once its
+    rows were committed, so when the database falls behind the prefetch window fills up and the broker stops
+    delivering (back-pressure), rather than messages piling up in memory.
+    :param host: Host name of the RabbitMQ broker (e.g. localhost/container name)
+    :type host: str
+    :param queue: RabbitMQ queue to consume messages from
+    :type queue: str
+    :param table_md: Table metadata YAML used to create the table and extract relevant fields from the events
+    :type table_md: TableMD
+    :param prefetch_count: Maximum number of unacknowledged messages in flight
+    :type prefetch_count: int
+    :param concurrency: Number of concurrent database writes (size of the connection pool)
+    :type concurrency: int
+    :param orgs_cache: Cache of the organizations, adding the organization_key column to every event (see
+    Consumer)
+    :type orgs_cache: Optional[DimensionCache]
+    """
+
+    def __init__(
+        self,
+        host: str,
+        queue: str,
+        table_md: TableMD,
+        prefetch_count: int = 100,
+        concurrency: int = 10,
+        orgs_cache: Optional[DimensionCache] = None,
+    ):
+        self.host = host
+        self.queue = queue
+        self.orgs_cache = orgs_cache
+        if orgs_cache is not None:
+            table_md = table_md.with_columns([orgs_cache.column])
+        self.table_md = table_md
+        self.prefetch_count = prefetch_count
+        self.concurrency = concurrency
+        self.fields = [col.get("name") for col in self.table_md.columns]
+        self.sql_gen = SQLGenerator(self.table_md)
+        self.insert_query = self.sql_gen.insert_query()
+        self.pg_hook = PgHook(pool="threaded", maxconn=concurrency)
+        # database calls are blocking, they run on as many threads as there are pooled connections
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        # lower bounds of the partitions known to exist, when the table is partitioned
+        self._partitions: Set[datetime] = set()
+        # the cache is refreshed from one executor thread at a time
+        self._orgs_lock = threading.Lock()
+        self.connection = None
+        self._closed: Optional[asyncio.Future] = None
+
+    def __ensure_partitions(self, rows: List[tuple]) -> None:
+        """Creates the partitions the rows fall in before loading them, when the table is partitioned"""
+        if not self.table_md.partitioning:
+            return
+        key_index = self.fields.index(self.table_md.partitioning["key"])
+        lower_bounds = {
+            self.sql_gen.partition_lower_bound(row[key_index]) for row in rows if row[key_index] is not None
+        } - self._partitions
+        if lower_bounds:
+            # concurrent writes may create the same partition, its creation waits for the other one and skips it
+            self.pg_hook.execute(
+                [self.sql_gen.create_partition_query(lower_bound) for lower_bound in sorted(lower_bounds)]
+            )
+            self._partitions.update(lower_bounds)
+
+    def __create_table(self) -> None:
+        queries = [self.sql_gen.create_table_query()]
+        if self.orgs_cache is not None:
+            queries.append(self.sql_gen.add_columns_query([self.orgs_cache.column]))
+        self.pg_hook.execute(queries)
+
+    def __refresh_orgs(self) -> None:
+        with self._orgs_lock:
+            self.orgs_cache.refresh_if_stale()
+
+    def __extract_rows(self, body, properties) -> List[tuple]:
+        events = unpack_events(body, properties)
+        if self.orgs_cache is not None:
+            events = [self.orgs_cache.enrich(event) for event in events]
+        return self.table_md.row_codec.extract_all(events)
+
+    def __write_rows(self, rows: List[tuple]) -> None:
+        self.__ensure_partitions(rows)
+        with self.pg_hook.session() as cur:
+            cur.executemany(self.insert_query, rows)
+
+    async def __handle_message(self, channel, method, properties, body) -> None:
+        if self.orgs_cache is not None:
+            try:
+                # reading the table blocks, it is done off the event loop
+                await asyncio.get_event_loop().run_in_executor(self.executor, self.__refresh_orgs)
+            except Exception:
+                logger.exception(f"failed refreshing the organizations, requeueing {method.delivery_tag}")
+                channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                return
+        try:
+            rows = self.__extract_rows(body, properties)
+        except (ValueError, TypeError, KeyError, OSError):
+            # a malformed message would fail again on redelivery, it is dropped instead of requeued
+            logger.exception(f"dropping malformed message {method.delivery_tag}")
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            return
+        try:
+            await asyncio.get_event_loop().run_in_executor(
+                self.executor, self.__write_rows, rows
+            )
+        except Exception:
+            logger.exception(f"failed loading message {method.delivery_tag}, requeueing")
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            return
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    def __on_message(self, channel, method, properties, body) -> None:
+        asyncio.ensure_future(self.__handle_message(channel, method, properties, body))
+
+    def __on_connection_closed(self, connection, reason) -> None:
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(reason)
+
+    async def consume_events(self) -> None:
+        """Consumes events until the connection is closed (see stop)"""
+        loop = asyncio.get_event_loop()
+        self._closed = loop.create_future()
+        # create table if not exists for loading
+        await loop.run_in_executor(self.executor, self.__create_table)
+        self.connection = await open_connection(
+            host=self.host, on_close_callback=self.__on_connection_closed
+        )
+        channel = await open_channel(self.connection, queue=self.queue)
+        await set_prefetch(channel, prefetch_count=self.prefetch_count)
+        channel.basic_consume(
+            queue=self.queue, auto_ack=False, on_message_callback=self.__on_message
+        )
+        reason = await self._closed
+        logger.info(f"connection closed: {reason}")
+        if self.orgs_cache is not None:
+            self.orgs_cache.close()
+
+    def stop(self) -> None:
+        if self.connection is not None and not self.connection.is_closed:
+            self.connection.close()
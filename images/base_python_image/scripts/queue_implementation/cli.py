@@ -1,5 +1,3 @@
-import pyfiglet
-from termcolor import colored
 import random
 from shutil import copy, move
 
@@ -9,6 +7,10 @@ def cli() -> int:
     This is really just to have a nice communication with the application and being able to drop a file in a click
     of a button and seeing that the Watcher does pick up the file movement and the postgres is updated (check counts)
     """
+    # imported on first use, they take most of the startup time of this module
+    import pyfiglet
+    from termcolor import colored
+
     print(colored(pyfiglet.figlet_format("WELCOME"), "green"))
     print(
         """Press 1 in order to drop a file containing events in the raw data directory: \n
@@ -36,6 +38,8 @@ def cli() -> int:
 
 
 def exec() -> None:
+    from termcolor import colored
+
     while True:
         val = cli()
         if val == 1:
@@ -0,0 +1,90 @@
+import gzip
+import json
+import pika
+from typing import List, Optional, Tuple
+
+
+# content types understood by the Consumer, messages without a content type hold a single JSON event
+JSON_CONTENT_TYPE = "application/json"
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+GZIP_CONTENT_ENCODING = "gzip"
+
+PACK_FORMATS = {"ndjson": NDJSON_CONTENT_TYPE, "json": JSON_CONTENT_TYPE}
+
+JSON_DECODERS = ["json", "orjson"]
+# decoder of the message bodies, see set_json_decoder
+_loads = json.loads
+
+
+def set_json_decoder(name: str) -> None:
+    """
+    Selects the JSON decoder used by unpack_events: the standard library ("json") or orjson, a faster decoder
+    which has to be installed separately (`pip install orjson`).
+    :param name: "json" or "orjson"
+    :type name: str
+    """
+    global _loads
+    if name not in JSON_DECODERS:
+        raise ValueError(f"unknown JSON decoder {name}, expected one of {JSON_DECODERS}")
+    if name == "orjson":
+        try:
+            import orjson
+        except ImportError as e:
+            raise ImportError(
+                "the orjson decoder requires orjson, install it with `pip install orjson`"
+            ) from e
+        _loads = orjson.loads
+    else:
+        _loads = json.loads
+
+
+def pack_events(
+    events: List[dict], pack_format: str = "ndjson", compress: bool = False
+) -> Tuple[bytes, pika.BasicProperties]:
+    """
+    Packs several events into a single message body, either as newline delimited JSON or as a JSON array.
+    :param events: Events to pack
+    :type events: List[dict]
+    :param pack_format: "ndjson" or "json"
+    :type pack_format: str
+    :param compress: Gzip the body
+    :type compress: bool
+    :return: Message body and the properties describing it
+    :rtype: Tuple[bytes, pika.BasicProperties]
+    """
+    if pack_format not in PACK_FORMATS:
+        raise ValueError(
+            f"unknown pack format {pack_format}, expected one of {list(PACK_FORMATS)}"
+        )
+    if pack_format == "ndjson":
+        body = "\n".join(json.dumps(event) for event in events).encode("utf-8")
+    else:
+        body = json.dumps(events).encode("utf-8")
+    properties = pika.BasicProperties(content_type=PACK_FORMATS[pack_format])
+    if compress:
+        body = gzip.compress(body)
+        properties.content_encoding = GZIP_CONTENT_ENCODING
+    return body, properties
+
+
+def unpack_events(
+    body: bytes, properties: Optional[pika.BasicProperties] = None
+) -> List[dict]:
+    """
+    Decodes a message body into the events it holds, according to its content type and encoding.
+    :param body: Message body
+    :type body: bytes
+    :param properties: Message properties (None for messages published without any)
+    :type properties: Optional[pika.BasicProperties]
+    :return: Events held by the message
+    :rtype: List[dict]
+    """
+    content_type = getattr(properties, "content_type", None)
+    if getattr(properties, "content_encoding", None) == GZIP_CONTENT_ENCODING:
+        body = gzip.decompress(body)
+    if content_type == NDJSON_CONTENT_TYPE:
+        return [_loads(line) for line in body.splitlines() if line.strip()]
+    data = _loads(body)
+    if content_type == JSON_CONTENT_TYPE and isinstance(data, list):
+        return data
+    return [data]
@@ -1,7 +1,33 @@
-import pika
-import json
+import metrics
+import threading
+from functools import partial
+from time import monotonic
+from typing import List, Optional
 from sql_gen import TableMD, SQLGenerator
-from psql_client import PgHook
+from psql_client import PgHook, CopyStream
+from pgcopy import BinaryCopyStream
+from dedupe import Deduper
+from rollup import Rollup
+from queue_implementation.codec import unpack_events
+from queue_implementation.dimension import DimensionCache
+from queue_implementation.sharding import shard_queue
+from queue_implementation.transport import PikaTransport, Transport
+
+CONSUMER_MESSAGES = metrics.counter("consumer_messages_total", "Messages consumed")
+CONSUMER_EVENTS = metrics.counter("consumer_events_total", "Events consumed")
+CONSUMER_ACKS = metrics.counter("consumer_acks_total", "Acknowledgements sent to the broker")
+CONSUMER_BATCHES = metrics.counter("consumer_batches_total", "Batches loaded in batch mode")
+CONSUMER_BATCH_ROWS = metrics.histogram(
+    "consumer_batch_rows",
+    "Rows of the batches loaded in batch mode",
+    buckets=(1, 10, 100, 1000, 10000, 100000),
+)
+CONSUMER_PARSE_SECONDS = metrics.histogram(
+    "consumer_parse_seconds", "Time spent decoding a message and extracting its rows"
+)
+CONSUMER_DB_SECONDS = metrics.histogram(
+    "consumer_db_seconds", "Time spent loading the rows of a message (single mode) or of a batch (batch mode)"
+)
 
 
 class Consumer:
@@ -9,91 +35,236 @@ class Consumer:
     This consumer can consume events in two ways:
     (a) Consume events one by one, using a table metadata YAML to extract fields from each message and accordingly
     generating the appropriate SQL to ingest the data
-    (b) Consume events in batches of 5, where after every 5 events consumes, they're loaded to the database.
-    If there are less than 5 messages left in the queue, it is left to the inactivity timeout to kick
-    in and initiate the loading process
+    (b) Consume events in batches, where buffered events are loaded to the database with a single COPY once
+    batch_size events were consumed or the oldest buffered event waited for max_linger seconds, whichever
+    comes first. Events are acknowledged only after the COPY was committed.
+    Messages either hold a single JSON event or several packed events (see codec.pack_events). Messages come from
+    RabbitMQ unless another transport is given, consuming stops once stop is called (from any thread).
     :param host: Host name of the RabbitMQ broker (e.g. localhost/container name)
     :type host: str
     :param queue: RabbitMQ queue to publish messages onto
     :type queue: str
     :param table_md: Table metadata YAML used to create the table and extract relevant fields from the events
     :type table_md: TableMD
+    :param batch_size: Maximum number of events loaded at once in batch mode
+    :type batch_size: int
+    :param max_linger: Maximum number of seconds an event is buffered before its batch is loaded in batch mode
+    :type max_linger: float
+    :param copy_format: Format of the COPY in batch mode, "csv" or "binary"
+    :type copy_format: str
+    :param transport: Transport to consume with (e.g. transport.InMemoryTransport), a PikaTransport when not given
+    :type transport: Optional[Transport]
+    :param shards: Shard queues ("<queue>.<shard>", see Producer) consumed instead of queue, a member of a consumer
+    group owns some of the shards (see sharding.owned_shards)
+    :type shards: Optional[List[int]]
+    :param exchange: Exchange the shard queues are bound to
+    :type exchange: str
+    :param orgs_cache: Cache of the organizations, adding the organization_key column (the value column of the
+    cache) to every event before it is loaded. The column is added to the table if it is missing.
+    :type orgs_cache: Optional[DimensionCache]
+    :param deduper: Drops the events already loaded into the table (by their deduper key column) before loading,
+    messages holding only duplicates are acknowledged without touching the table
+    :type deduper: Optional[Deduper]
+    :param rollup: Aggregates the loaded events into rollup tables, merged in the transaction loading them
+    :type rollup: Optional[Rollup]
     """
     # I chose to use the default Exchange instead of creating a new one for simplicity
 
-    def __init__(self, host: str, queue: str, table_md: TableMD):
+    def __init__(
+        self,
+        host: str,
+        queue: str,
+        table_md: TableMD,
+        batch_size: int = 1000,
+        max_linger: float = 5.0,
+        copy_format: str = "csv",
+        transport: Optional[Transport] = None,
+        shards: Optional[List[int]] = None,
+        exchange: str = "events",
+        orgs_cache: Optional[DimensionCache] = None,
+        deduper: Optional[Deduper] = None,
+        rollup: Optional[Rollup] = None,
+    ):
         self.host = host
         self.queue = queue
+        self.shards = shards
+        self.orgs_cache = orgs_cache
+        if orgs_cache is not None:
+            table_md = table_md.with_columns([orgs_cache.column])
         self.table_md = table_md
+        self.batch_size = batch_size
+        self.max_linger = max_linger
+        self.copy_format = copy_format
+        self._batch: List[tuple] = []
+        self._batch_last_tag: Optional[int] = None
+        self._batch_deadline: Optional[float] = None
         self.fields = [col.get("name") for col in self.table_md.columns]
-        self.connection, self.channel = self.__get_conn()
-
-    def __get_conn(self):
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
-        channel = connection.channel()
-        channel.queue_declare(queue=self.queue)
-        return connection, channel
-
-    def __load_to_pgres_callback(self, ch, method, properties, body):
-        data = json.loads(body)
-        # encapsulating values inside single quotes for loading into the database
-        row = [data[field] for field in self.fields]
-        hook = PgHook()
-        sql_gen = SQLGenerator(self.table_md)
-        queries = [
-            sql_gen.create_table_query(),  # create table if not exists for loading
-            sql_gen.insert_values_into(values=row),
-        ]
-        hook.execute(queries)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        self.deduper = deduper
+        if deduper is not None:
+            self._dedupe_indexes = deduper.indexes(self.fields)
+        self.rollup = rollup
+        if rollup is not None and not set(rollup.columns) <= set(self.fields):
+            raise ValueError(f"the rollup needs the columns {rollup.columns}, the table has {self.fields}")
+        # a single pooled hook keeps the database connection open between messages
+        self.pg_hook = PgHook(pool="process", maxconn=1)
+        self.sql_gen = SQLGenerator(self.table_md)
+        self.insert_query = self.sql_gen.insert_query()
+        # compiled once: missing keys are loaded as NULL and timestamps are parsed before reaching the database
+        self.row_codec = self.table_md.row_codec
+        # lower bounds of the partitions known to exist, when the table is partitioned
+        self._partitions = set()
+        self._stopped = threading.Event()
+        self.transport = transport or PikaTransport(host=host)
+        if shards is None:
+            self.queues = [queue]
+            self.transport.declare_queue(queue)
+        else:
+            # declared and bound here as well, the consumer may start before the producer
+            self.queues = [shard_queue(queue, shard) for shard in shards]
+            self.transport.declare_exchange(exchange)
+            for shard, shard_queue_name in zip(shards, self.queues):
+                self.transport.declare_queue(shard_queue_name)
+                self.transport.bind_queue(shard_queue_name, exchange, str(shard))
+
+    def __ensure_partitions(self, rows: List[tuple]) -> None:
+        """Creates the partitions the rows fall in before loading them, when the table is partitioned"""
+        if not self.table_md.partitioning:
+            return
+        key_index = self.fields.index(self.table_md.partitioning["key"])
+        queries = []
+        for row in rows:
+            if row[key_index] is None:
+                continue
+            lower_bound = self.sql_gen.partition_lower_bound(row[key_index])
+            if lower_bound not in self._partitions:
+                queries.append(self.sql_gen.create_partition_query(lower_bound))
+                self._partitions.add(lower_bound)
+        if queries:
+            self.pg_hook.execute(queries)
+
+    def __create_table(self) -> None:
+        queries = [self.sql_gen.create_table_query()]
+        if self.orgs_cache is not None:
+            queries.append(self.sql_gen.add_columns_query([self.orgs_cache.column]))
+        self.pg_hook.execute(queries)
+
+    def __extract_rows(self, body, properties) -> List[tuple]:
+        with CONSUMER_PARSE_SECONDS.time():
+            events = unpack_events(body, properties)
+            if self.orgs_cache is not None:
+                self.orgs_cache.refresh_if_stale()
+                events = [self.orgs_cache.enrich(event) for event in events]
+            rows = self.row_codec.extract_all(events)
+        CONSUMER_MESSAGES.inc()
+        CONSUMER_EVENTS.inc(len(rows))
+        return rows
+
+    def __dedupe(self, rows: List[tuple]) -> List[tuple]:
+        if self.deduper is None:
+            return rows
+        return self.deduper.filter_rows(rows, self._dedupe_indexes)
+
+    def __merge_rollup(self, cur, rows: List[tuple]) -> None:
+        # only once the rows were written, in their transaction: a failed load is redelivered and counted then
+        if self.rollup is not None:
+            self.rollup.merge_rows(cur, rows, self.fields)
+
+    def __load_to_pgres_callback(self, transport, method, properties, body):
+        rows = self.__dedupe(self.__extract_rows(body, properties))
+        if rows:
+            with CONSUMER_DB_SECONDS.time():
+                self.__ensure_partitions(rows)
+                # values are passed as query parameters, psycopg2 takes care of quoting them
+                with self.pg_hook.session() as cur:
+                    cur.executemany(self.insert_query, rows)
+                    self.__merge_rollup(cur, rows)
+        if self.deduper is not None:
+            self.deduper.commit()
+        transport.ack(delivery_tag=method.delivery_tag)
+        CONSUMER_ACKS.inc()
+
+    def __buffer_callback(self, transport, method, properties, body):
+        self._batch += self.__extract_rows(body, properties)
+        self._batch_last_tag = method.delivery_tag
+        if self._batch_deadline is None:
+            self._batch_deadline = monotonic() + self.max_linger
+
+    def __flush_batch(self) -> None:
+        print(f"processing batch of {len(self._batch)} events")
+        rows = self.__dedupe(self._batch)
+        if rows:
+            with CONSUMER_DB_SECONDS.time():
+                self.__ensure_partitions(rows)
+                if self.copy_format == "binary":
+                    stream = BinaryCopyStream(
+                        rows=rows,
+                        column_types=[col.get("type") for col in self.table_md.columns],
+                    )
+                else:
+                    stream = CopyStream(
+                        rows=rows, header=self.fields, delimiter=self.table_md.delimiter
+                    )
+                self.pg_hook.copy_stream(
+                    query=self.sql_gen.copy_query(self.copy_format),
+                    stream=stream,
+                    after_load=None if self.rollup is None else partial(self.__merge_rollup, rows=rows),
+                )
+        if self.deduper is not None:
+            self.deduper.commit()
+        # the COPY is committed at this point, every message of the batch is acknowledged at once
+        self.transport.ack(delivery_tag=self._batch_last_tag, multiple=True)
+        CONSUMER_ACKS.inc()
+        CONSUMER_BATCHES.inc()
+        CONSUMER_BATCH_ROWS.observe(len(rows))
+        self._batch, self._batch_last_tag, self._batch_deadline = [], None, None
 
     def batch_load_to_pgres(self):
         """
-        Inactivity timeout is added in cases where there are less than 5 messages left in the queue. If no further messages
-        arrive in 15 seconds, the inactivity timeout kicks in and triggers the processing of the batch currently
-        stored in memory.
+        Buffers consumed events and loads them with a single COPY command once batch_size events were buffered or
+        the oldest buffered event has waited max_linger seconds. The prefetch count equals the batch size, so
+        the broker never pushes more unacknowledged events than a batch can hold. If loading fails, the exception
+        is raised and the unacknowledged events are redelivered once the connection is closed. Once stopped, the
+        buffered events are loaded before returning.
         """
-        sql_gen = SQLGenerator(self.table_md)
-        hook = PgHook()
-        hook.execute(sql_gen.create_table_query())
-
-        while True:
-            try:
-                connection, channel = self.__get_conn()
-                batch = []
-                # Get five messages and break out.
-                for method_frame, properties, body in channel.consume(
-                    queue=self.queue, inactivity_timeout=15
+        self.__create_table()
+        self.transport.set_prefetch(self.batch_size)
+        for queue in self.queues:
+            self.transport.consume(queue, self.__buffer_callback)
+        try:
+            while not self._stopped.is_set():
+                if self._batch_deadline is None:
+                    time_limit = self.max_linger
+                else:
+                    time_limit = max(self._batch_deadline - monotonic(), 0)
+                self.transport.process_data_events(time_limit=time_limit)
+                if self._batch and (
+                    len(self._batch) >= self.batch_size
+                    or monotonic() >= self._batch_deadline
                 ):
+                    self.__flush_batch()
+            if self._batch:
+                self.__flush_batch()
 
-                    # if no more messages exist in the queue, break out of the loop
-                    if not method_frame:
-                        break
-                    data = json.loads(body)
-                    row = [data[field] for field in self.fields]
-                    batch.append(sql_gen.insert_values_into(values=row))
-                    channel.basic_ack(method_frame.delivery_tag)
-
-                    if method_frame.delivery_tag == 5:
-                        break
-                # Requeing the rest of the messages after having pulled a batch
-                channel.cancel()
-                print("processing batch")
-                hook.execute(batch)
-
-            # Close the channel and the connection safely when interrupting so we don't get hanging connections
-            except KeyboardInterrupt:  # safely
-                channel.close()
-                connection.close()
-                raise
+        # Close the transport safely when interrupting so we don't get hanging connections
+        except KeyboardInterrupt:  # safely
+            self.transport.close()
+            raise
 
     def consume_events(self):
-        self.channel.basic_consume(
-            queue=self.queue,
-            auto_ack=False,
-            on_message_callback=self.__load_to_pgres_callback,
-        )
-        self.channel.start_consuming()
+        # create table if not exists for loading, once instead of on every message
+        self.__create_table()
+        for queue in self.queues:
+            self.transport.consume(queue, self.__load_to_pgres_callback)
+        self.transport.start_consuming()
+
+    def stop(self):
+        """Makes consume_events/batch_load_to_pgres return, can be called from any thread"""
+        self._stopped.set()
+        self.transport.stop_consuming()
 
     def close(self):
-        self.connection.close()
+        self.transport.close()
+        if self.orgs_cache is not None:
+            self.orgs_cache.close()
+        if self.deduper is not None:
+            self.deduper.close()
@@ -0,0 +1,137 @@
+import logging
+import metrics
+import psycopg2.extensions
+from select import select
+from time import monotonic
+from typing import Dict, Optional
+from psql_client import PgHook
+from sql_gen import TABLE_LOADED_CHANNEL
+
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+DIMENSION_REFRESHES = metrics.counter("dimension_refreshes_total", "Reloads of the dimension caches")
+DIMENSION_MISSES = metrics.counter(
+    "dimension_misses_total", "Events whose key was not found in a dimension cache"
+)
+
+
+class DimensionCache:
+    """
+    In-memory copy of a dimension table, mapping its key column onto its value column, to enrich events before they
+    are loaded (e.g. the organization_key of the organization_name of an event, out of staging.raw_orgs). Lookups
+    are a dict access. The table is read again once ttl seconds went by, or as soon as import_sources notifies that
+    it loaded the table again when listen is set (LISTEN on sql_gen.TABLE_LOADED_CHANNEL). The cache is refreshed
+    from the thread using it, in refresh_if_stale.
+    :param schema: Schema of the dimension table
+    :type schema: str
+    :param table_name: Dimension table
+    :type table_name: str
+    :param key: Column the events are matched on
+    :type key: str
+    :param value: Column added to the events
+    :type value: str
+    :param ttl: Seconds before the table is read again, 0 only refreshes on notifications
+    :type ttl: float
+    :param listen: Refresh when the table was loaded again
+    :type listen: bool
+    :param pg_hook: Hook used for reading the table and listening
+    :type pg_hook: PgHook
+    """
+
+    # how often the listening connection is checked for notifications, at most
+    POLL_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        schema: str = "staging",
+        table_name: str = "raw_orgs",
+        key: str = "organization_name",
+        value: str = "organization_key",
+        ttl: float = 300.0,
+        listen: bool = False,
+        pg_hook: Optional[PgHook] = None,
+    ):
+        if not ttl and not listen:
+            raise ValueError("a dimension cache needs a ttl or to listen for changes")
+        self.schema = schema
+        self.table_name = table_name
+        self.key = key
+        self.value = value
+        self.ttl = ttl
+        self.listen = listen
+        self.pg_hook = pg_hook or PgHook()
+        self.values: Dict[str, str] = {}
+        self._expires_at = 0.0
+        self._next_poll = 0.0
+        self._listener: Optional[psycopg2.extensions.connection] = None
+
+    @property
+    def column(self) -> dict:
+        """Table metadata column of the value added to the events"""
+        return {"name": self.value, "type": "varchar", "length": 300}
+
+    def __listen(self) -> None:
+        self._listener = self.pg_hook.get_conn()
+        self._listener.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with self._listener.cursor() as cur:
+            cur.execute(f"LISTEN {TABLE_LOADED_CHANNEL}")
+
+    def __notified(self) -> bool:
+        """Whether the table was loaded again since the last check, reconnecting if the connection was lost"""
+        now = monotonic()
+        if now < self._next_poll:
+            return False
+        self._next_poll = now + self.POLL_INTERVAL
+        try:
+            if self._listener is None or self._listener.closed:
+                # changes may have been missed while not listening
+                self.__listen()
+                return True
+            if select([self._listener], [], [], 0)[0]:
+                self._listener.poll()
+        except psycopg2.OperationalError:
+            logger.warning(f"lost the notifications of {self.schema}.{self.table_name}, refreshing by ttl")
+            self._listener = None
+            return False
+        notified = any(
+            notify.payload == f"{self.schema}.{self.table_name}" for notify in self._listener.notifies
+        )
+        self._listener.notifies.clear()
+        return notified
+
+    def refresh(self) -> None:
+        """Reads the dimension table again, an empty cache when the table does not exist yet"""
+        with self.pg_hook.session() as cur:
+            cur.execute("SELECT to_regclass(%s)", (f"{self.schema}.{self.table_name}",))
+            if cur.fetchone()[0] is None:
+                values = {}
+            else:
+                cur.execute(
+                    f"SELECT {self.key}, {self.value} FROM {self.schema}.{self.table_name} "
+                    f"WHERE {self.key} IS NOT NULL"
+                )
+                values = dict(cur.fetchall())
+        self.values = values
+        self._expires_at = monotonic() + self.ttl if self.ttl else float("inf")
+        DIMENSION_REFRESHES.inc()
+        logger.info(f"cached {len(values)} rows of {self.schema}.{self.table_name}")
+
+    def refresh_if_stale(self) -> None:
+        """Refreshes the cache if its ttl expired or the table was loaded again, call it before looking values up"""
+        notified = self.listen and self.__notified()
+        if notified or monotonic() >= self._expires_at:
+            self.refresh()
+
+    def enrich(self, event: dict) -> dict:
+        """Sets the value of the key of an event (None when the key is unknown) on the event itself"""
+        value = self.values.get(event.get(self.key))
+        if value is None:
+            DIMENSION_MISSES.inc()
+        event[self.value] = value
+        return event
+
+    def close(self) -> None:
+        if self._listener is not None and not self._listener.closed:
+            self._listener.close()
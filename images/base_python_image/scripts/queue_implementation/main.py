@@ -1,37 +1,277 @@
+from __future__ import annotations
+
+import asyncio
+import metrics
+import multiprocessing
+import os
+import threading
+import traceback
 from queue import Queue
 from pathlib import Path
 from os.path import join, expandvars, dirname
-from sql_gen import TableMD
+from os import environ
+from typing import Optional, TYPE_CHECKING
 from sys import argv
-from queue_implementation.watcher import Watcher
-from queue_implementation.consumer import Consumer
+from queue_implementation.codec import set_json_decoder
+
+# every mode imports the modules it runs, the producer does not wait for the database clients nor the consumers for
+# watchdog (see benchmarks/imports.py)
+if TYPE_CHECKING:
+    from dedupe import Deduper
+    from rollup import Rollup
+    from queue_implementation.consumer import Consumer
+    from queue_implementation.dimension import DimensionCache
 
 
 ROOT_DIR = Path(__file__).parent.absolute()
 TABLE_METADATA_PATH = join(ROOT_DIR, "table_metadata", "raw_events.yaml")
 RAW_DATA_DIR = join(dirname(dirname(ROOT_DIR)), "raw_data", "events")
+# producer options, packing events into messages and publishing with confirms are opt-in
+WATCHER_PACK_SIZE = int(environ.get("WATCHER_PACK_SIZE", "0")) or None
+WATCHER_PACK_FORMAT = environ.get("WATCHER_PACK_FORMAT", "ndjson")
+WATCHER_COMPRESS = environ.get("WATCHER_COMPRESS", "false").lower() == "true"
+WATCHER_CONFIRMS = environ.get("WATCHER_CONFIRMS", "false").lower() == "true"
+WATCHER_WORKERS = int(environ.get("WATCHER_WORKERS", "4"))
+# batch mode loads buffered events once either limit is reached
+CONSUMER_BATCH_SIZE = int(environ.get("CONSUMER_BATCH_SIZE", "1000"))
+CONSUMER_MAX_LINGER = float(environ.get("CONSUMER_MAX_LINGER", "5"))
+# "csv" or "binary" COPY of the batches
+CONSUMER_COPY_FORMAT = environ.get("CONSUMER_COPY_FORMAT", "csv")
+# async mode keeps up to CONSUMER_PREFETCH unacknowledged events in flight, written by CONSUMER_CONCURRENCY connections
+CONSUMER_PREFETCH = int(environ.get("CONSUMER_PREFETCH", "100"))
+CONSUMER_CONCURRENCY = int(environ.get("CONSUMER_CONCURRENCY", "10"))
+# "json" or "orjson" (faster, to be installed separately) for decoding consumed messages
+CONSUMER_JSON_DECODER = environ.get("CONSUMER_JSON_DECODER", "json")
+# events are routed to QUEUE_SHARDS queues by a consistent hash of their SHARD_KEY field, 0 keeps a single queue
+QUEUE_SHARDS = int(environ.get("QUEUE_SHARDS", "0"))
+QUEUE_EXCHANGE = environ.get("QUEUE_EXCHANGE", "events")
+SHARD_KEY = environ.get("SHARD_KEY", "organization_name")
+# the shards are split between the CONSUMER_GROUP_SIZE members of the consumer group, the consumer-group mode runs
+# the members listed in CONSUMER_GROUP_MEMBERS (comma separated indexes, every member by default) as processes
+CONSUMER_GROUP_SIZE = int(environ.get("CONSUMER_GROUP_SIZE", "1"))
+CONSUMER_GROUP_MEMBERS = [
+    int(member)
+    for member in environ.get(
+        "CONSUMER_GROUP_MEMBERS", ",".join(map(str, range(CONSUMER_GROUP_SIZE)))
+    ).split(",")
+    if member
+]
+# the consumers add the organization_key of staging.raw_orgs to the events, the organizations being read again every
+# ORGS_CACHE_TTL seconds (0 never expires them) and as soon as they were loaded again with ORGS_CACHE_LISTEN
+CONSUMER_ORGS_CACHE = environ.get("CONSUMER_ORGS_CACHE", "false").lower() == "true"
+ORGS_CACHE_TTL = float(environ.get("ORGS_CACHE_TTL", "300"))
+ORGS_CACHE_LISTEN = environ.get("ORGS_CACHE_LISTEN", "true").lower() == "true"
+# the consumers drop the events whose DEDUPE_KEY (comma separated columns identifying an event) was already loaded
+# (see dedupe.py), their filters being saved to DEDUPE_SNAPSHOT_DIR every DEDUPE_SNAPSHOT_INTERVAL seconds
+CONSUMER_DEDUPE = environ.get("CONSUMER_DEDUPE", "false").lower() == "true"
+DEDUPE_KEY = environ.get("DEDUPE_KEY", "id,event_type,received_at").split(",")
+DEDUPE_CAPACITY = int(environ.get("DEDUPE_CAPACITY", "1000000"))
+DEDUPE_ERROR_RATE = float(environ.get("DEDUPE_ERROR_RATE", "0.001"))
+DEDUPE_SNAPSHOT_DIR = environ.get("DEDUPE_SNAPSHOT_DIR", "/tmp/dedupe")
+DEDUPE_SNAPSHOT_INTERVAL = float(environ.get("DEDUPE_SNAPSHOT_INTERVAL", "60"))
+# the consumers aggregate the events into modelled.events_rollup(_users) at every commit (see rollup.py), requires
+# CONSUMER_DEDUPE=true
+CONSUMER_ROLLUP = environ.get("CONSUMER_ROLLUP", "false").lower() == "true"
+# counters and latency histograms of the producer/consumer, see main.py
+METRICS = environ.get("METRICS", "false").lower() == "true"
+METRICS_PORT = int(environ.get("METRICS_PORT", "0"))
+METRICS_LOG_INTERVAL = float(environ.get("METRICS_LOG_INTERVAL", "60"))
+
+
+def orgs_cache() -> Optional[DimensionCache]:
+    """Cache of the organizations enriching the events of a consumer, None when enrichment is off"""
+    if not CONSUMER_ORGS_CACHE:
+        return None
+    from queue_implementation.dimension import DimensionCache
+
+    return DimensionCache(ttl=ORGS_CACHE_TTL, listen=ORGS_CACHE_LISTEN)
+
+
+def deduper(name: str) -> Optional[Deduper]:
+    """
+    Deduper of a consumer, None when deduplication is off. Every consumer keeps its filter in its own snapshot
+    (named after name), the members of a consumer group only seeing the keys of their shards.
+    """
+    if not CONSUMER_DEDUPE:
+        return None
+    from dedupe import Deduper
+    from sql_gen import SQLGenerator, TableMD
+
+    table_md = TableMD(table_md_path=TABLE_METADATA_PATH)
+    return Deduper(
+        schema=table_md.schema_name,
+        table_name=SQLGenerator(table_md).partitioned_table(),
+        key=DEDUPE_KEY,
+        capacity=DEDUPE_CAPACITY,
+        error_rate=DEDUPE_ERROR_RATE,
+        snapshot_path=join(DEDUPE_SNAPSHOT_DIR, f"{name}.bloom"),
+        snapshot_interval=DEDUPE_SNAPSHOT_INTERVAL,
+    )
+
+
+def rollup() -> Optional[Rollup]:
+    """Rollup of a consumer, None when rollups are off"""
+    if not CONSUMER_ROLLUP:
+        return None
+    if not CONSUMER_DEDUPE:
+        raise ValueError("CONSUMER_ROLLUP=true requires CONSUMER_DEDUPE=true, redelivered events are counted again")
+    from rollup import Rollup
+
+    return Rollup()
+
+
+def consume_or_exit(consumer: Consumer) -> None:
+    """Runs a batch consumer, exiting the process if it fails so that events do not pile up in memory"""
+    try:
+        consumer.batch_load_to_pgres()
+    except BaseException:
+        traceback.print_exc()
+        os._exit(1)
+
+
+def consume_shards(member: int) -> None:
+    """Runs the batch consumer of a member of the consumer group, on the shards it owns"""
+    from queue_implementation.consumer import Consumer
+    from queue_implementation.sharding import owned_shards
+    from sql_gen import TableMD
+
+    shards = owned_shards(member, CONSUMER_GROUP_SIZE, QUEUE_SHARDS)
+    print(f"consumer group member {member} consumes shards {shards}")
+    consumer = Consumer(
+        host=expandvars("$RABBITMQ_HOST"),
+        queue="events",
+        table_md=TableMD(table_md_path=TABLE_METADATA_PATH),
+        batch_size=CONSUMER_BATCH_SIZE,
+        max_linger=CONSUMER_MAX_LINGER,
+        copy_format=CONSUMER_COPY_FORMAT,
+        shards=shards,
+        exchange=QUEUE_EXCHANGE,
+        orgs_cache=orgs_cache(),
+        # the snapshot follows the shards, a member owning other shards starts from the table
+        deduper=deduper(f"shards-{'-'.join(map(str, shards))}"),
+        rollup=rollup(),
+    )
+    consumer.batch_load_to_pgres()
 
 
 # this is decided by the docker-compose files that are used (check documentation)
 if __name__ == "__main__":
+    set_json_decoder(CONSUMER_JSON_DECODER)
+    metrics.configure(
+        enable=METRICS, port=METRICS_PORT, stats_interval=METRICS_LOG_INTERVAL
+    )
     if argv[1] == "producer":
+        from queue_implementation.watcher import Watcher
+
         watchdog_queue = Queue()
         watcher = Watcher(
-            path=RAW_DATA_DIR, watchdog_queue=watchdog_queue, rabbitmq_queue="events"
+            path=RAW_DATA_DIR,
+            watchdog_queue=watchdog_queue,
+            rabbitmq_queue="events",
+            pack_size=WATCHER_PACK_SIZE,
+            pack_format=WATCHER_PACK_FORMAT,
+            compress=WATCHER_COMPRESS,
+            confirms=WATCHER_CONFIRMS,
+            workers=WATCHER_WORKERS,
+            shards=QUEUE_SHARDS,
+            shard_key=SHARD_KEY,
+            exchange=QUEUE_EXCHANGE,
         )
         watcher.start()
     elif argv[1] == "consumer":
+        from queue_implementation.consumer import Consumer
+        from sql_gen import TableMD
+
         consumer = Consumer(
             host=expandvars("$RABBITMQ_HOST"),
             queue="events",
             table_md=TableMD(table_md_path=TABLE_METADATA_PATH),
+            orgs_cache=orgs_cache(),
+            deduper=deduper("consumer"),
+            rollup=rollup(),
         )
         consumer.consume_events()
 
     elif argv[1] == "consumer-batch":
+        from queue_implementation.consumer import Consumer
+        from sql_gen import TableMD
+
         consumer = Consumer(
             host=expandvars("$RABBITMQ_HOST"),
             queue="events",
             table_md=TableMD(table_md_path=TABLE_METADATA_PATH),
+            batch_size=CONSUMER_BATCH_SIZE,
+            max_linger=CONSUMER_MAX_LINGER,
+            copy_format=CONSUMER_COPY_FORMAT,
+            orgs_cache=orgs_cache(),
+            deduper=deduper("consumer"),
+            rollup=rollup(),
         )
         consumer.batch_load_to_pgres()
+
+    elif argv[1] == "consumer-async":
+        from queue_implementation.async_consumer import AsyncConsumer
+        from sql_gen import TableMD
+
+        # the concurrent writes of the asyncio consumer do not share a deduper (nor the rollups relying on it)
+        if CONSUMER_DEDUPE or CONSUMER_ROLLUP:
+            raise ValueError("the consumer-async mode does not support CONSUMER_DEDUPE nor CONSUMER_ROLLUP")
+        consumer = AsyncConsumer(
+            host=expandvars("$RABBITMQ_HOST"),
+            queue="events",
+            table_md=TableMD(table_md_path=TABLE_METADATA_PATH),
+            prefetch_count=CONSUMER_PREFETCH,
+            concurrency=CONSUMER_CONCURRENCY,
+            orgs_cache=orgs_cache(),
+        )
+        asyncio.run(consumer.consume_events())
+
+    elif argv[1] == "consumer-group":
+        # a member per process, every shard being consumed by a single member the events of a key stay in order.
+        # If a member fails the whole group stops, its shards would not be consumed otherwise
+        if not QUEUE_SHARDS:
+            raise ValueError("the consumer-group mode needs QUEUE_SHARDS to be set")
+        members = [
+            multiprocessing.Process(target=consume_shards, args=(member,), name=f"consumer-{member}")
+            for member in CONSUMER_GROUP_MEMBERS
+        ]
+        for member in members:
+            member.start()
+        while all(member.is_alive() for member in members):
+            members[0].join(timeout=1)
+        for member in members:
+            member.terminate()
+        os._exit(1)
+
+    elif argv[1] == "standalone":
+        # single node deployment without RabbitMQ: the Watcher publishes onto the in-process broker and a batch
+        # consumer thread loads the events, pending events are lost if the process stops
+        from queue_implementation.consumer import Consumer
+        from queue_implementation.transport import get_transport
+        from queue_implementation.watcher import Watcher
+        from sql_gen import TableMD
+
+        consumer = Consumer(
+            host="",
+            queue="events",
+            table_md=TableMD(table_md_path=TABLE_METADATA_PATH),
+            batch_size=CONSUMER_BATCH_SIZE,
+            max_linger=CONSUMER_MAX_LINGER,
+            copy_format=CONSUMER_COPY_FORMAT,
+            transport=get_transport("memory"),
+            orgs_cache=orgs_cache(),
+            deduper=deduper("consumer"),
+            rollup=rollup(),
+        )
+        threading.Thread(target=consume_or_exit, args=(consumer,), daemon=True).start()
+        watcher = Watcher(
+            path=RAW_DATA_DIR,
+            watchdog_queue=Queue(),
+            rabbitmq_queue="events",
+            pack_size=WATCHER_PACK_SIZE,
+            pack_format=WATCHER_PACK_FORMAT,
+            compress=WATCHER_COMPRESS,
+            workers=WATCHER_WORKERS,
+            transport=get_transport("memory"),
+        )
+        watcher.start()
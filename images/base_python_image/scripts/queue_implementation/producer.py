@@ -1,28 +1,222 @@
+import asyncio
+import threading
+import metrics
 import pika
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Union
+from queue_implementation.aio import open_connection, open_channel
+from queue_implementation.codec import pack_events
+from queue_implementation.sharding import shard_of, shard_queue
+from queue_implementation.transport import PikaTransport, Transport
+
+PRODUCER_MESSAGES = metrics.counter("producer_messages_total", "Messages published")
+PRODUCER_BYTES = metrics.counter("producer_bytes_total", "Bytes of the published message bodies")
+PRODUCER_PUBLISH_SECONDS = metrics.histogram(
+    "producer_publish_seconds", "Time spent publishing a message (Producer.publish_event)"
+)
+
+
+class NackedPublishError(Exception):
+    """Raised when the broker refused (nacked) published messages"""
 
 
 class Producer:
     """
-    Basic RabbitMQ producer to publish messages to a designated queue
+    Basic producer to publish messages to a designated queue, over RabbitMQ unless another transport is given.
+    The producer can be shared between threads, publishing is serialized and the RabbitMQ connection is reopened
+    if it was dropped.
+    With shards set, events are spread over that many queues ("<queue>.<shard>") bound to a direct exchange, the
+    shard of an event being a consistent hash of its shard_key field (see sharding.shard_of). Every event of a key
+    lands on the same queue, so consumers owning distinct shards still load the events of a key in order.
     :param host: Host name of the RabbitMQ broker (e.g. localhost/container name)
     :type host: str
-    :param queue: RabbitMQ queue to publish messages onto
+    :param queue: RabbitMQ queue to publish messages onto, the prefix of the shard queues when sharded
     :type queue: str
+    :param transport: Transport to publish with (e.g. transport.InMemoryTransport), a PikaTransport when not given
+    :type transport: Optional[Transport]
+    :param shards: Number of shard queues, 0 publishes everything onto queue through the default exchange
+    :type shards: int
+    :param shard_key: Field of the events hashed into their shard
+    :type shard_key: str
+    :param exchange: Exchange the shard queues are bound to
+    :type exchange: str
     """
-    # I chose to use the default Exchange instead of creating a new one for simplicity
-    def __init__(self, host: str, queue: str):
+    # I chose to use the default Exchange instead of creating a new one for simplicity, unless sharding
+    def __init__(
+        self,
+        host: str,
+        queue: str,
+        transport: Optional[Transport] = None,
+        shards: int = 0,
+        shard_key: str = "organization_name",
+        exchange: str = "events",
+    ):
         self.host = host
         self.queue = queue
-        self.connection, self.channel = self.__get_conn()
+        self.shards = shards
+        self.shard_key = shard_key
+        self.exchange = exchange
+        # pika connections are not thread safe, every use of the transport goes through this lock
+        self._lock = threading.Lock()
+        self.transport = transport or PikaTransport(host=host)
+        if not shards:
+            self.transport.declare_queue(queue)
+            return
+        self.transport.declare_exchange(exchange)
+        for shard in range(shards):
+            self.transport.declare_queue(shard_queue(queue, shard))
+            self.transport.bind_queue(shard_queue(queue, shard), exchange, str(shard))
+
+    def shard_of(self, event: dict) -> Optional[int]:
+        """Shard an event is published onto, None when the producer is not sharded"""
+        if not self.shards:
+            return None
+        return shard_of(event.get(self.shard_key), self.shards)
 
-    def __get_conn(self):
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
-        channel = connection.channel()
-        channel.queue_declare(queue=self.queue)
-        return connection, channel
+    def publish_event(
+        self,
+        msg: Union[str, bytes],
+        properties: Optional[pika.BasicProperties] = None,
+        shard: Optional[int] = None,
+    ):
+        """Publishes a message, onto the given shard when sharded (see shard_of)"""
+        if self.shards and shard is None:
+            raise ValueError("a sharded producer needs the shard of every message")
+        with self._lock, PRODUCER_PUBLISH_SECONDS.time():
+            if self.shards:
+                self.transport.publish(str(shard), msg, properties, exchange=self.exchange)
+            else:
+                self.transport.publish(self.queue, msg, properties)
+        PRODUCER_MESSAGES.inc()
+        PRODUCER_BYTES.inc(len(msg))
 
-    def publish_event(self, msg: str):
-        self.channel.basic_publish(exchange="", routing_key=self.queue, body=msg)
+    def publish_events(
+        self, events: List[dict], pack_format: str = "ndjson", compress: bool = False
+    ):
+        """
+        Publishes several events packed into a single message (see codec.pack_events), one message per shard when
+        sharded, keeping the order of the events of every shard
+        """
+        by_shard: Dict[Optional[int], List[dict]] = OrderedDict()
+        for event in events:
+            by_shard.setdefault(self.shard_of(event), []).append(event)
+        for shard, shard_events in by_shard.items():
+            body, properties = pack_events(shard_events, pack_format=pack_format, compress=compress)
+            self.publish_event(msg=body, properties=properties, shard=shard)
 
     def close(self):
-        self.connection.close()
+        with self._lock:
+            self.transport.close()
+
+
+class AsyncProducer:
+    """
+    RabbitMQ producer using publisher confirms without waiting for every message to be confirmed. Up to
+    max_outstanding messages can be published and not yet confirmed by the broker, publish_event waits for
+    a free slot beyond that. wait_for_confirms returns once everything published was confirmed.
+    If the connection drops, messages waiting for a confirm are counted as nacked and the next publish reconnects.
+    :param host: Host name of the RabbitMQ broker (e.g. localhost/container name)
+    :type host: str
+    :param queue: RabbitMQ queue to publish messages onto
+    :type queue: str
+    :param max_outstanding: Maximum number of published messages waiting for a confirm
+    :type max_outstanding: int
+    """
+
+    def __init__(self, host: str, queue: str, max_outstanding: int = 1000):
+        self.host = host
+        self.queue = queue
+        self.max_outstanding = max_outstanding
+        self.connection = None
+        self.channel = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._confirmed: Optional[asyncio.Event] = None
+        self._connecting: Optional[asyncio.Lock] = None
+        self._outstanding: Set[int] = set()
+        self._delivery_tag = 0
+        self._nacked = 0
+        self._reconnect = False
+
+    async def connect(self) -> None:
+        if self._slots is None:
+            # created on the loop running the producer
+            self._slots = asyncio.Semaphore(self.max_outstanding)
+            self._confirmed = asyncio.Event()
+            self._confirmed.set()
+            self._connecting = asyncio.Lock()
+        self.connection = await open_connection(
+            host=self.host, on_close_callback=self.__on_connection_closed
+        )
+        self._delivery_tag = 0
+        self.channel = await open_channel(self.connection, queue=self.queue)
+        enabled = asyncio.get_event_loop().create_future()
+        self.channel.confirm_delivery(
+            ack_nack_callback=self.__on_confirm, callback=enabled.set_result
+        )
+        await enabled
+        self._reconnect = False
+
+    def __on_connection_closed(self, connection, reason) -> None:
+        """The messages waiting for a confirm will never get one, they are counted as nacked"""
+        self._nacked += len(self._outstanding)
+        for _ in self._outstanding:
+            self._slots.release()
+        self._outstanding.clear()
+        self._confirmed.set()
+        self._reconnect = True
+
+    def __on_confirm(self, frame) -> None:
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self._outstanding if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        if isinstance(method, pika.spec.Basic.Nack):
+            self._nacked += len(tags)
+        for tag in tags:
+            self._outstanding.discard(tag)
+            self._slots.release()
+        if not self._outstanding:
+            self._confirmed.set()
+
+    async def publish_event(
+        self, msg: Union[str, bytes], properties: Optional[pika.BasicProperties] = None
+    ) -> None:
+        await self._slots.acquire()
+        if self._reconnect:
+            # publishers waiting for the connection reconnect once
+            async with self._connecting:
+                if self._reconnect:
+                    try:
+                        await self.connect()
+                    except BaseException:
+                        self._slots.release()
+                        raise
+        # delivery tags of a confirming channel are sequential, starting at 1
+        self._delivery_tag += 1
+        self._outstanding.add(self._delivery_tag)
+        self._confirmed.clear()
+        self.channel.basic_publish(
+            exchange="", routing_key=self.queue, body=msg, properties=properties
+        )
+        PRODUCER_MESSAGES.inc()
+        PRODUCER_BYTES.inc(len(msg))
+
+    async def publish_events(
+        self, events: List[dict], pack_format: str = "ndjson", compress: bool = False
+    ) -> None:
+        """Publishes several events packed into a single message (see codec.pack_events)"""
+        body, properties = pack_events(events, pack_format=pack_format, compress=compress)
+        await self.publish_event(msg=body, properties=properties)
+
+    async def wait_for_confirms(self) -> None:
+        """Waits for every published message to be confirmed, raises if the broker nacked any of them"""
+        await self._confirmed.wait()
+        nacked, self._nacked = self._nacked, 0
+        if nacked:
+            raise NackedPublishError(f"{nacked} messages were nacked by the broker")
+
+    async def close(self) -> None:
+        await self.wait_for_confirms()
+        if not self.connection.is_closed:
+            self.connection.close()
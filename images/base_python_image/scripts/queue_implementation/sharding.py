@@ -0,0 +1,62 @@
+import hashlib
+from typing import List
+
+
+# multiplier of the linear congruential generator of the jump consistent hash
+JUMP_MULTIPLIER = 2862933555777941757
+UINT64_MASK = (1 << 64) - 1
+
+
+def jump_hash(key: int, n_buckets: int) -> int:
+    """
+    Jump consistent hash (Lamping & Veach): maps a 64 bit key onto one of n_buckets buckets, so that going from
+    n to n + 1 buckets only moves 1 / (n + 1) of the keys, all of them to the new bucket.
+    :param key: Unsigned 64 bit key
+    :type key: int
+    :param n_buckets: Number of buckets
+    :type n_buckets: int
+    :return: Bucket of the key, in [0, n_buckets)
+    :rtype: int
+    """
+    if n_buckets < 1:
+        raise ValueError("the number of buckets must be positive")
+    b, j = -1, 0
+    while j < n_buckets:
+        b = j
+        key = (key * JUMP_MULTIPLIER + 1) & UINT64_MASK
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def shard_of(value, n_shards: int) -> int:
+    """
+    Shard of a routing key value (e.g. the organization name of an event). Values are hashed with a stable hash,
+    unlike the builtin hash of strings, so every producer process agrees on the shard. None goes to shard 0 along
+    with the empty string.
+    """
+    data = ("" if value is None else str(value)).encode("utf-8")
+    key = int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+    return jump_hash(key, n_shards)
+
+
+def shard_queue(queue: str, shard: int) -> str:
+    """Name of the queue of a shard, bound to the exchange with the shard number as routing key"""
+    return f"{queue}.{shard}"
+
+
+def owned_shards(member: int, group_size: int, n_shards: int) -> List[int]:
+    """
+    Shards consumed by a member of a consumer group. Every shard is owned by exactly one member, so the events of
+    a key are consumed in order by a single consumer.
+    :param member: Index of the member, in [0, group_size)
+    :type member: int
+    :param group_size: Number of members of the group
+    :type group_size: int
+    :param n_shards: Number of shards
+    :type n_shards: int
+    """
+    if not 0 <= member < group_size:
+        raise ValueError(f"member {member} is not part of a group of {group_size}")
+    if group_size > n_shards:
+        raise ValueError(f"a group of {group_size} members can not share {n_shards} shards")
+    return [shard for shard in range(n_shards) if shard % group_size == member]
@@ -0,0 +1,406 @@
+import threading
+import pika
+from abc import ABC, abstractmethod
+from collections import deque
+from time import monotonic
+from types import SimpleNamespace
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Union
+
+
+# kinds of transport, see get_transport
+TRANSPORTS = ["pika", "memory"]
+
+# called with (transport, method, properties, body) for every delivered message, method holding the delivery_tag,
+# routing_key and redelivered flag of the message like pika's Basic.Deliver
+OnMessage = Callable[["Transport", object, Optional[pika.BasicProperties], bytes], None]
+
+
+class Transport(ABC):
+    """
+    Connection of a Producer or Consumer to a message broker. Messages are published onto named queues and
+    delivered to the consumers of a queue, which acknowledge (ack) or reject (nack) them. At most prefetch_count
+    messages are delivered and not yet acknowledged at a time, and messages left unacknowledged when the transport
+    is closed are delivered again. Callbacks run in the thread driving the transport (start_consuming or
+    process_data_events), publishing and stop_consuming may be called from other threads.
+    """
+
+    @abstractmethod
+    def declare_queue(self, queue: str) -> None:
+        """Creates the queue if it does not exist yet"""
+
+    @abstractmethod
+    def declare_exchange(self, exchange: str) -> None:
+        """Creates a direct exchange if it does not exist yet"""
+
+    @abstractmethod
+    def bind_queue(self, queue: str, exchange: str, routing_key: str) -> None:
+        """Routes the messages published onto the exchange with the routing key to the queue"""
+
+    @abstractmethod
+    def publish(
+        self,
+        routing_key: str,
+        body: Union[str, bytes],
+        properties: Optional[pika.BasicProperties] = None,
+        exchange: str = "",
+    ) -> None:
+        """
+        Publishes a message onto an exchange, on the default exchange the routing key is the name of the queue.
+        Messages no queue is bound for are dropped.
+        """
+
+    @abstractmethod
+    def set_prefetch(self, prefetch_count: int) -> None:
+        """Limits the number of delivered and unacknowledged messages, 0 does not limit them"""
+
+    @abstractmethod
+    def consume(self, queue: str, on_message: OnMessage) -> None:
+        """Registers a callback for the messages of a queue, messages are delivered once the transport is driven"""
+
+    @abstractmethod
+    def ack(self, delivery_tag: int, multiple: bool = False) -> None:
+        """Acknowledges a delivered message, or every message up to it with multiple"""
+
+    @abstractmethod
+    def nack(self, delivery_tag: int, multiple: bool = False, requeue: bool = True) -> None:
+        """Rejects a delivered message (or every message up to it), requeued for redelivery or dropped"""
+
+    @abstractmethod
+    def process_data_events(self, time_limit: float = 0) -> None:
+        """Delivers the messages that can be delivered, waiting up to time_limit seconds for some"""
+
+    @abstractmethod
+    def start_consuming(self) -> None:
+        """Delivers messages until stop_consuming is called"""
+
+    @abstractmethod
+    def stop_consuming(self) -> None:
+        """Makes start_consuming return, can be called from any thread"""
+
+    @abstractmethod
+    def close(self) -> None:
+        pass
+
+
+class PikaTransport(Transport):
+    """
+    Transport using a RabbitMQ broker through a pika blocking connection on the default exchange. The connection
+    is reopened if it was dropped when publishing.
+    :param host: Host name of the RabbitMQ broker (e.g. localhost/container name)
+    :type host: str
+    """
+
+    def __init__(self, host: str):
+        self.host = host
+        # declarations replayed on a new connection, as (channel method name, keyword arguments)
+        self._declarations: List[Tuple[str, Dict]] = []
+        self.connection, self.channel = self.__get_conn()
+
+    def __get_conn(self):
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
+        channel = connection.channel()
+        for method, kwargs in self._declarations:
+            getattr(channel, method)(**kwargs)
+        return connection, channel
+
+    def __declare(self, method: str, **kwargs) -> None:
+        getattr(self.channel, method)(**kwargs)
+        self._declarations.append((method, kwargs))
+
+    def declare_queue(self, queue: str) -> None:
+        self.__declare("queue_declare", queue=queue)
+
+    def declare_exchange(self, exchange: str) -> None:
+        self.__declare("exchange_declare", exchange=exchange, exchange_type="direct")
+
+    def bind_queue(self, queue: str, exchange: str, routing_key: str) -> None:
+        self.__declare("queue_bind", queue=queue, exchange=exchange, routing_key=routing_key)
+
+    def publish(self, routing_key, body, properties=None, exchange="") -> None:
+        try:
+            self.channel.basic_publish(
+                exchange=exchange, routing_key=routing_key, body=body, properties=properties
+            )
+        except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError):
+            # the broker dropped the (possibly long idle) connection, reconnect and publish again
+            if self.connection.is_open:
+                self.connection.close()
+            self.connection, self.channel = self.__get_conn()
+            self.channel.basic_publish(
+                exchange=exchange, routing_key=routing_key, body=body, properties=properties
+            )
+
+    def set_prefetch(self, prefetch_count: int) -> None:
+        # per channel rather than per consumer, a channel may consume several (shard) queues
+        self.channel.basic_qos(prefetch_count=prefetch_count, global_qos=True)
+
+    def consume(self, queue: str, on_message: OnMessage) -> None:
+        self.channel.basic_consume(
+            queue=queue,
+            auto_ack=False,
+            on_message_callback=lambda ch, method, properties, body: on_message(
+                self, method, properties, body
+            ),
+        )
+
+    def ack(self, delivery_tag: int, multiple: bool = False) -> None:
+        self.channel.basic_ack(delivery_tag=delivery_tag, multiple=multiple)
+
+    def nack(self, delivery_tag: int, multiple: bool = False, requeue: bool = True) -> None:
+        self.channel.basic_nack(delivery_tag=delivery_tag, multiple=multiple, requeue=requeue)
+
+    def process_data_events(self, time_limit: float = 0) -> None:
+        self.connection.process_data_events(time_limit=time_limit)
+
+    def start_consuming(self) -> None:
+        self.channel.start_consuming()
+
+    def stop_consuming(self) -> None:
+        # pika connections are not thread safe, the stop is handed over to the thread driving the connection
+        self.connection.add_callback_threadsafe(self.channel.stop_consuming)
+
+    def close(self) -> None:
+        if self.connection.is_open:
+            self.connection.close()
+
+
+# a queued message: body, properties, whether it was delivered before and its position in the publishing order
+Message = Tuple[bytes, Optional[pika.BasicProperties], bool, int]
+
+
+class InMemoryBroker:
+    """
+    Broker living in the memory of the process, shared by the InMemoryTransport of its producers and consumers
+    (e.g. the Watcher threads and a Consumer thread). Messages are lost when the process exits, it is meant for
+    single node deployments, tests and benchmarks.
+    :param record_latencies: Record the time between the delivery and the acknowledgement of every message in
+    ack_latencies
+    :type record_latencies: bool
+    """
+
+    def __init__(self, record_latencies: bool = False):
+        self.queues: Dict[str, Deque[Message]] = {}
+        self.record_latencies = record_latencies
+        self.ack_latencies: List[float] = []
+        self.published = 0
+        # delivered and not yet acknowledged messages, by queue
+        self._unacked: Dict[str, int] = {}
+        # queues bound to the (exchange, routing key) pairs
+        self._bindings: Dict[Tuple[str, str], List[str]] = {}
+        self._changed = threading.Condition()
+
+    def queue(self, name: str) -> Deque[Message]:
+        """Messages waiting in a queue, the queue is created if needed"""
+        with self._changed:
+            self._unacked.setdefault(name, 0)
+            return self.queues.setdefault(name, deque())
+
+    def bind(self, queue: str, exchange: str, routing_key: str) -> None:
+        with self._changed:
+            queues = self._bindings.setdefault((exchange, routing_key), [])
+            if queue not in queues:
+                queues.append(queue)
+
+    def publish(
+        self,
+        routing_key: str,
+        body: bytes,
+        properties: Optional[pika.BasicProperties],
+        exchange: str = "",
+    ) -> None:
+        with self._changed:
+            if exchange:
+                queues = self._bindings.get((exchange, routing_key), [])
+            else:
+                queues = [routing_key]
+            for queue in queues:
+                self.queues.setdefault(queue, deque()).append(
+                    (body, properties, False, self.published)
+                )
+            self.published += 1
+            self._changed.notify_all()
+
+    def requeue(self, queue: str, message: Message) -> None:
+        """Puts a delivered message back at its original position, ahead of the messages published after it"""
+        body, properties, _, position = message
+        with self._changed:
+            messages = self.queues.setdefault(queue, deque())
+            i = 0
+            while i < len(messages) and messages[i][3] < position:
+                i += 1
+            messages.insert(i, (body, properties, True, position))
+            self._changed.notify_all()
+
+    def get(self, queue: str) -> Optional[Message]:
+        """Takes the next message of a queue for delivery, None when the queue is empty"""
+        with self._changed:
+            messages = self.queues.get(queue)
+            if not messages:
+                return None
+            self._unacked[queue] = self._unacked.get(queue, 0) + 1
+            return messages.popleft()
+
+    def settle(self, queue: str, delivered_at: List[float]) -> None:
+        """Records that delivered messages of a queue were acknowledged, rejected or requeued"""
+        now = monotonic()
+        with self._changed:
+            self._unacked[queue] -= len(delivered_at)
+            if self.record_latencies:
+                self.ack_latencies += [now - at for at in delivered_at]
+            self._changed.notify_all()
+
+    def wait_for(self, predicate: Callable[[], bool], timeout: Optional[float]) -> bool:
+        """Waits until the predicate holds, it is checked whenever messages are published or settled"""
+        with self._changed:
+            return self._changed.wait_for(predicate, timeout)
+
+    def notify(self) -> None:
+        with self._changed:
+            self._changed.notify_all()
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until every queue is empty and every delivered message was acknowledged
+        :return: False if the timeout expired first
+        :rtype: bool
+        """
+        return self.wait_for(
+            lambda: not any(self.queues.values()) and not any(self._unacked.values()),
+            timeout,
+        )
+
+
+# broker of the process, used by the transports created with get_transport("memory")
+BROKER = InMemoryBroker()
+
+
+class InMemoryTransport(Transport):
+    """
+    Transport over an InMemoryBroker. Consumers of the same queue (in different threads) share its messages, every
+    message being delivered to one of them. Rejected messages are requeued at their original position with the
+    redelivered flag set, and so are the unacknowledged messages of a closed transport.
+    :param broker: Broker to connect to, the one of the process by default
+    :type broker: InMemoryBroker
+    """
+
+    def __init__(self, broker: Optional[InMemoryBroker] = None):
+        self.broker = broker or BROKER
+        self.prefetch_count = 0
+        self.is_open = True
+        self._consumers: List[Tuple[str, OnMessage]] = []
+        # queue, message and delivery time of the unacknowledged messages, by delivery tag (in delivery order)
+        self._unacked: Dict[int, Tuple[str, Message, float]] = {}
+        self._delivery_tag = 0
+        self._stopped = threading.Event()
+
+    def declare_queue(self, queue: str) -> None:
+        self.broker.queue(queue)
+
+    def declare_exchange(self, exchange: str) -> None:
+        pass
+
+    def bind_queue(self, queue: str, exchange: str, routing_key: str) -> None:
+        self.broker.bind(queue, exchange, routing_key)
+
+    def publish(self, routing_key, body, properties=None, exchange="") -> None:
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.broker.publish(routing_key, body, properties, exchange=exchange)
+
+    def set_prefetch(self, prefetch_count: int) -> None:
+        self.prefetch_count = prefetch_count
+
+    def consume(self, queue: str, on_message: OnMessage) -> None:
+        self.broker.queue(queue)
+        self._consumers.append((queue, on_message))
+
+    def __settle(self, delivery_tag: int, multiple: bool) -> List[Tuple[str, Message, float]]:
+        if multiple:
+            tags = [tag for tag in self._unacked if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+        settled = [self._unacked.pop(tag) for tag in tags]
+        for queue in {queue for queue, _, _ in settled}:
+            self.broker.settle(
+                queue, [at for settled_queue, _, at in settled if settled_queue == queue]
+            )
+        return settled
+
+    def ack(self, delivery_tag: int, multiple: bool = False) -> None:
+        self.__settle(delivery_tag, multiple)
+
+    def nack(self, delivery_tag: int, multiple: bool = False, requeue: bool = True) -> None:
+        settled = self.__settle(delivery_tag, multiple)
+        if not requeue:
+            # there is no dead letter queue, rejected messages are dropped
+            return
+        for queue, message, _ in settled:
+            self.broker.requeue(queue, message)
+
+    def __deliver(self) -> int:
+        delivered = 0
+        for queue, on_message in self._consumers:
+            while not self._stopped.is_set():
+                if self.prefetch_count and len(self._unacked) >= self.prefetch_count:
+                    return delivered
+                message = self.broker.get(queue)
+                if message is None:
+                    break
+                body, properties, redelivered, _ = message
+                self._delivery_tag += 1
+                self._unacked[self._delivery_tag] = (queue, message, monotonic())
+                method = SimpleNamespace(
+                    delivery_tag=self._delivery_tag,
+                    routing_key=queue,
+                    redelivered=redelivered,
+                )
+                on_message(self, method, properties, body)
+                delivered += 1
+        return delivered
+
+    def __ready(self) -> bool:
+        """Whether a message can be delivered (or consuming was stopped), checked under the broker lock"""
+        if self._stopped.is_set():
+            return True
+        if self.prefetch_count and len(self._unacked) >= self.prefetch_count:
+            return False
+        return any(self.broker.queues.get(queue) for queue, _ in self._consumers)
+
+    def process_data_events(self, time_limit: float = 0) -> None:
+        if self.__deliver() or not time_limit:
+            return
+        if self.broker.wait_for(self.__ready, time_limit):
+            self.__deliver()
+
+    def start_consuming(self) -> None:
+        self._stopped.clear()
+        while not self._stopped.is_set():
+            if not self.__deliver():
+                self.broker.wait_for(self.__ready, None)
+
+    def stop_consuming(self) -> None:
+        self._stopped.set()
+        self.broker.notify()
+
+    def close(self) -> None:
+        if not self.is_open:
+            return
+        self.is_open = False
+        self._stopped.set()
+        if self._unacked:
+            self.nack(max(self._unacked), multiple=True, requeue=True)
+
+
+def get_transport(name: str, host: Optional[str] = None) -> Transport:
+    """
+    Creates a transport of the given kind
+    :param name: "pika" (RabbitMQ) or "memory" (the in-process broker, see BROKER)
+    :type name: str
+    :param host: Host name of the RabbitMQ broker, for pika
+    :type host: Optional[str]
+    """
+    if name == "pika":
+        return PikaTransport(host=host)
+    if name == "memory":
+        return InMemoryTransport()
+    raise ValueError(f"unknown transport {name}, expected one of {TRANSPORTS}")
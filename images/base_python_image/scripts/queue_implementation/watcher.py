@@ -1,15 +1,29 @@
 from watchdog.observers import Observer
+import asyncio
+import metrics
+import threading
+import traceback
 from queue import Queue
 from os.path import join, isfile, sep
 from os import listdir
 from watchdog.events import RegexMatchingEventHandler, FileCreatedEvent
-from queue_implementation.producer import Producer
+from queue_implementation.producer import Producer, AsyncProducer
+from queue_implementation.codec import pack_events
+from queue_implementation.transport import Transport
+from json_stream import iter_json_records
+from typing import Dict, Iterator, List, Optional, Tuple
+import pika
 import json
 import shutil
 from os.path import expandvars
 from pathlib import Path
 from termcolor import colored
 
+WATCHER_FILES = metrics.counter("watcher_files_total", "Files published by the Watcher")
+WATCHER_EVENTS = metrics.counter("watcher_events_total", "Events published by the Watcher")
+WATCHER_FILE_SECONDS = metrics.histogram(
+    "watcher_file_seconds", "Time spent publishing the events of a file"
+)
 
 class Watcher:
     """
@@ -17,63 +31,206 @@ class Watcher:
     To note, Watchdog does not parse files that have already existed in the target path, therefore a normal queue is used
     to first parse the directory and then monitor any following changes.
     The Watcher triggers the Producer to publish events on RabbitMQ whenever new .json files are added.
+    Files are parsed one event at a time. By default every event is published as its own message, with pack_size
+    set, events are packed pack_size at a time into a single message (see codec.pack_events). With confirms
+    set, messages are published with asynchronous publisher confirms and a file is only moved away once all
+    of its messages were confirmed by the broker.
+    A single publishing connection is kept for the lifetime of the Watcher (and reopened if it drops). Files are
+    handled by a fixed number of worker threads taking them from the watchdog queue, so a burst of new files is
+    processed concurrently while the publishing connection is shared safely between the workers.
     :param path: Host name of the RabbitMQ broker (e.g. localhost/container name)
     :type path: str
     :param watchdog_queue: Queue used by watchdog for parsing files already existing in the monitor directory
     :type watchdog_queue: Queue
     :param rabbitmq_queue: Designated RabbitMQ queue to publish messages onto
     :type rabbitmq_queue: str
+    :param pack_size: Number of events packed into a single message (None publishes one message per event)
+    :type pack_size: Optional[int]
+    :param pack_format: Body format of packed messages, "ndjson" or "json"
+    :type pack_format: str
+    :param compress: Gzip the body of packed messages
+    :type compress: bool
+    :param confirms: Publish with asynchronous publisher confirms
+    :type confirms: bool
+    :param max_outstanding_confirms: Maximum number of messages waiting for a confirm when confirms are used
+    :type max_outstanding_confirms: int
+    :param workers: Number of threads handling files concurrently
+    :type workers: int
+    :param transport: Transport of the producer (e.g. transport.InMemoryTransport), RabbitMQ when not given.
+    Publisher confirms require RabbitMQ.
+    :type transport: Optional[Transport]
+    :param shards: Number of shard queues the events are routed to by their shard_key (see Producer), 0 does not
+    shard. Packed messages only hold events of a single shard. Not supported along with confirms.
+    :type shards: int
+    :param shard_key: Field of the events hashed into their shard
+    :type shard_key: str
+    :param exchange: Exchange the shard queues are bound to
+    :type exchange: str
     """
 
     regexes = [r".*.json$"]
     ignore_directories = True
     case_sensitive = True
 
-    def __init__(self, path: str, watchdog_queue: Queue, rabbitmq_queue: str) -> None:
+    def __init__(
+        self,
+        path: str,
+        watchdog_queue: Queue,
+        rabbitmq_queue: str,
+        pack_size: Optional[int] = None,
+        pack_format: str = "ndjson",
+        compress: bool = False,
+        confirms: bool = False,
+        max_outstanding_confirms: int = 1000,
+        workers: int = 1,
+        transport: Optional[Transport] = None,
+        shards: int = 0,
+        shard_key: str = "organization_name",
+        exchange: str = "events",
+    ) -> None:
+        if confirms and transport is not None:
+            raise ValueError("publisher confirms are only supported with RabbitMQ")
+        if confirms and shards:
+            raise ValueError("publisher confirms are not supported with sharding")
+        self.shards = shards
+        self.shard_key = shard_key
+        self.exchange = exchange
         self.rabbitmq_queue = rabbitmq_queue
+        self.pack_size = pack_size
+        self.pack_format = pack_format
+        self.compress = compress
+        self.confirms = confirms
+        self.max_outstanding_confirms = max_outstanding_confirms
+        self.transport = transport
         self.path = path
         self.event_handler = RegexMatchingEventHandler(
             regexes=self.regexes,
             ignore_directories=self.ignore_directories,
             case_sensitive=self.case_sensitive,
         )
-        self.event_handler.on_created = self.__on_created_event
+        # new files are only queued by the observer thread, the workers pick them up from there
+        self.event_handler.on_created = lambda event: self.watchdog_queue.put(item=event)
         self.watchdog_queue = watchdog_queue
+        self.__open_producer()
+        self.workers = [
+            threading.Thread(target=self.__work, daemon=True) for _ in range(workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
         for file in listdir(path):
             fpath = join(path, file)
             if isfile(fpath):
                 event = FileCreatedEvent(fpath)
                 self.watchdog_queue.put(item=event)
 
-        while not watchdog_queue.empty():
-            self.__on_created_event(watchdog_queue.get())
+        # files that already existed are published before the Watcher starts monitoring
+        watchdog_queue.join()
+
+    def __open_producer(self) -> None:
+        host = expandvars("$RABBITMQ_HOST")
+        if not self.confirms:
+            self.producer = Producer(
+                host=host,
+                queue=self.rabbitmq_queue,
+                transport=self.transport,
+                shards=self.shards,
+                shard_key=self.shard_key,
+                exchange=self.exchange,
+            )
+            return
+        # the confirming producer lives on its own event loop, workers submit their files to it
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.producer = AsyncProducer(
+            host=host,
+            queue=self.rabbitmq_queue,
+            max_outstanding=self.max_outstanding_confirms,
+        )
+        asyncio.run_coroutine_threadsafe(self.producer.connect(), self.loop).result()
+
+    def __work(self) -> None:
+        while True:
+            event = self.watchdog_queue.get()
+            try:
+                self.__on_created_event(event)
+            except Exception:
+                # a broken file must not take the worker down with it
+                print(colored(f"failed processing {event.src_path}", "red"))
+                traceback.print_exc()
+            finally:
+                self.watchdog_queue.task_done()
+
+    def __shard_of(self, entry: dict) -> Optional[int]:
+        return self.producer.shard_of(entry) if self.shards else None
+
+    def __messages(
+        self, src_path: str
+    ) -> Iterator[Tuple[str, Optional[pika.BasicProperties], int, Optional[int]]]:
+        """
+        Yields the messages to publish for a file as (body, properties, number of events in the message, shard),
+        the events of a shard in file order
+        """
+        if not self.pack_size:
+            for entry in iter_json_records(src_path):
+                yield json.dumps(entry), None, 1, self.__shard_of(entry)
+            return
+
+        # one batch per shard being filled (a single one when not sharded)
+        batches: Dict[Optional[int], List[dict]] = {}
+        for entry in iter_json_records(src_path):
+            shard = self.__shard_of(entry)
+            batch = batches.setdefault(shard, [])
+            batch.append(entry)
+            if len(batch) == self.pack_size:
+                body, properties = pack_events(batch, self.pack_format, self.compress)
+                yield body, properties, len(batch), shard
+                del batches[shard]
+        for shard, batch in batches.items():
+            body, properties = pack_events(batch, self.pack_format, self.compress)
+            yield body, properties, len(batch), shard
+
+    def __publish_with_confirms(self, src_path: str) -> int:
+        produced = 0
+        for body, properties, events, _ in self.__messages(src_path):
+            asyncio.run_coroutine_threadsafe(
+                self.producer.publish_event(msg=body, properties=properties), self.loop
+            ).result()
+            produced += events
+        asyncio.run_coroutine_threadsafe(
+            self.producer.wait_for_confirms(), self.loop
+        ).result()
+        return produced
 
     def __on_created_event(self, event: FileCreatedEvent) -> None:
         print(f"{event.src_path} has been created")
-        producer = Producer(
-            host=expandvars("$RABBITMQ_HOST"), queue=self.rabbitmq_queue
-        )
-        with open(event.src_path, "r") as f:
-            data = json.loads(f.read())
-        if isinstance(data, list):  # if a file containing list of dicts
-            for i, entry in enumerate(data):
-                producer.publish_event(msg=json.dumps(entry))
-            print(
-                colored(f"{i + 1} events were produced", "blue")
-            )  # I'm taking into account that we don't feed empty files
-        elif isinstance(data, dict):
-            producer.publish_event(msg=json.dumps(data))
-            print("1 event was produced")
+        with WATCHER_FILE_SECONDS.time():
+            if self.confirms:
+                produced = self.__publish_with_confirms(event.src_path)
+            else:
+                produced = 0
+                for body, properties, events, shard in self.__messages(event.src_path):
+                    self.producer.publish_event(msg=body, properties=properties, shard=shard)
+                    produced += events
+        WATCHER_FILES.inc()
+        WATCHER_EVENTS.inc(produced)
+        print(colored(f"{produced} events were produced", "blue"))
 
         processed_dir = join(
             sep, "tmp", "processed"
         )  # after having processed the file, it is moved
         Path(processed_dir).mkdir(parents=True, exist_ok=True)
         shutil.move(src=event.src_path, dst=processed_dir)
-        producer.close()
 
     def start(self) -> None:
         observer = Observer()
         observer.schedule(self.event_handler, self.path, recursive=True)
         observer.start()
         observer.join()
+
+    def close(self) -> None:
+        if self.confirms:
+            asyncio.run_coroutine_threadsafe(self.producer.close(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        else:
+            self.producer.close()
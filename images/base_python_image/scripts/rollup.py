@@ -0,0 +1,256 @@
+import logging
+import math
+import metrics
+import psycopg2
+import psycopg2.extensions
+from collections import Counter
+from datetime import date, datetime
+from file_index import parse_timestamp
+from hashlib import blake2b
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+ROLLUP_MERGES = metrics.counter("rollup_merges_total", "Merges of the rollups into their tables")
+ROLLUP_ROWS = metrics.counter("rollup_rows_total", "Rows added to the rollups")
+
+CREATE_ROLLUP_SQL = """
+CREATE TABLE IF NOT EXISTS {schema}.{table_name} (
+    {date_key} date NOT NULL,
+    {dimension_columns},
+    events bigint NOT NULL,
+    updated_at timestamp NOT NULL DEFAULT now()
+);
+CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_key_idx ON {schema}.{table_name} ({conflict_target});
+CREATE TABLE IF NOT EXISTS {schema}.{table_name}_users (
+    {date_key} date PRIMARY KEY,
+    unique_users bigint NOT NULL,
+    users_sketch bytea NOT NULL,
+    updated_at timestamp NOT NULL DEFAULT now()
+);
+"""
+
+
+class HyperLogLog:
+    """
+    HyperLogLog sketch estimating the number of distinct values added to it, within about 1.04 / sqrt(2^precision)
+    (0.8% with the default precision) using 2^precision bytes. Sketches of the same precision merge losslessly, the
+    merged sketch estimating the distinct values of the union.
+    :param precision: Number of bits of the hash addressing the registers, between 4 and 16
+    :type precision: int
+    :param registers: Registers of a sketch saved with to_bytes, empty when not given
+    :type registers: Optional[bytes]
+    """
+
+    def __init__(self, precision: int = 14, registers: Optional[bytes] = None):
+        if not 4 <= precision <= 16:
+            raise ValueError("the precision of a HyperLogLog sketch is between 4 and 16")
+        self.precision = precision
+        self.m = 1 << precision
+        if registers:
+            if len(registers) != self.m:
+                raise ValueError(f"a sketch of precision {precision} has {self.m} registers, got {len(registers)}")
+            self.registers = bytearray(registers)
+        else:
+            self.registers = bytearray(self.m)
+
+    def add(self, value: str) -> None:
+        h = int.from_bytes(blake2b(value.encode("utf-8"), digest_size=8).digest(), "little")
+        index = h >> (64 - self.precision)
+        rest_bits = 64 - self.precision
+        # position of the leftmost 1 of the remaining bits
+        rank = rest_bits - (h & ((1 << rest_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        if other.precision != self.precision:
+            raise ValueError("only sketches of the same precision can be merged")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        raw = alpha * self.m ** 2 / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * self.m and zeros:
+            # linear counting is more accurate on small cardinalities
+            return round(self.m * math.log(self.m / zeros))
+        return round(raw)
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.registers)
+
+
+def event_day(value) -> Optional[date]:
+    """Day of a timestamp value, parsed or not, None for missing values"""
+    if value is None or value != value:  # NaN/NaT of the pandas columns
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return parse_timestamp(str(value)).date()
+
+
+class Rollup:
+    """
+    Pre-aggregation of the events during ingestion, for dashboards to read near real time numbers without scanning
+    the events: events per day and dimensions (e.g. per received_at date, organization and user type, summed up
+    for coarser numbers) in {schema}.{table_name}, and a HyperLogLog sketch of the users of every day with the
+    estimated number of unique users in {schema}.{table_name}_users.
+    Rows are aggregated in memory with add_rows and merged into the tables with merge, on the cursor committing
+    them, or both at once with merge_rows: counters are added up and sketches are merged, so the rollup only counts
+    every event once if every event is loaded once (see dedupe.Deduper). The in-memory aggregates are cleared once
+    merged.
+    Events are counted per event (unlike fact_events.sql, counting distinct users, organizations and user types).
+    :param schema: Schema of the rollup tables
+    :type schema: str
+    :param table_name: Table of the counters, the sketches being in <table_name>_users
+    :type table_name: str
+    :param date_key: Timestamp column the events are aggregated by day on
+    :type date_key: str
+    :param user_key: Column of the users counted in the sketches
+    :type user_key: str
+    :param dimensions: Columns the events are counted by, besides the day
+    :type dimensions: Sequence[str]
+    :param precision: Precision of the sketches (see HyperLogLog)
+    :type precision: int
+    """
+
+    def __init__(
+        self,
+        schema: str = "modelled",
+        table_name: str = "events_rollup",
+        date_key: str = "received_at",
+        user_key: str = "username",
+        dimensions: Sequence[str] = ("organization_name", "user_type"),
+        precision: int = 14,
+    ):
+        self.schema = schema
+        self.table_name = table_name
+        self.date_key = date_key
+        self.user_key = user_key
+        self.dimensions = list(dimensions)
+        self.precision = precision
+        self.counts: Counter = Counter()
+        self.sketches: Dict[date, HyperLogLog] = {}
+
+    @property
+    def columns(self) -> List[str]:
+        """Columns the rows must have"""
+        return [self.date_key, self.user_key] + self.dimensions
+
+    def create_table_query(self) -> str:
+        return CREATE_ROLLUP_SQL.format(
+            schema=self.schema,
+            table_name=self.table_name,
+            date_key=self.date_key,
+            dimension_columns=",\n    ".join(f"{dimension} text" for dimension in self.dimensions),
+            conflict_target=self.__conflict_target(),
+        )
+
+    def __conflict_target(self) -> str:
+        # NULL dimensions are a group of their own, as in the fact table
+        return ", ".join([self.date_key] + [f"(COALESCE({dimension}, ''))" for dimension in self.dimensions])
+
+    def add_rows(self, rows: Iterable[tuple], fields: List[str]) -> None:
+        """
+        Aggregates rows, e.g. the rows of a batch. Rows without a day are left out.
+        :param rows: Rows to aggregate
+        :type rows: Iterable[tuple]
+        :param fields: Columns of the rows, holding at least the columns of the rollup
+        :type fields: List[str]
+        """
+        indexes = self.__indexes(fields)
+        ROLLUP_ROWS.inc(sum(self.__add(row, *indexes) for row in rows))
+
+    def observe(self, rows: Iterable[tuple], fields: List[str]) -> Iterator[tuple]:
+        """Aggregates rows while passing them on, for streams loaded as they are read"""
+        indexes = self.__indexes(fields)
+        for row in rows:
+            if self.__add(row, *indexes):
+                ROLLUP_ROWS.inc()
+            yield row
+
+    def __indexes(self, fields: List[str]) -> Tuple[int, int, List[int]]:
+        return (
+            fields.index(self.date_key),
+            fields.index(self.user_key),
+            [fields.index(dimension) for dimension in self.dimensions],
+        )
+
+    def __add(self, row: tuple, date_index: int, user_index: int, dimension_indexes: List[int]) -> bool:
+        day = event_day(row[date_index])
+        if day is None:
+            return False
+        self.counts[(day,) + tuple(self.__value(row[i]) for i in dimension_indexes)] += 1
+        user = self.__value(row[user_index])
+        if user is not None:
+            sketch = self.sketches.get(day)
+            if sketch is None:
+                sketch = self.sketches[day] = HyperLogLog(self.precision)
+            sketch.add(user)
+        return True
+
+    @staticmethod
+    def __value(value) -> Optional[str]:
+        if value is None or value != value:
+            return None
+        return str(value)
+
+    def merge_rows(self, cur: psycopg2.extensions.cursor, rows: Iterable[tuple], fields: List[str]) -> None:
+        """
+        Aggregates rows apart from the aggregates of the rollup and merges them on the cursor, once the statement
+        loading the rows succeeded: rows whose load fails (and which are loaded again) are never counted
+        """
+        rollup = Rollup(
+            self.schema, self.table_name, self.date_key, self.user_key, self.dimensions, self.precision
+        )
+        rollup.add_rows(rows, fields)
+        rollup.merge(cur)
+
+    def merge(self, cur: psycopg2.extensions.cursor) -> None:
+        """Merges the aggregates into the rollup tables on the cursor (the transaction) of the load and clears them"""
+        if not self.counts:
+            return
+        counts, sketches = self.counts, self.sketches
+        self.counts, self.sketches = Counter(), {}
+        cur.execute(self.create_table_query())
+        columns = ", ".join([self.date_key] + self.dimensions)
+        placeholders = ", ".join(["%s"] * (len(self.dimensions) + 2))
+        cur.executemany(
+            f"""INSERT INTO {self.schema}.{self.table_name} ({columns}, events) VALUES ({placeholders})
+            ON CONFLICT ({self.__conflict_target()}) DO UPDATE
+            SET events = {self.table_name}.events + EXCLUDED.events, updated_at = now()""",
+            [key + (events,) for key, events in sorted(counts.items(), key=lambda item: str(item[0]))],
+        )
+        if sketches:
+            self.__merge_sketches(cur, sketches)
+        ROLLUP_MERGES.inc()
+
+    def __merge_sketches(self, cur: psycopg2.extensions.cursor, sketches: Dict[date, HyperLogLog]) -> None:
+        users_table = f"{self.schema}.{self.table_name}_users"
+        days = sorted(sketches)
+        # the rows of the days are created first and locked, concurrent merges of a day then wait for each other
+        cur.executemany(
+            f"""INSERT INTO {users_table} ({self.date_key}, unique_users, users_sketch) VALUES (%s, 0, %s)
+            ON CONFLICT ({self.date_key}) DO NOTHING""",
+            [(day, psycopg2.Binary(b"")) for day in days],
+        )
+        cur.execute(
+            f"SELECT {self.date_key}, users_sketch FROM {users_table} WHERE {self.date_key} = ANY(%s) "
+            f"ORDER BY {self.date_key} FOR UPDATE",
+            (days,),
+        )
+        updates: List[Tuple] = []
+        for day, registers in cur.fetchall():
+            sketch = sketches[day]
+            sketch.merge(HyperLogLog(self.precision, bytes(registers)))
+            updates.append((sketch.estimate(), psycopg2.Binary(sketch.to_bytes()), day))
+        cur.executemany(
+            f"""UPDATE {users_table} SET unique_users = %s, users_sketch = %s, updated_at = now()
+            WHERE {self.date_key} = %s""",
+            updates,
+        )
@@ -0,0 +1,75 @@
+from datetime import datetime
+from file_index import parse_timestamp
+from typing import Callable, Dict, Iterable, List, Tuple
+
+
+# column types whose values are coerced into datetime objects by the row extractor
+TIMESTAMP_TYPES = {
+    "timestamp",
+    "timestamp without time zone",
+    "timestamptz",
+    "timestamp with time zone",
+}
+
+
+def coerce_timestamp(value):
+    """Timestamp value (ISO 8601 string or anything pandas understands) as a datetime, None stays None"""
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return parse_timestamp(value)
+
+
+def compile_extractor(
+    columns: List[Dict], coerce_timestamps: bool = True
+) -> Callable[[dict], tuple]:
+    """
+    Generates the function extracting a row out of a parsed JSON record, for a table metadata column list. The
+    generated function reads every column with a single dict lookup (missing keys give None, i.e. NULL) and
+    coerces the timestamp columns, without looping over the columns at runtime.
+    :param columns: Columns of the table metadata (name and type)
+    :type columns: List[Dict]
+    :param coerce_timestamps: Parse the values of timestamp columns into datetime objects, so that malformed
+    timestamps are rejected before reaching the database
+    :type coerce_timestamps: bool
+    :return: Function turning a record into a row (tuple ordered like the columns)
+    :rtype: Callable[[dict], tuple]
+    """
+    getters = []
+    for column in columns:
+        getter = f"get({column['name']!r})"
+        if coerce_timestamps and str(column.get("type")).strip().lower() in TIMESTAMP_TYPES:
+            getter = f"coerce_timestamp({getter})"
+        getters.append(getter)
+    source = (
+        "def extract(record):\n"
+        "    get = record.get\n"
+        f"    return ({', '.join(getters)},)\n"
+    )
+    namespace = {"coerce_timestamp": coerce_timestamp}
+    exec(compile(source, "<row extractor>", "exec"), namespace)
+    return namespace["extract"]
+
+
+class RowCodec:
+    """
+    Row extraction compiled once for a table metadata column list (see TableMD.row_codec), to keep the per record
+    work of the loaders and consumers down to one call. Rows are then encoded by CopyStream (CSV),
+    pgcopy.BinaryCopyStream or passed as query parameters.
+    :param columns: Columns of the table metadata (name and type)
+    :type columns: List[Dict]
+    :param coerce_timestamps: Parse the values of timestamp columns into datetime objects
+    :type coerce_timestamps: bool
+    """
+
+    def __init__(self, columns: List[Dict], coerce_timestamps: bool = True):
+        self.fields: Tuple[str, ...] = tuple(column["name"] for column in columns)
+        self.extract: Callable[[dict], tuple] = compile_extractor(
+            columns, coerce_timestamps=coerce_timestamps
+        )
+
+    def extract_all(self, records: Iterable[dict]) -> List[tuple]:
+        extract = self.extract
+        return [extract(record) for record in records]
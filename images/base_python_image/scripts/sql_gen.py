@@ -1,6 +1,70 @@
 import yaml
+from copy import copy
 from dataclasses import dataclass
-from typing import List, Dict, Union
+from datetime import datetime
+from row_codec import RowCodec
+from typing import List, Dict, Tuple, Union
+
+# supported partition grains: (date_trunc field, partition range, partition name suffix format)
+PARTITION_GRAINS = {
+    "daily": ("day", "1 day", "YYYYMMDD"),
+    "monthly": ("month", "1 month", "YYYYMM"),
+}
+
+# creates the partitions covering every lower bound returned by the buckets query. A partition is created
+# detached, filled with the rows of its range that landed in the default partition beforehand, and attached.
+# Loads creating the partitions of the same table (e.g. concurrent consumers) wait for each other
+CREATE_PARTITIONS_SQL = """
+DO $$
+DECLARE
+    lower_bound TIMESTAMP;
+    partition_name TEXT;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('{schema}.{table_name}'));
+    FOR lower_bound IN {buckets} LOOP
+        CONTINUE WHEN lower_bound IS NULL;
+        partition_name := '{table_name}_p' || to_char(lower_bound, '{name_format}');
+        IF to_regclass(format('%I.%I', '{schema}', partition_name)) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I.%I (LIKE %I.%I INCLUDING DEFAULTS)',
+                           '{schema}', partition_name, '{schema}', '{table_name}');
+            EXECUTE format('WITH moved AS (DELETE FROM %I.%I WHERE {key} >= %L AND {key} < %L RETURNING *) '
+                           'INSERT INTO %I.%I SELECT * FROM moved',
+                           '{schema}', '{table_name}_default', lower_bound, lower_bound + INTERVAL '{interval}',
+                           '{schema}', partition_name);
+            EXECUTE format('ALTER TABLE %I.%I ATTACH PARTITION %I.%I FOR VALUES FROM (%L) TO (%L)',
+                           '{schema}', '{table_name}', '{schema}', partition_name,
+                           lower_bound, lower_bound + INTERVAL '{interval}');
+        END IF;{replace}
+    END LOOP;
+END $$;
+"""
+
+# CREATE TABLE IF NOT EXISTS would keep a table created before partitioning was set as is, every row of it then
+# missing the partitions
+REQUIRE_PARTITIONED_SQL = """
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = '{schema}' AND c.relname = '{table_name}' AND c.relkind <> 'p'
+    ) THEN
+        RAISE EXCEPTION '{schema}.{table_name} exists and is not partitioned, drop it or move its rows to a partitioned table';
+    END IF;
+END $$;
+"""
+
+COPY_FORMATS = ["csv", "binary"]
+
+UPSERT_STRATEGIES = ["delete_insert", "partition_replace", "on_conflict", "merge"]
+
+# first PostgreSQL version (server_version_num) supporting MERGE
+MERGE_MIN_SERVER_VERSION = 150000
+
+# channel notified with the "{schema}.{table}" name of a table whenever import_sources finished loading it
+TABLE_LOADED_CHANNEL = "table_loaded"
+
+REPLACE_PARTITION_SQL = """
+        EXECUTE format('TRUNCATE %I.%I', '{schema}', partition_name);"""
 
 
 @dataclass
@@ -15,6 +79,7 @@ class TableMD:
     def __post_init__(self):
         with open(self.table_md_path, "r") as f:
             self.table_md = yaml.load(f, Loader=yaml.FullLoader)
+        self._row_codec = None
 
     @property
     def table_name(self) -> str:
@@ -45,6 +110,44 @@ class TableMD:
     def delta_params(self) -> Union[Dict, None]:
         return self.table_md.get("delta_params")
 
+    @property
+    def row_codec(self) -> RowCodec:
+        """Row extractor compiled for the columns, on first use"""
+        if self._row_codec is None:
+            self._row_codec = RowCodec(self.columns)
+        return self._row_codec
+
+    def with_columns(self, columns: List[dict]) -> "TableMD":
+        """Copy of the table metadata with extra columns appended (e.g. columns filled in by enrichment)"""
+        names = {column["name"] for column in self.columns}
+        md = copy(self)
+        md.table_md = dict(
+            self.table_md,
+            columns=self.columns + [column for column in columns if column["name"] not in names],
+        )
+        md._row_codec = None
+        return md
+
+    @property
+    def partitioning(self) -> Union[Dict, None]:
+        """
+        Range partitioning of the table (the master table when delta_params are set), e.g.
+        partitioning:
+          key: received_at  # defaults to filter_key
+          grain: daily  # daily or monthly
+        """
+        partitioning = self.table_md.get("partitioning")
+        if partitioning is None:
+            return None
+        partitioning = {"key": self.filter_key, "grain": "daily", **partitioning}
+        if partitioning["grain"] not in PARTITION_GRAINS:
+            raise ValueError(
+                f"unknown partitioning grain {partitioning['grain']}, expected one of {list(PARTITION_GRAINS)}"
+            )
+        if not partitioning["key"]:
+            raise ValueError("partitioning requires a key or a filter_key")
+        return partitioning
+
 
 @dataclass
 class SQLGenerator:
@@ -63,19 +166,121 @@ class SQLGenerator:
         )
 
     def create_table_query(self) -> str:
+        """
+        Creates the table. Tables without delta_params are created partitioned when partitioning is set, along with
+        a default partition catching rows no partition was created for yet (see create_partitions_query). An
+        existing table that is not partitioned is rejected.
+        """
         sql = "CREATE TABLE IF NOT EXISTS {schema}.{table_name}({columns});"
-        columns = []
-        for column_md in self.table_md.columns:
-            column = f"{column_md['name']} {column_md['type']}"
-            if column_md.get("length"):
-                column += f"({column_md['length']})"
-            columns.append(column)
+        partitioned = self.table_md.partitioning and not self.table_md.delta_params
+        if partitioned:
+            sql = (
+                "CREATE TABLE IF NOT EXISTS {schema}.{table_name}({columns}) "
+                + self.partition_clause()
+                + ";\n"
+                + self.create_default_partition_query(self.table_md.table_name)
+            )
+        columns = [self.__column_definition(column_md) for column_md in self.table_md.columns]
 
-        return sql.format(
+        sql = sql.format(
             schema=self.table_md.schema_name,
             table_name=self.table_md.table_name,
             columns=",".join(columns),
         )
+        if partitioned:
+            sql = self.require_partitioned_query(self.table_md.table_name) + sql
+        return sql
+
+    @staticmethod
+    def __column_definition(column_md: dict) -> str:
+        column = f"{column_md['name']} {column_md['type']}"
+        if column_md.get("length"):
+            column += f"({column_md['length']})"
+        return column
+
+    def add_columns_query(self, columns: List[dict]) -> str:
+        """Adds columns to the table if it does not have them yet, e.g. a table created before they were added"""
+        return ";\n".join(
+            f"ALTER TABLE {self.table_md.schema_name}.{self.table_md.table_name} "
+            f"ADD COLUMN IF NOT EXISTS {self.__column_definition(column_md)}"
+            for column_md in columns
+        ) + ";"
+
+    def notify_loaded_query(self) -> str:
+        """Notifies the listeners of TABLE_LOADED_CHANNEL that the table (the master table of deltas) was loaded"""
+        return "SELECT pg_notify('{channel}', '{schema}.{table_name}');".format(
+            channel=TABLE_LOADED_CHANNEL,
+            schema=self.table_md.schema_name,
+            table_name=self.partitioned_table(),
+        )
+
+    def partition_clause(self) -> str:
+        return "PARTITION BY RANGE ({key})".format(key=self.table_md.partitioning["key"])
+
+    def partitioned_table(self) -> str:
+        """The partitioned table: the master table for delta loads, the table itself otherwise"""
+        if self.table_md.delta_params:
+            return self.table_md.delta_params["master_table"]
+        return self.table_md.table_name
+
+    def require_partitioned_query(self, table_name: str) -> str:
+        """Fails if the table exists without being partitioned"""
+        return REQUIRE_PARTITIONED_SQL.format(schema=self.table_md.schema_name, table_name=table_name).lstrip()
+
+    def create_default_partition_query(self, table_name: str) -> str:
+        return "CREATE TABLE IF NOT EXISTS {schema}.{table_name}_default PARTITION OF {schema}.{table_name} DEFAULT;".format(
+            schema=self.table_md.schema_name, table_name=table_name
+        )
+
+    def partition_lower_bound(self, value: Union[str, datetime]) -> datetime:
+        """Lower bound of the partition a partition key value falls in"""
+        if not isinstance(value, datetime):
+            value = datetime.fromisoformat(str(value))
+        lower_bound = value.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.table_md.partitioning["grain"] == "monthly":
+            lower_bound = lower_bound.replace(day=1)
+        return lower_bound
+
+    def create_partitions_query(
+        self, source_table: Union[str, None] = None, replace: bool = False
+    ) -> str:
+        """
+        Creates the missing partitions of the partitioned table for every partition key value found in a source
+        table (by default the table itself, i.e. the delta table for delta loads).
+        :param source_table: Table (in the same schema) whose partition key values need a partition
+        :type source_table: Union[str, None]
+        :param replace: Truncate the partitions of those values as well, so they can be replaced as a whole
+        :type replace: bool
+        """
+        trunc_field, _, _ = PARTITION_GRAINS[self.table_md.partitioning["grain"]]
+        buckets = "SELECT DISTINCT date_trunc('{field}', {key}) FROM {schema}.{source_table}".format(
+            field=trunc_field,
+            key=self.table_md.partitioning["key"],
+            schema=self.table_md.schema_name,
+            source_table=source_table or self.table_md.table_name,
+        )
+        return self.__create_partitions(buckets, replace)
+
+    def create_partition_query(self, lower_bound: datetime) -> str:
+        """Creates the partition starting at the given lower bound (see partition_lower_bound) if missing"""
+        buckets = "SELECT '{lower_bound}'::TIMESTAMP".format(
+            lower_bound=lower_bound.strftime("%Y-%m-%d %H:%M:%S")
+        )
+        return self.__create_partitions(buckets, replace=False)
+
+    def __create_partitions(self, buckets: str, replace: bool) -> str:
+        _, interval, name_format = PARTITION_GRAINS[self.table_md.partitioning["grain"]]
+        return CREATE_PARTITIONS_SQL.format(
+            buckets=buckets,
+            schema=self.table_md.schema_name,
+            table_name=self.partitioned_table(),
+            key=self.table_md.partitioning["key"],
+            interval=interval,
+            name_format=name_format,
+            replace=REPLACE_PARTITION_SQL.format(schema=self.table_md.schema_name)
+            if replace
+            else "",
+        )
 
     def insert_values_into(self, values: list):
         return """INSERT INTO {dst_schema}.{dst_table} VALUES ({values});
@@ -85,7 +290,31 @@ class SQLGenerator:
             values=",".join(["'{}'".format(value) for value in values]),
         )
 
-    def copy_query(self) -> str:
+    def insert_query(self) -> str:
+        """Parameterized INSERT of a single row, values are passed separately to cursor.execute"""
+        return "INSERT INTO {schema}.{table_name} ({columns}) VALUES ({placeholders});".format(
+            schema=self.table_md.schema_name,
+            table_name=self.table_md.table_name,
+            columns=",".join([col.get("name") for col in self.table_md.columns]),
+            placeholders=",".join(["%s"] * len(self.table_md.columns)),
+        )
+
+    def copy_query(self, copy_format: str = "csv") -> str:
+        """
+        COPY of the table columns from STDIN, either as CSV with a header or in the binary format (see pgcopy)
+        :param copy_format: "csv" or "binary"
+        :type copy_format: str
+        """
+        if copy_format not in COPY_FORMATS:
+            raise ValueError(
+                f"unknown copy format {copy_format}, expected one of {COPY_FORMATS}"
+            )
+        if copy_format == "binary":
+            return "COPY {schema}.{table_name} ({columns}) FROM STDIN WITH (FORMAT binary)".format(
+                schema=self.table_md.schema_name,
+                table_name=self.table_md.table_name,
+                columns=",".join([col.get("name") for col in self.table_md.columns]),
+            )
         return """COPY {schema}.{table_name} ({columns}) FROM STDIN 
         WITH
         DELIMITER '{delimiter}'
@@ -97,19 +326,143 @@ class SQLGenerator:
             columns=",".join([col.get("name") for col in self.table_md.columns]),
         )
 
-    def upsert_on_id(self) -> str:
+    def upsert_on_id(self, server_version: Union[int, None] = None) -> str:
         """
         Load data from a delta table (containing only a subset of the data) into a master
         table containing the full dataset. Load replaces entries existing on both tables using a specific key.
+        The delta_params strategy selects how:
+        - delete_insert (default): deletes the master rows whose key is in the delta (through an index on the key)
+          and inserts the delta.
+        - on_conflict: keeps a unique index on the key and updates rows in place with INSERT ... ON CONFLICT, which
+          avoids rewriting unchanged rows and bloating the master table. The master must not hold duplicate keys,
+          duplicates in the delta are reduced to the latest row (by filter_key when set).
+        - merge: same as on_conflict using MERGE, falls back to on_conflict on servers older than PostgreSQL 15.
+        - partition_replace: see below.
+        When partitioning is set, the master table is partitioned and the partitions of the delta are created on
+        demand. With delta_params strategy "partition_replace", every partition touched by the delta is truncated
+        and replaced as a whole instead of deleting rows by key, the delta must then hold the complete content of
+        those partitions (e.g. a daily partition loaded for a specific date).
+        :param server_version: Version of the server the query runs on (connection.server_version), used to
+        decide whether MERGE is available
+        :type server_version: Union[int, None]
         """
-        return """
+        strategy = self.table_md.delta_params.get("strategy", "delete_insert")
+        if strategy not in UPSERT_STRATEGIES:
+            raise ValueError(
+                f"unknown upsert strategy {strategy}, expected one of {UPSERT_STRATEGIES}"
+            )
+        if strategy == "partition_replace" and not self.table_md.partitioning:
+            raise ValueError("the partition_replace strategy requires partitioning")
+        if strategy in ("on_conflict", "merge"):
+            if self.table_md.partitioning:
+                # unique indexes of a partitioned table must contain the partition key
+                raise ValueError(f"the {strategy} strategy does not support partitioning")
+            if strategy == "merge" and (server_version or 0) >= MERGE_MIN_SERVER_VERSION:
+                return self.__merge_query()
+            return self.__on_conflict_query()
+
+        if not self.table_md.partitioning:
+            return """
         CREATE TABLE IF NOT EXISTS {schema}.{master_table} (LIKE {schema}.{delta_table});
+        CREATE INDEX IF NOT EXISTS {master_table}_{delta_key}_idx ON {schema}.{master_table} ({delta_key});
+        ANALYZE {schema}.{delta_table};
         DELETE FROM {schema}.{master_table} WHERE {delta_key}
         IN (SELECT {delta_key} FROM {schema}.{delta_table});
         INSERT INTO {schema}.{master_table} SELECT * FROM {schema}.{delta_table};
         """.format(
+                schema=self.table_md.schema_name,
+                master_table=self.table_md.delta_params["master_table"],
+                delta_key=self.table_md.delta_params["delta_key"],
+                delta_table=self.table_md.table_name,
+            )
+
+        sql = """
+        {require_partitioned}
+        CREATE TABLE IF NOT EXISTS {schema}.{master_table} (LIKE {schema}.{delta_table}) {partition_clause};
+        {default_partition}
+        {partitions}
+        """
+        if strategy != "partition_replace":
+            sql += """CREATE INDEX IF NOT EXISTS {master_table}_{delta_key}_idx ON {schema}.{master_table} ({delta_key});
+        ANALYZE {schema}.{delta_table};
+        DELETE FROM {schema}.{master_table} WHERE {delta_key}
+        IN (SELECT {delta_key} FROM {schema}.{delta_table});
+        """
+        sql += """INSERT INTO {schema}.{master_table} SELECT * FROM {schema}.{delta_table};
+        """
+        return sql.format(
             schema=self.table_md.schema_name,
             master_table=self.table_md.delta_params["master_table"],
             delta_key=self.table_md.delta_params["delta_key"],
             delta_table=self.table_md.table_name,
+            partition_clause=self.partition_clause(),
+            require_partitioned=self.require_partitioned_query(self.table_md.delta_params["master_table"]),
+            default_partition=self.create_default_partition_query(
+                self.table_md.delta_params["master_table"]
+            ),
+            partitions=self.create_partitions_query(
+                replace=strategy == "partition_replace"
+            ),
+        )
+
+    def __deduplicated_delta(self) -> str:
+        """Delta rows with one row per key, the latest one when the table has a filter_key"""
+        order_by = [self.table_md.delta_params["delta_key"]]
+        if self.table_md.filter_key:
+            order_by.append(f"{self.table_md.filter_key} DESC")
+        return "SELECT DISTINCT ON ({delta_key}) * FROM {schema}.{delta_table} ORDER BY {order_by}".format(
+            delta_key=self.table_md.delta_params["delta_key"],
+            schema=self.table_md.schema_name,
+            delta_table=self.table_md.table_name,
+            order_by=", ".join(order_by),
+        )
+
+    def __upsert_prelude(self) -> str:
+        return """
+        CREATE TABLE IF NOT EXISTS {schema}.{master_table} (LIKE {schema}.{delta_table});
+        CREATE UNIQUE INDEX IF NOT EXISTS {master_table}_{delta_key}_uidx ON {schema}.{master_table} ({delta_key});
+        """.format(
+            schema=self.table_md.schema_name,
+            master_table=self.table_md.delta_params["master_table"],
+            delta_key=self.table_md.delta_params["delta_key"],
+            delta_table=self.table_md.table_name,
+        )
+
+    def __on_conflict_query(self) -> str:
+        delta_key = self.table_md.delta_params["delta_key"]
+        columns = [col.get("name") for col in self.table_md.columns]
+        updates = [f"{col} = EXCLUDED.{col}" for col in columns if col != delta_key]
+        action = "DO UPDATE SET " + ", ".join(updates) if updates else "DO NOTHING"
+        return self.__upsert_prelude() + """INSERT INTO {schema}.{master_table} ({columns})
+        SELECT {columns} FROM ({delta}) AS delta
+        ON CONFLICT ({delta_key}) {action};
+        """.format(
+            schema=self.table_md.schema_name,
+            master_table=self.table_md.delta_params["master_table"],
+            columns=",".join(columns),
+            delta=self.__deduplicated_delta(),
+            delta_key=delta_key,
+            action=action,
+        )
+
+    def __merge_query(self) -> str:
+        delta_key = self.table_md.delta_params["delta_key"]
+        columns = [col.get("name") for col in self.table_md.columns]
+        updates = [f"{col} = delta.{col}" for col in columns if col != delta_key]
+        matched = (
+            "WHEN MATCHED THEN UPDATE SET " + ", ".join(updates) + "\n        "
+            if updates
+            else ""
+        )
+        return self.__upsert_prelude() + """MERGE INTO {schema}.{master_table} AS master
+        USING ({delta}) AS delta ON master.{delta_key} = delta.{delta_key}
+        {matched}WHEN NOT MATCHED THEN INSERT ({columns}) VALUES ({values});
+        """.format(
+            schema=self.table_md.schema_name,
+            master_table=self.table_md.delta_params["master_table"],
+            delta=self.__deduplicated_delta(),
+            delta_key=delta_key,
+            matched=matched,
+            columns=",".join(columns),
+            values=",".join(f"delta.{col}" for col in columns),
         )
@@ -0,0 +1,87 @@
+import pytest
+from datetime import datetime
+from os.path import join
+from benchmarks.datagen import DataGenerator, generate_dataset
+from json_stream import iter_json_records
+from tests.mocks import get_mock_table_md
+
+
+pytestmark = pytest.mark.unittests
+
+
+def write_table_mds(directory):
+    with open(join(directory, "raw_events.yaml"), "w") as f:
+        f.write(
+            """
+            table_name: raw_events_delta
+            load_prefix: events
+            schema: staging
+            delimiter: ","
+            filter_key: received_at
+            columns:
+              - {name: id, type: varchar, length: 300}
+              - {name: username, type: varchar, length: 100}
+              - {name: user_email, type: varchar, length: 100}
+              - {name: organization_name, type: varchar, length: 100}
+              - {name: received_at, type: timestamp}
+            """
+        )
+    with open(join(directory, "raw_orgs.yaml"), "w") as f:
+        f.write(
+            """
+            table_name: raw_orgs
+            load_prefix: orgs
+            schema: staging
+            delimiter: ","
+            columns:
+              - {name: organization_key, type: varchar, length: 300}
+              - {name: organization_name, type: varchar, length: 100}
+              - {name: created_at, type: timestamp}
+            """
+        )
+
+
+def test_records_are_reproducible():
+    table_md = get_mock_table_md()
+    first = list(DataGenerator(seed=1).records(table_md, 10))
+    assert first == list(DataGenerator(seed=1).records(table_md, 10))
+    assert first != list(DataGenerator(seed=2).records(table_md, 10))
+    assert [list(record) for record in first] == [["id", "event_type", "event_ts"]] * 10
+
+
+def test_timestamps_within_date_range():
+    generator = DataGenerator(start_date="2020-12-01", days=2)
+    for record in generator.records(get_mock_table_md(), 100):
+        ts = datetime.fromisoformat(record["event_ts"])
+        assert datetime(2020, 12, 1) <= ts < datetime(2020, 12, 3)
+
+
+def test_duplicate_ratio():
+    generator = DataGenerator(duplicate_ratio=0.5)
+    ids = [record["id"] for record in generator.records(get_mock_table_md(), 1000)]
+    assert 300 < len(set(ids)) < 700
+    ids = [record["id"] for record in DataGenerator().records(get_mock_table_md(), 1000)]
+    assert len(set(ids)) == 1000
+
+
+def test_generate_dataset(tmp_path):
+    tables_md_dir = tmp_path / "table_metadata"
+    tables_md_dir.mkdir()
+    write_table_mds(str(tables_md_dir))
+
+    paths = generate_dataset(
+        tables_md_dir=str(tables_md_dir),
+        raw_data_dir=str(tmp_path / "raw_data"),
+        rows=10,
+        files=3,
+        generator=DataGenerator(n_orgs=5),
+    )
+
+    events = [list(iter_json_records(path)) for path in paths["events"]]
+    assert [len(records) for records in events] == [4, 3, 3]
+    orgs = list(iter_json_records(paths["orgs"][0]))
+    org_names = {org["organization_name"] for org in orgs}
+    assert len(org_names) == 5
+    for record in sum(events, []):
+        assert record["organization_name"] in org_names
+        assert record["user_email"] == record["username"] + "@example.com"
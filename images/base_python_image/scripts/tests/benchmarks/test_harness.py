@@ -0,0 +1,58 @@
+import pytest
+import json
+from benchmarks.harness import Benchmark, compare, percentiles
+from benchmarks.main import stages_to_run
+
+
+pytestmark = pytest.mark.unittests
+
+
+def test_percentiles():
+    assert percentiles([]) == {}
+    assert percentiles([i / 1000 for i in range(1, 101)]) == {
+        "p50": 51.0,
+        "p95": 96.0,
+        "p99": 100.0,
+        "max": 100.0,
+    }
+
+
+def test_measure_and_save(tmp_path):
+    bench = Benchmark(params={"rows": 3})
+    with bench.measure("stage") as stage:
+        for _ in range(3):
+            with stage.unit():
+                pass
+        stage.rows = 3
+
+    path = str(tmp_path / "results" / "run.json")
+    bench.save(path)
+    with open(path) as f:
+        results = json.load(f)
+    assert results["params"] == {"rows": 3}
+    result = results["stages"]["stage"]
+    assert result["rows"] == 3
+    assert result["rows_per_sec"] > 0
+    assert result["peak_rss_mb"] > 0
+    assert set(result["latency_ms"]) == {"p50", "p95", "p99", "max"}
+
+
+def test_compare():
+    def results(rows_per_sec, peak_rss_mb):
+        return {"stages": {"load": {"rows_per_sec": rows_per_sec, "peak_rss_mb": peak_rss_mb}}}
+
+    assert compare(results(100, 50), results(95, 54)) == []
+    assert compare(results(100, 50), results(80, 50)) == ["load: 80 rows/s, was 100 rows/s"]
+    assert compare(results(100, 50), results(100, 60)) == ["load: peak RSS 60 MB, was 50 MB"]
+    # stages missing from the baseline are not compared
+    assert compare({"stages": {}}, results(1, 1000)) == []
+
+
+def test_stages_to_run():
+    assert stages_to_run(["fact_events"]) == {
+        "extract_data",
+        "copy_expert",
+        "upsert_on_id",
+        "fact_events",
+    }
+    assert stages_to_run(["consumer_batch"]) == {"watcher", "consumer_batch"}
@@ -0,0 +1,20 @@
+import pytest
+from benchmarks.imports import ENTRY_POINTS, main, measure
+
+
+pytestmark = pytest.mark.unittests
+
+
+def test_entry_points_load_what_they_use():
+    consumer = measure(ENTRY_POINTS["consumer"], repeat=1)
+    assert consumer["import_ms"] > 0
+    assert not {"pandas", "pyarrow", "watchdog", "pyfiglet"} & set(consumer["loaded"])
+    assert not {"pandas", "psycopg2", "yaml"} & set(measure(ENTRY_POINTS["producer"], repeat=1)["loaded"])
+    assert not {"pandas", "pyfiglet", "termcolor"} & set(measure(ENTRY_POINTS["cli"], repeat=1)["loaded"])
+    assert measure(ENTRY_POINTS["queue-cli"], repeat=1)["loaded"] == []
+
+
+def test_budget(capsys):
+    assert main(["--entry-points", "queue-cli", "--repeat", "1", "--budget-ms", "0"]) == 1
+    assert "over the 0.0 ms budget: queue-cli" in capsys.readouterr().out
+    assert main(["--entry-points", "queue-cli", "--repeat", "1"]) == 0
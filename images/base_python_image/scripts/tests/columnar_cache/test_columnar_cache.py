@@ -0,0 +1,133 @@
+import pytest
+import json
+from concurrent.futures import ThreadPoolExecutor
+from columnar_cache import ColumnarCache
+from file_op import extract_data, stream_data
+from os.path import join
+from tempfile import TemporaryDirectory
+from tests.mocks import get_mock_json, get_mock_table_md
+
+pytestmark = pytest.mark.unittests
+
+# the cache is optional, so is pyarrow
+pytest.importorskip("pyarrow")
+
+COLUMNS = ["id", "event_type", "event_ts"]
+
+
+@pytest.fixture
+def tmpdir():
+    with TemporaryDirectory(dir="/tmp") as tmpdir:
+        with open(join(tmpdir, "events.json"), "w") as f:
+            f.write(get_mock_json())
+        yield tmpdir
+
+
+def test_read(tmpdir, mocker):
+    cache = ColumnarCache(cache_dir=join(tmpdir, "cache"))
+    src_path = join(tmpdir, "events.json")
+    df = cache.read(src_path, ["event_ts", "id"])
+    assert df.to_dict("records") == [
+        {"event_ts": "2020-12-08 20:03:16.759617", "id": "foo"},
+        {"event_ts": "2014-12-08 20:03:16.759617", "id": "bar"},
+    ]
+    # a second read comes from the cache, another column set gets its own entry
+    parse = mocker.spy(ColumnarCache, "_ColumnarCache__write")
+    cache.read(src_path, ["event_ts", "id"])
+    assert parse.call_count == 0
+    cache.read(src_path, COLUMNS)
+    assert parse.call_count == 1
+    assert len(cache.entries()) == 2
+
+
+def test_changed_file_is_parsed_again(tmpdir):
+    cache = ColumnarCache(cache_dir=join(tmpdir, "cache"))
+    src_path = join(tmpdir, "events.json")
+    cache.read(src_path, COLUMNS)
+    with open(src_path, "w") as f:
+        json.dump([{"id": "baz", "event_type": "deleted"}], f)
+    df = cache.read(src_path, COLUMNS)
+    assert df[["id", "event_type"]].to_dict("records") == [
+        {"id": "baz", "event_type": "deleted"}
+    ]
+    assert df["event_ts"].isna().all()
+
+
+def test_evict(tmpdir):
+    cache = ColumnarCache(cache_dir=join(tmpdir, "cache"))
+    src_path = join(tmpdir, "events.json")
+    cache.read(src_path, ["id"])
+    cache.read(src_path, COLUMNS)
+    # only the most recently used entry fits
+    cache.max_bytes = cache.size() - 1
+    cache.read(src_path, ["id"])
+    cache.evict()
+    assert cache.entries() == [cache.entry_path(src_path, ["id"])]
+    cache.clear()
+    assert cache.entries() == []
+
+
+def test_entry_larger_than_the_cache(tmpdir):
+    """The entry being read is never evicted, it is only dropped once another entry is written"""
+    cache = ColumnarCache(cache_dir=join(tmpdir, "cache"), max_bytes=10)
+    src_path = join(tmpdir, "events.json")
+    assert cache.read(src_path, COLUMNS)["id"].tolist() == ["foo", "bar"]
+    assert cache.entries() == [cache.entry_path(src_path, COLUMNS)]
+    cache.read(src_path, ["id"])
+    assert cache.entries() == [cache.entry_path(src_path, ["id"])]
+
+
+def test_read_batches(tmpdir, mocker):
+    mocker.patch("columnar_cache.BATCH_SIZE", 1)
+    cache = ColumnarCache(cache_dir=join(tmpdir, "cache"))
+    batches = list(cache.read_batches(join(tmpdir, "events.json"), ["id", "event_type"]))
+    assert [df.to_dict("records") for df in batches] == [
+        [{"id": "foo", "event_type": "created"}],
+        [{"id": "bar", "event_type": "created"}],
+    ]
+
+
+def test_concurrent_source_hashes(tmpdir):
+    """Loaders sharing the cache hash their files at the same time without losing the hashes of the others"""
+    paths = []
+    for i in range(8):
+        paths.append(join(tmpdir, f"events_{i}.json"))
+        with open(paths[-1], "w") as f:
+            json.dump([{"id": str(i)}], f)
+    cache = ColumnarCache(cache_dir=join(tmpdir, "cache"))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda path: cache.entry_path(path, COLUMNS), paths))
+    with open(join(tmpdir, "cache", "hashes.json"), "r") as f:
+        assert sorted(json.load(f)) == sorted(paths)
+
+
+@pytest.mark.parametrize("date_filter_val", [None, "2020-12-08"])
+def test_extract_data_from_cache(tmpdir, date_filter_val):
+    """Reading from the cache produces the same CSV as parsing the file with pandas"""
+    src_path = join(tmpdir, "events.json")
+    outputs = []
+    for cache in [None, ColumnarCache(cache_dir=join(tmpdir, "cache"))]:
+        dst_path = join(tmpdir, f"output_{len(outputs)}.csv")
+        extract_data(
+            src_path=src_path,
+            dst_path=dst_path,
+            date_filter_key="event_ts",
+            date_filter_val=date_filter_val,
+            columns=COLUMNS,
+            cache=cache,
+        )
+        with open(dst_path, "r") as f:
+            outputs.append(f.read())
+    assert outputs[0] == outputs[1]
+
+
+def test_stream_data_from_cache(tmpdir):
+    src_path = join(tmpdir, "events.json")
+    with open(src_path, "w") as f:
+        json.dump([{"id": "foo", "event_type": "created"}], f)
+    stream = stream_data(
+        src_path=src_path,
+        table_md=get_mock_table_md(),
+        cache=ColumnarCache(cache_dir=join(tmpdir, "cache")),
+    )
+    assert stream.read() == "id,event_type,event_ts\nfoo,created,\n"
@@ -0,0 +1,244 @@
+import pytest
+import json
+import threading
+import pandas as pd
+from datetime import datetime
+from dedupe import BloomFilter, Deduper, dedupe_key
+from file_op import extract_data
+from os.path import dirname, join
+from queue_implementation.consumer import Consumer
+from queue_implementation.producer import Producer
+from queue_implementation.transport import InMemoryBroker, InMemoryTransport
+from tempfile import TemporaryDirectory
+from tests.mocks import get_mock_json, get_mock_table_md
+from unittest import mock
+
+pytestmark = pytest.mark.unittests
+
+TEST_QUEUE = "test_queue"
+RAW_DATA_DIR = join(dirname(dirname(dirname(dirname(__file__)))), "raw_data")
+
+
+def mock_pg_hook(loaded=(), staged=()):
+    """
+    Hook of a table holding the loaded keys and of its staging table (test.test_table_delta) holding the staged
+    keys, tuples of the key columns or values of single column keys
+    """
+    pg_hook = mock.MagicMock()
+    cur = pg_hook.session.return_value.__enter__.return_value
+    cur.fetchone.return_value = ("test.test_table",)
+    rows = [key if isinstance(key, tuple) else (key,) for key in loaded]
+    staged_rows = [key if isinstance(key, tuple) else (key,) for key in staged]
+
+    def execute(query, params=None):
+        if "ANY" in query:
+            table_rows = staged_rows if "test.test_table_delta " in query else rows
+            cur.fetchall.return_value = [row for row in table_rows if row[0] in params[0]]
+
+    cur.execute.side_effect = execute
+    seed_cur = pg_hook.connection.return_value.__enter__.return_value.cursor.return_value.__enter__.return_value
+    seed_cur.fetchone.return_value = ("test.test_table",)
+    seed_cur.__iter__.return_value = rows
+    return pg_hook
+
+
+def lookups(pg_hook):
+    """Keys looked up in the table, by query"""
+    return [
+        call[0][1][0]
+        for call in pg_hook.session.return_value.__enter__.return_value.execute.call_args_list
+        if "ANY" in call[0][0]
+    ]
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(capacity=10000, error_rate=0.01)
+    for i in range(10000):
+        bloom.add(f"id_{i}")
+    assert all(f"id_{i}" in bloom for i in range(10000))
+    false_positives = sum(f"other_{i}" in bloom for i in range(10000))
+    assert false_positives / 10000 < 0.02
+    # about 1.2 bytes per key at 1%
+    assert len(bloom.bits) == 11982
+    with pytest.raises(ValueError):
+        BloomFilter(capacity=0)
+
+
+def test_bloom_filter_snapshot():
+    bloom = BloomFilter(capacity=100)
+    bloom.add("foo")
+    with TemporaryDirectory(dir="/tmp") as tmpdir:
+        path = join(tmpdir, "test.bloom")
+        bloom.save(path)
+        loaded = BloomFilter.load(path)
+        assert "foo" in loaded and "bar" not in loaded
+        assert (loaded.capacity, loaded.error_rate, loaded.count) == (100, 0.001, 1)
+        with open(path, "wb") as f:
+            f.write(b'{"magic": "other"}\n')
+        with pytest.raises(ValueError):
+            BloomFilter.load(path)
+
+
+def test_deduper_drops_loaded_keys():
+    """Only the keys reported by the filter are looked up, missing keys are always loaded"""
+    pg_hook = mock_pg_hook(loaded={"foo", "bar"})
+    deduper = Deduper(schema="test", table_name="test_table", pg_hook=pg_hook)
+    mask = deduper.keep(["foo", "baz", "baz", None, float("nan"), 1, None])
+    assert mask == [False, True, False, True, True, True, True]
+    assert lookups(pg_hook) == [["foo"]]
+    # the kept keys are duplicates until committed, without looking them up
+    assert deduper.keep(["baz", "1", "bar"]) == [False, False, False]
+    assert lookups(pg_hook) == [["foo"], ["bar"]]
+
+
+def test_deduper_keeps_false_positives():
+    """Keys kept by a load that was not committed are in the filter, but not in the table"""
+    pg_hook = mock_pg_hook()
+    deduper = Deduper(schema="test", table_name="test_table", pg_hook=pg_hook)
+    assert deduper.keep(["foo"]) == [True]
+    deduper.commit()
+    assert deduper.keep(["foo"]) == [True]
+    assert lookups(pg_hook) == [["foo"]]
+
+
+def test_deduper_looks_staged_keys_up():
+    """The keys of the files loaded into the delta table are looked up there instead of being held in memory"""
+    pg_hook = mock_pg_hook(staged={"foo"})
+    deduper = Deduper(schema="test", table_name="test_table", staging_table="test_table_delta", pg_hook=pg_hook)
+    assert deduper.keep(["foo", "bar"]) == [True, True]
+    deduper.stage()
+    assert not deduper.pending
+    # bar was not staged: the load holding it failed
+    assert deduper.keep(["foo", "bar"]) == [False, True]
+    queries = [call[0][0] for call in pg_hook.session.return_value.__enter__.return_value.execute.call_args_list]
+    assert [query.split(" FROM ")[1].split()[0] for query in queries if "ANY" in query] == [
+        "test.test_table",
+        "test.test_table_delta",
+    ]
+    # once upserted, only the table is looked up again
+    deduper.commit()
+    deduper.keep(["foo"])
+    assert "test.test_table_delta" not in pg_hook.session.return_value.__enter__.return_value.execute.call_args[0][0]
+    with pytest.raises(ValueError):
+        Deduper(schema="test", table_name="test_table", pg_hook=pg_hook).stage()
+
+
+def test_deduper_of_missing_table():
+    pg_hook = mock_pg_hook()
+    seed_cur = pg_hook.connection.return_value.__enter__.return_value.cursor.return_value.__enter__.return_value
+    seed_cur.fetchone.return_value = (None,)
+    deduper = Deduper(schema="test", table_name="test_table", pg_hook=pg_hook)
+    assert deduper.keep(["foo", "foo"]) == [True, False]
+    assert seed_cur.execute.call_count == 1
+
+
+def test_deduper_restarts_from_snapshot_and_journal():
+    with TemporaryDirectory(dir="/tmp") as tmpdir:
+        snapshot_path = join(tmpdir, "dedupe", "test.bloom")
+        deduper = Deduper(
+            schema="test", table_name="test_table", snapshot_path=snapshot_path, pg_hook=mock_pg_hook({"foo"})
+        )
+        assert deduper.keep(["foo", "bar"]) == [False, True]
+        deduper.commit()
+        # not closed, as if the process crashed: bar is only in the journal
+        pg_hook = mock_pg_hook({"foo", "bar"})
+        restarted = Deduper(schema="test", table_name="test_table", snapshot_path=snapshot_path, pg_hook=pg_hook)
+        assert restarted.keep(["bar", "baz"]) == [False, True]
+        assert not pg_hook.connection.called
+        assert restarted.bloom.count == 3
+        restarted.close()
+        with open(snapshot_path + ".journal", "r") as f:
+            assert f.read() == ""
+
+        # a filter sized differently is seeded from the table again
+        resized = Deduper(
+            schema="test", table_name="test_table", capacity=10, snapshot_path=snapshot_path, pg_hook=pg_hook
+        )
+        resized.keep(["foo"])
+        assert pg_hook.connection.called
+        assert BloomFilter.load(snapshot_path).capacity == 10
+
+
+def test_deduper_composite_key():
+    """Events of a user share its id, only the events having the same id, type and time are duplicates"""
+    created = ("user", "User Created", "2020-12-08 20:03:16.759617")
+    pg_hook = mock_pg_hook({created})
+    deduper = Deduper(schema="test", table_name="test_table", pg_hook=pg_hook)
+    assert deduper.columns == ["id", "event_type", "received_at"]
+    mask = deduper.keep(
+        [
+            ("user", "User Created", datetime(2020, 12, 8, 20, 3, 16, 759617)),
+            ("user", "User Updated", "2020-12-08 20:03:16.759617"),
+            ("user", "User Deleted", "2020-12-09 20:03:16.759617"),
+            ("user", "User Deleted", "2020-12-09 20:03:16.759617"),
+            ("user", "User Deleted", None),
+        ]
+    )
+    assert mask == [False, True, True, False, True]
+    # the rows of the id are looked up and told apart by the other columns
+    assert lookups(pg_hook) == [["user"]]
+    query = pg_hook.session.return_value.__enter__.return_value.execute.call_args[0][0]
+    assert "SELECT id::text, event_type::text, received_at::text FROM test.test_table WHERE id::text = ANY" in query
+
+
+def test_dedupe_key():
+    assert dedupe_key(("foo",)) == "foo"
+    assert dedupe_key((1, datetime(2020, 12, 8, 20, 3, 16, 500000))) == '["1", "2020-12-08 20:03:16.5"]'
+    assert dedupe_key((1, datetime(2020, 12, 8, 20, 3, 16))) == '["1", "2020-12-08 20:03:16"]'
+    assert dedupe_key(("foo", float("nan"))) is None
+
+
+def test_extract_data_keeps_events_of_a_user():
+    """The events of the sample share the ids of their users, only the event sent twice is dropped"""
+    events_path = join(RAW_DATA_DIR, "events", "events_sample.json")
+    with open(events_path, "r") as f:
+        events = json.load(f)
+    deduper = Deduper(schema="test", table_name="test_table", pg_hook=mock_pg_hook())
+    with TemporaryDirectory(dir="/tmp") as tmpdir:
+        extract_data(
+            src_path=events_path, dst_path=join(tmpdir, "events"), columns=list(events[0]), deduper=deduper
+        )
+        loaded = pd.read_csv(join(tmpdir, "events"))
+
+    assert len(events) == 36 and len(loaded) == 35
+    assert loaded["id"].nunique() == len({event["id"] for event in events})
+    assert len(loaded.drop_duplicates(["id", "event_type", "received_at"])) == 35
+
+
+def test_deduper_iter_rows():
+    deduper = Deduper(schema="test", table_name="test_table", pg_hook=mock_pg_hook({"foo"}))
+    rows = [("foo", 1), ("bar", 2), ("bar", 3), ("baz", 4)]
+    assert list(deduper.iter_rows(iter(rows), key_indexes=[0], batch_size=2)) == [("bar", 2), ("baz", 4)]
+
+
+@mock.patch("queue_implementation.consumer.PgHook")
+def test_consumer_drops_duplicates(pg_hook):
+    """Redelivered events never reach the table, messages holding only duplicates are acknowledged"""
+    broker = InMemoryBroker()
+    producer = Producer(host="", queue=TEST_QUEUE, transport=InMemoryTransport(broker))
+    events = json.loads(get_mock_json())
+    for event in events + events[1:]:
+        producer.publish_event(msg=json.dumps(event))
+    consumer = Consumer(
+        host="",
+        queue=TEST_QUEUE,
+        table_md=get_mock_table_md(),
+        batch_size=10,
+        max_linger=0.01,
+        transport=InMemoryTransport(broker),
+        deduper=Deduper(
+            schema="test",
+            table_name="test_table",
+            key=["id", "event_type", "event_ts"],
+            pg_hook=mock_pg_hook({("foo", "created", "2020-12-08 20:03:16.759617")}),
+        ),
+    )
+    thread = threading.Thread(target=consumer.batch_load_to_pgres)
+    thread.start()
+    assert broker.wait_idle(timeout=5)
+    consumer.stop()
+    thread.join(timeout=5)
+
+    stream = pg_hook.return_value.copy_stream.call_args[1]["stream"]
+    assert [row[0] for row in stream.rows] == ["bar"]
+    assert not consumer.deduper.pending
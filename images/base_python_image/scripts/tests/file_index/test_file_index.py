@@ -0,0 +1,95 @@
+import pytest
+import json
+from datetime import datetime
+from file_index import FileIndex, LoadWindow, get_index, record_days
+from os import utime
+from os.path import exists, join
+from tempfile import TemporaryDirectory
+
+pytestmark = pytest.mark.unittests
+
+RECORDS = [
+    {"id": "a", "event_ts": "2020-12-08 10:00:00"},
+    {"id": "b", "event_ts": "2020-12-08 23:00:00"},
+    {"id": "c", "event_ts": "2020-12-09 00:00:00"},
+    {"id": "d", "event_ts": "2020-12-10 08:00:00"},
+    {"id": "e"},
+    {"id": "f", "event_ts": "2020-12-08 12:00:00"},
+]
+
+
+@pytest.fixture
+def src_path():
+    with TemporaryDirectory(dir="/tmp") as tmpdir:
+        path = join(tmpdir, "events.json")
+        with open(path, "w") as f:
+            json.dump(RECORDS, f, indent=2)
+        yield path
+
+
+def test_record_days():
+    """A value at midnight matches the date filter of the day before as well"""
+    assert record_days("2020-12-08 10:00:00") == ["2020-12-08"]
+    assert record_days("2020-12-09 00:00:00") == ["2020-12-09", "2020-12-08"]
+
+
+def test_build_index(src_path):
+    index = FileIndex.build(src_path, "event_ts")
+    assert (index.min, index.max) == ("2020-12-08 10:00:00", "2020-12-10 08:00:00")
+    assert sorted(index.days) == ["2020-12-08", "2020-12-09", "2020-12-10"]
+    # consecutive records of a day are a single region
+    assert len(index.days["2020-12-08"]) == 2
+    assert len(index.days["2020-12-09"]) == 1
+
+
+@pytest.mark.parametrize(
+    "date_filter_val, expected",
+    [
+        ("2020-12-08", ["a", "b", "c", "f"]),
+        ("2020-12-09", ["c"]),
+        ("2020-12-10", ["d"]),
+        ("2020-12-11", []),
+    ],
+)
+def test_iter_records(src_path, date_filter_val, expected):
+    index = get_index(src_path, "event_ts")
+    assert index.may_contain(date_filter_val) is bool(expected)
+    assert [r["id"] for r in index.iter_records(date_filter_val)] == expected
+
+
+@pytest.mark.parametrize(
+    "window, expected",
+    [
+        (LoadWindow(start=datetime(2020, 12, 8, 20)), ["a", "b", "c", "d", "f"]),
+        (LoadWindow(start=datetime(2020, 12, 9, 12)), ["c", "d"]),
+        (LoadWindow.for_dates("2020-12-08", "2020-12-09"), ["a", "b", "c", "d", "f"]),
+        (LoadWindow(end=datetime(2020, 12, 8)), []),
+        (LoadWindow(), ["a", "b", "c", "d", "f"]),
+    ],
+)
+def test_iter_records_window(src_path, window, expected):
+    """Records of every day overlapping the window (bounds included) are parsed once each, midnight records too"""
+    index = get_index(src_path, "event_ts")
+    assert index.may_contain(window) is bool(expected)
+    assert [r["id"] for r in index.iter_records(window)] == expected
+
+
+def test_index_is_saved_and_invalidated(src_path, mocker):
+    index = get_index(src_path, "event_ts")
+    assert exists(src_path + ".idx")
+    build = mocker.spy(FileIndex, "build")
+    assert get_index(src_path, "event_ts") == index
+    # another key or a modified file require a new index
+    get_index(src_path, "received_at")
+    utime(src_path, (0, 0))
+    get_index(src_path, "event_ts")
+    assert build.call_count == 2
+
+
+def test_scattered_days_are_not_recorded(src_path, mocker):
+    mocker.patch("file_index.MAX_REGIONS", 1)
+    index = FileIndex.build(src_path, "event_ts")
+    assert index.days["2020-12-08"] is None
+    assert [r["id"] for r in index.iter_records("2020-12-10")] == [
+        r["id"] for r in RECORDS
+    ]
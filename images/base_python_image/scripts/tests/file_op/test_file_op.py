@@ -1,8 +1,28 @@
 import pytest
-from file_op import extract_data
+import json
+from file_op import (
+    chunk_rows_for_budget,
+    extract_data,
+    import_sources,
+    iter_json_records,
+    load_files_parallel,
+    load_file,
+    load_files_with_manifest,
+    stream_data,
+)
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from os import mkdir
 from os.path import join
+from manifest import LOADED, LoadManifest
+from pgcopy import HEADER, TRAILER, row_encoder
+from psql_client import PgHook
+from rollup import Rollup
+from sql_gen import SQLGenerator
 from tempfile import NamedTemporaryFile, TemporaryDirectory
-from tests.mocks import get_mock_json
+from file_index import LoadWindow
+from tests.mocks import get_mock_json, get_mock_table_md, get_mock_table_md_yaml
+from unittest import mock
 
 pytestmark = pytest.mark.unittests
 
@@ -49,3 +69,472 @@ def test_extract_data_filter():
             with open(outputfile, "r") as f:
                 data = f.readlines()
                 assert expected == data
+
+
+@pytest.mark.parametrize("chunk_rows", [1, 2, 1000])
+@pytest.mark.parametrize(
+    "date_filter_val, expected",
+    [
+        (
+            None,
+            "id,event_type,event_ts\n"
+            "foo,created,2020-12-08 20:03:16.759617\n"
+            "bar,created,2014-12-08 20:03:16.759617\n",
+        ),
+        (
+            "2020-12-08",
+            "id,event_type,event_ts\nfoo,created,2020-12-08 20:03:16.759617\n",
+        ),
+    ],
+)
+def test_extract_data_chunked(chunk_rows, date_filter_val, expected):
+    """The chunked mode writes the same CSV whatever the size of the chunks, header included once"""
+    with NamedTemporaryFile() as inputfile:
+        inputfile.write(get_mock_json().encode("utf-8"))
+        inputfile.flush()
+        with TemporaryDirectory(dir="/tmp") as tmpdir:
+            outputfile = join(tmpdir, "test")
+            extract_data(
+                src_path=inputfile.name,
+                dst_path=outputfile,
+                date_filter_key="event_ts",
+                date_filter_val=date_filter_val,
+                columns=["id", "event_type", "event_ts"],
+                chunk_rows=chunk_rows,
+            )
+            with open(outputfile, "r") as f:
+                assert f.read() == expected
+
+
+def mock_deduper(loaded=("foo",)):
+    deduper = mock.Mock(columns=["id"])
+    deduper.keep.side_effect = lambda keys: [key[0] not in loaded for key in keys]
+    return deduper
+
+
+@pytest.mark.parametrize("chunk_rows", [None, 1])
+def test_extract_data_dedupe(chunk_rows):
+    """Rows are deduplicated after the date filter, only the rows to load reach the deduper"""
+    deduper = mock_deduper()
+    with NamedTemporaryFile() as inputfile:
+        inputfile.write(get_mock_json().encode("utf-8"))
+        inputfile.flush()
+        with TemporaryDirectory(dir="/tmp") as tmpdir:
+            outputfile = join(tmpdir, "test")
+            extract_data(
+                src_path=inputfile.name,
+                dst_path=outputfile,
+                columns=["id", "event_type", "event_ts"],
+                chunk_rows=chunk_rows,
+                deduper=deduper,
+            )
+            with open(outputfile, "r") as f:
+                assert f.read() == (
+                    "id,event_type,event_ts\n"
+                    "bar,created,2014-12-08 20:03:16.759617\n"
+                )
+            extract_data(
+                src_path=inputfile.name,
+                dst_path=outputfile,
+                date_filter_key="event_ts",
+                date_filter_val="2014-12-08",
+                columns=["id", "event_type", "event_ts"],
+                chunk_rows=chunk_rows,
+                deduper=deduper,
+            )
+    assert deduper.keep.call_args[0][0] == [("bar",)]
+
+
+def test_chunk_rows_for_budget():
+    records = [{"id": str(i), "event_type": "created" * 10} for i in range(100)]
+    with NamedTemporaryFile() as inputfile:
+        inputfile.write(json.dumps(records).encode("utf-8"))
+        inputfile.flush()
+        small = chunk_rows_for_budget(inputfile.name, memory_budget=10000)
+        large = chunk_rows_for_budget(inputfile.name, memory_budget=1000000)
+        assert chunk_rows_for_budget(inputfile.name, memory_budget=1) == 1
+    assert 1 < small < 100
+    assert large == pytest.approx(small * 100, rel=0.01)
+
+
+#########################
+### streaming tests
+##########
+@pytest.mark.parametrize("read_size", [1, 7, 1 << 16])
+def test_iter_json_records(read_size):
+    """The streaming parser must yield the same objects as json.loads regardless of how the file is windowed"""
+    with NamedTemporaryFile() as inputfile:
+        inputfile.write(get_mock_json().encode("utf-8"))
+        inputfile.flush()
+        records = list(iter_json_records(inputfile.name, read_size=read_size))
+    assert records == json.loads(get_mock_json())
+
+
+def test_iter_json_records_single_object():
+    with NamedTemporaryFile() as inputfile:
+        inputfile.write(b'{"id": "foo", "event_type": "created"}')
+        inputfile.flush()
+        records = list(iter_json_records(inputfile.name, read_size=4))
+    assert records == [{"id": "foo", "event_type": "created"}]
+
+
+@pytest.mark.parametrize("read_size", [1, 7, 1 << 16])
+def test_iter_json_records_offsets(read_size):
+    """Reported byte offsets delimit every record, also with multi-byte characters, and parsing can resume from
+    them"""
+    records = [{"id": "f\u00f6\u00f6", "n": i} for i in range(5)]
+    with NamedTemporaryFile() as inputfile:
+        inputfile.write(json.dumps(records, ensure_ascii=False).encode("utf-8"))
+        inputfile.flush()
+        inputfile.seek(0)
+        content = inputfile.read()
+        offsets = list(
+            iter_json_records(inputfile.name, read_size=read_size, with_offsets=True)
+        )
+        assert [json.loads(content[start:end]) for _, start, end in offsets] == records
+        region = iter_json_records(
+            inputfile.name, read_size=read_size, start=offsets[1][1], end=offsets[3][2]
+        )
+        assert list(region) == records[1:4]
+
+
+@pytest.mark.parametrize(
+    "date_filter_val, expected",
+    [
+        (
+            None,
+            "id,event_type,event_ts\n"
+            "foo,created,2020-12-08 20:03:16.759617\n"
+            "bar,created,2014-12-08 20:03:16.759617\n",
+        ),
+        (
+            "2020-12-08",
+            "id,event_type,event_ts\nfoo,created,2020-12-08 20:03:16.759617\n",
+        ),
+    ],
+)
+def test_stream_data(date_filter_val, expected):
+    """stream_data produces the same CSV as extract_data, read in small chunks the way psycopg2 does"""
+    with NamedTemporaryFile() as inputfile:
+        inputfile.write(get_mock_json().encode("utf-8"))
+        inputfile.flush()
+        stream = stream_data(
+            src_path=inputfile.name,
+            table_md=get_mock_table_md(),
+            date_filter_val=date_filter_val,
+        )
+        data = "".join(iter(lambda: stream.read(5), ""))
+    assert data == expected
+
+
+def test_stream_data_binary():
+    """Binary streams hold the same rows, encoded according to the column types"""
+    with NamedTemporaryFile() as inputfile:
+        inputfile.write(get_mock_json().encode("utf-8"))
+        inputfile.flush()
+        stream = stream_data(
+            src_path=inputfile.name,
+            table_md=get_mock_table_md(),
+            date_filter_val="2020-12-08",
+            copy_format="binary",
+        )
+        data = stream.read()
+    encode_row = row_encoder(["varchar", "varchar", "timestamp"])
+    assert data == HEADER + encode_row(json.loads(get_mock_json())[0].values()) + TRAILER
+
+
+#########################
+### import_sources tests
+##########
+@pytest.mark.parametrize("streaming", [False, True])
+def test_import_sources_several_files(mocker, streaming):
+    """Every file of a prefix goes into the same delta table: only the first one recreates it and only the
+    last one upserts into the master table"""
+    load_to_table = mocker.patch("file_op.PgHook.load_to_table")
+    execute = mocker.patch("file_op.PgHook.execute")
+    with TemporaryDirectory(dir="/tmp") as raw_data_dir:
+        mkdir(join(raw_data_dir, "test"))
+        for name in ["a.json", "b.json", "c.json"]:
+            with open(join(raw_data_dir, "test", name), "w") as f:
+                f.write(get_mock_json())
+        with TemporaryDirectory(dir="/tmp") as md_dir:
+            with open(join(md_dir, "test.yaml"), "w") as f:
+                f.write(get_mock_table_md_yaml())
+            import_sources(
+                tables_md_dir=md_dir, raw_data_dir=raw_data_dir, streaming=streaming
+            )
+            assert not execute.called
+            import_sources(
+                tables_md_dir=md_dir, raw_data_dir=raw_data_dir, streaming=streaming, notify_loaded=True
+            )
+
+    calls = [kwargs for _, kwargs in load_to_table.call_args_list]
+    assert [kwargs["create_table"] for kwargs in calls] == [True, False, False] * 2
+    assert [kwargs["upsert"] for kwargs in calls] == [False, False, True] * 2
+    # the master table is notified once loaded
+    execute.assert_called_once_with("SELECT pg_notify('table_loaded', 'test.test_table');")
+
+
+def test_import_sources_prunes_files_by_date(mocker):
+    """Date filtered loads only open the files whose index holds the date"""
+    load_file = mocker.patch("file_op.load_file")
+    execute = mocker.patch("file_op.PgHook.execute")
+    with TemporaryDirectory(dir="/tmp") as raw_data_dir:
+        mkdir(join(raw_data_dir, "test"))
+        for name, day in [("a.json", "2020-12-08"), ("b.json", "2020-12-09")]:
+            with open(join(raw_data_dir, "test", name), "w") as f:
+                json.dump([{"id": name, "event_ts": f"{day} 10:00:00"}], f)
+        with TemporaryDirectory(dir="/tmp") as md_dir:
+            with open(join(md_dir, "test.yaml"), "w") as f:
+                f.write(get_mock_table_md_yaml())
+            import_sources(
+                tables_md_dir=md_dir,
+                raw_data_dir=raw_data_dir,
+                date_filter_val="2020-12-09",
+            )
+
+    (_, kwargs), = load_file.call_args_list
+    assert kwargs["src_file_path"] == join(raw_data_dir, "test", "b.json")
+    # tables are only notified on demand
+    assert not execute.called
+
+
+def test_import_sources_incremental(mocker):
+    """Incremental loads only open the files holding records from the watermark on, then advance it"""
+    load_file = mocker.patch("file_op.load_file")
+    mocker.patch("file_op.PgHook.session")
+    watermarks = mocker.patch("file_op.Watermarks")
+    window = LoadWindow(start=datetime(2020, 12, 9))
+    watermarks.return_value.window.return_value = window
+    with TemporaryDirectory(dir="/tmp") as raw_data_dir:
+        mkdir(join(raw_data_dir, "test"))
+        for name, day in [("a.json", "2020-12-08"), ("b.json", "2020-12-09"), ("c.json", "2020-12-10")]:
+            with open(join(raw_data_dir, "test", name), "w") as f:
+                json.dump([{"id": name, "event_ts": f"{day} 10:00:00"}], f)
+        with TemporaryDirectory(dir="/tmp") as md_dir:
+            with open(join(md_dir, "test.yaml"), "w") as f:
+                f.write(get_mock_table_md_yaml())
+            import_sources(
+                tables_md_dir=md_dir,
+                raw_data_dir=raw_data_dir,
+                incremental=True,
+                lateness=timedelta(hours=1),
+            )
+
+    watermarks.return_value.window.assert_called_once_with("test_table_delta", timedelta(hours=1))
+    calls = [kwargs for _, kwargs in load_file.call_args_list]
+    assert sorted(kwargs["src_file_path"] for kwargs in calls) == [
+        join(raw_data_dir, "test", "b.json"),
+        join(raw_data_dir, "test", "c.json"),
+    ]
+    assert all(kwargs["date_filter_val"] == window for kwargs in calls)
+    watermarks.return_value.advance.assert_called_once()
+
+
+def test_import_sources_dedupe(mocker):
+    """Tables having the key column are deduplicated against their master table, once every file is loaded"""
+    load_file = mocker.patch("file_op.load_file")
+    mocker.patch("file_op.PgHook")
+    deduper = mocker.patch("file_op.Deduper")
+    with TemporaryDirectory(dir="/tmp") as raw_data_dir:
+        mkdir(join(raw_data_dir, "test"))
+        for name in ["a.json", "b.json"]:
+            with open(join(raw_data_dir, "test", name), "w") as f:
+                f.write(get_mock_json())
+        with TemporaryDirectory(dir="/tmp") as md_dir:
+            with open(join(md_dir, "test.yaml"), "w") as f:
+                f.write(get_mock_table_md_yaml())
+            with pytest.raises(ValueError):
+                import_sources(tables_md_dir=md_dir, raw_data_dir=raw_data_dir, workers=2, dedupe_key="id")
+            import_sources(tables_md_dir=md_dir, raw_data_dir=raw_data_dir, dedupe_key="id")
+            import_sources(tables_md_dir=md_dir, raw_data_dir=raw_data_dir, dedupe_key="other")
+
+    assert deduper.call_count == 1
+    assert deduper.call_args[1]["table_name"] == "test_table"
+    assert deduper.call_args[1]["key"] == ["id"]
+    assert deduper.call_args[1]["staging_table"] == "test_table_delta"
+    calls = [kwargs for _, kwargs in load_file.call_args_list]
+    assert [kwargs["deduper"] for kwargs in calls] == [deduper.return_value] * 2 + [None] * 2
+    deduper.return_value.commit.assert_called_once_with()
+
+
+def test_import_sources_rollup(mocker):
+    """Rollups require deduplication and are merged in the transaction upserting the last file"""
+    load_file = mocker.patch("file_op.load_file")
+    mocker.patch("file_op.PgHook")
+    mocker.patch("file_op.Deduper")
+    rollup = Rollup(date_key="event_ts", user_key="id", dimensions=())
+    with TemporaryDirectory(dir="/tmp") as raw_data_dir:
+        mkdir(join(raw_data_dir, "test"))
+        for name in ["a.json", "b.json"]:
+            with open(join(raw_data_dir, "test", name), "w") as f:
+                f.write(get_mock_json())
+        with TemporaryDirectory(dir="/tmp") as md_dir:
+            with open(join(md_dir, "test.yaml"), "w") as f:
+                f.write(get_mock_table_md_yaml())
+            with pytest.raises(ValueError):
+                import_sources(tables_md_dir=md_dir, raw_data_dir=raw_data_dir, rollup=rollup)
+            import_sources(tables_md_dir=md_dir, raw_data_dir=raw_data_dir, dedupe_key="id", rollup=rollup)
+
+    calls = [kwargs for _, kwargs in load_file.call_args_list]
+    assert [kwargs["rollup"] for kwargs in calls] == [rollup] * 2
+    assert [kwargs["after_load"] for kwargs in calls] == [None, rollup.merge]
+    assert [kwargs["upsert"] for kwargs in calls] == [False, True]
+
+
+def test_load_files_parallel(mocker):
+    """The table is recreated once, files are loaded by the executor and the upsert runs once at the end"""
+    execute = mocker.patch("file_op.PgHook.execute")
+    mocker.patch("file_op.PgHook.server_version", return_value=130000)
+    load_to_table = mocker.patch("file_op.PgHook.load_to_table")
+    md = get_mock_table_md()
+    with NamedTemporaryFile() as inputfile:
+        inputfile.write(get_mock_json().encode("utf-8"))
+        inputfile.flush()
+        jobs = [
+            dict(
+                table_md=md,
+                src_file_path=inputfile.name,
+                dst_file_path=None,
+                streaming=True,
+            )
+            for _ in range(3)
+        ]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            load_files_parallel(
+                executor=executor, table_md=md, jobs=jobs, pg_hook=PgHook()
+            )
+
+    assert execute.call_count == 2
+    (recreate_queries,), _ = execute.call_args_list[0]
+    (upsert_query,), _ = execute.call_args_list[1]
+    assert "DROP TABLE" in recreate_queries[0]
+    assert "INSERT INTO" in upsert_query
+    assert load_to_table.call_count == 3
+    for _, kwargs in load_to_table.call_args_list:
+        assert not kwargs["create_table"] and not kwargs["upsert"]
+
+
+def partitioned_table_md(grain="daily"):
+    md = get_mock_table_md()
+    md.table_md["delta_params"] = None
+    md.table_md["partitioning"] = {"grain": grain}
+    return md
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_load_file_creates_partitions(mocker, streaming):
+    """The partitions of the records loaded are created along with the table, only those of the date loaded"""
+    load_to_table = mocker.patch("file_op.PgHook.load_to_table")
+    with TemporaryDirectory(dir="/tmp") as tmpdir:
+        # the partitions are read from the index written next to the file
+        src_path = join(tmpdir, "test.json")
+        with open(src_path, "w") as f:
+            f.write(get_mock_json())
+        for md, date_filter_val in [
+            (partitioned_table_md(), None),
+            (partitioned_table_md(grain="monthly"), "2020-12-08"),
+            (get_mock_table_md(), None),
+        ]:
+            load_file(
+                table_md=md,
+                src_file_path=src_path,
+                dst_file_path=join(tmpdir, "test"),
+                date_filter_val=date_filter_val,
+                streaming=streaming,
+                pg_hook=PgHook(),
+            )
+
+    assert [kwargs["partitions"] for _, kwargs in load_to_table.call_args_list] == [
+        [datetime(2014, 12, 8), datetime(2020, 12, 8)],
+        [datetime(2020, 12, 1)],
+        # the master table of deltas gets its partitions when upserted
+        [],
+    ]
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_load_file_stages_dedupe_keys(mocker, streaming):
+    """The keys of every file of a delta are staged once it is loaded, and committed with the upsert"""
+    mocker.patch("file_op.PgHook.load_to_table")
+    deduper = mock_deduper()
+    deduper.iter_rows.side_effect = lambda rows, key_indexes: rows
+    with TemporaryDirectory(dir="/tmp") as tmpdir:
+        src_path = join(tmpdir, "test.json")
+        with open(src_path, "w") as f:
+            f.write(get_mock_json())
+        for upsert in (False, True):
+            load_file(
+                table_md=get_mock_table_md(),
+                src_file_path=src_path,
+                dst_file_path=join(tmpdir, "test"),
+                streaming=streaming,
+                upsert=upsert,
+                pg_hook=PgHook(),
+                deduper=deduper,
+            )
+            if not upsert:
+                deduper.stage.assert_called_once_with()
+                assert not deduper.commit.called
+    deduper.commit.assert_called_once_with()
+
+
+def test_load_files_parallel_creates_partitions_up_front(mocker):
+    execute = mocker.patch("file_op.PgHook.execute")
+    load_to_table = mocker.patch("file_op.PgHook.load_to_table")
+    md = partitioned_table_md()
+    with TemporaryDirectory(dir="/tmp") as tmpdir:
+        src_path = join(tmpdir, "test.json")
+        with open(src_path, "w") as f:
+            f.write(get_mock_json())
+        jobs = [dict(table_md=md, src_file_path=src_path, dst_file_path=None, streaming=True)] * 2
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            load_files_parallel(executor=executor, table_md=md, jobs=jobs, pg_hook=PgHook())
+
+    (partition_queries,), _ = execute.call_args_list[1]
+    assert partition_queries == [
+        SQLGenerator(md).create_partition_query(datetime(2014, 12, 8)),
+        SQLGenerator(md).create_partition_query(datetime(2020, 12, 8)),
+    ]
+    assert [kwargs["partitions"] for _, kwargs in load_to_table.call_args_list] == [[], []]
+
+
+def test_load_files_with_manifest(mocker):
+    """Only the files planned by the manifest are loaded, each one staged within its own load, and the upsert
+    marks them as loaded and calls after_load"""
+    session = mocker.patch("file_op.PgHook.session")
+    cur = session.return_value.__enter__.return_value
+    load_to_table = mocker.patch("file_op.PgHook.load_to_table")
+    mark_staged = mocker.patch("file_op.LoadManifest.mark_staged")
+    mark_loaded = mocker.patch("file_op.LoadManifest.mark_loaded")
+    md = get_mock_table_md()
+    with TemporaryDirectory(dir="/tmp") as raw_data_dir:
+        paths = []
+        for name in ["a.json", "b.json"]:
+            paths.append(join(raw_data_dir, name))
+            with open(paths[-1], "w") as f:
+                f.write(get_mock_json())
+        loaded = LoadManifest.fingerprint(paths[0])
+        mocker.patch(
+            "file_op.LoadManifest.entries",
+            return_value={paths[0]: (loaded.size, loaded.mtime, loaded.sha256, LOADED)},
+        )
+        jobs = [
+            dict(table_md=md, src_file_path=path, dst_file_path=None, streaming=True)
+            for path in paths
+        ]
+        after_load = mock.MagicMock()
+        load_files_with_manifest(table_md=md, jobs=jobs, pg_hook=PgHook(), after_load=after_load)
+
+    assert load_to_table.call_count == 1
+    _, kwargs = load_to_table.call_args
+    assert not kwargs["create_table"] and not kwargs["upsert"]
+    # the load records the file on its own cursor
+    kwargs["after_load"](cur)
+    (fingerprint, staged_cur), _ = mark_staged.call_args
+    assert fingerprint.path == paths[1] and staged_cur is cur
+    executed = [args[0] for args, _ in cur.execute.call_args_list]
+    assert "DROP TABLE" in executed[0]
+    assert any("INSERT INTO test.test_table " in query for query in executed)
+    mark_loaded.assert_called_once_with(cur)
+    after_load.assert_called_once_with(cur)
@@ -0,0 +1,34 @@
+import pytest
+import main
+from file_index import LoadWindow
+
+pytestmark = pytest.mark.unittests
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_load_streams_files(mocker, streaming):
+    """IMPORT_STREAMING is handed over to import_sources"""
+    import_sources = mocker.patch("file_op.import_sources")
+    mocker.patch("main.run_modelling")
+    mocker.patch("main.IMPORT_STREAMING", streaming)
+    main.load(None, "table_metadata", "raw_data")
+    assert import_sources.call_args[1]["streaming"] is streaming
+
+
+@pytest.mark.parametrize(
+    "val, incremental_modelling, incremental",
+    [
+        (None, None, False),
+        ("2020-12-08", None, True),
+        (LoadWindow.for_dates("2020-12-07", "2020-12-08"), None, True),
+        (main.INCREMENTAL, None, True),
+        ("2020-12-08", False, False),
+        (None, True, True),
+    ],
+)
+def test_load_models_delta_loads_incrementally(mocker, val, incremental_modelling, incremental):
+    """Only loading all events rebuilds the fact table, unless the modelling mode is forced"""
+    mocker.patch("file_op.import_sources")
+    run_modelling = mocker.patch("main.run_modelling")
+    main.load(val, "table_metadata", "raw_data", incremental_modelling)
+    run_modelling.assert_called_once_with(incremental=incremental)
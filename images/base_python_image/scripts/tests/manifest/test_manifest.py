@@ -0,0 +1,103 @@
+import pytest
+import hashlib
+from manifest import LoadManifest, LOADED, STAGED, file_sha256
+from os import utime
+from os.path import join
+from tempfile import TemporaryDirectory
+
+pytestmark = pytest.mark.unittests
+
+
+@pytest.fixture
+def src_dir():
+    with TemporaryDirectory(dir="/tmp") as tmpdir:
+        for name in ["a.json", "b.json"]:
+            with open(join(tmpdir, name), "w") as f:
+                f.write(f'[{{"id": "{name}"}}]')
+        yield tmpdir
+
+
+def entry(path, status=LOADED, sha256=None):
+    """Manifest entry matching the current state of a file"""
+    fingerprint = LoadManifest.fingerprint(path)
+    return (fingerprint.size, fingerprint.mtime, sha256 or fingerprint.sha256, status)
+
+
+def plan(mocker, entries, paths, delta):
+    mocker.patch("manifest.LoadManifest.entries", return_value=entries)
+    return LoadManifest(schema="test", table_name="test", pg_hook=None).plan(
+        paths, delta=delta
+    )
+
+
+def test_file_sha256(src_dir):
+    path = join(src_dir, "a.json")
+    with open(path, "rb") as f:
+        assert file_sha256(path) == hashlib.sha256(f.read()).hexdigest()
+
+
+def test_fingerprint_reuses_hash(src_dir):
+    """The recorded hash is trusted as long as size and mtime did not change"""
+    path = join(src_dir, "a.json")
+    recorded = entry(path, sha256="f" * 64)
+    assert LoadManifest.fingerprint(path, recorded).sha256 == "f" * 64
+    utime(path, (0, 0))
+    assert LoadManifest.fingerprint(path, recorded).sha256 == file_sha256(path)
+
+
+@pytest.mark.parametrize("delta", [True, False])
+def test_plan_first_run(mocker, src_dir, delta):
+    paths = [join(src_dir, "a.json"), join(src_dir, "b.json")]
+    result = plan(mocker, {}, paths, delta)
+    assert [fp.path for fp in result.to_load] == paths
+    assert result.recreate_table and not result.resumed
+
+
+@pytest.mark.parametrize("delta", [True, False])
+def test_plan_up_to_date(mocker, src_dir, delta):
+    paths = [join(src_dir, "a.json"), join(src_dir, "b.json")]
+    result = plan(mocker, {path: entry(path) for path in paths}, paths, delta)
+    assert result.up_to_date
+
+
+@pytest.mark.parametrize(
+    "delta, expected", [(True, ["b.json"]), (False, ["a.json", "b.json"])]
+)
+def test_plan_new_file(mocker, src_dir, delta, expected):
+    """Delta tables only receive the new file, other tables are rebuilt from every file"""
+    paths = [join(src_dir, "a.json"), join(src_dir, "b.json")]
+    result = plan(mocker, {paths[0]: entry(paths[0])}, paths, delta)
+    assert [fp.path for fp in result.to_load] == [join(src_dir, f) for f in expected]
+    assert result.recreate_table
+
+
+@pytest.mark.parametrize("delta", [True, False])
+def test_plan_resumes_staged_files(mocker, src_dir, delta):
+    """Files staged by an interrupted run stay in the table, only the remaining ones are loaded"""
+    paths = [join(src_dir, "a.json"), join(src_dir, "b.json")]
+    result = plan(mocker, {paths[0]: entry(paths[0], status=STAGED)}, paths, delta)
+    assert [fp.path for fp in result.to_load] == [paths[1]]
+    assert result.resumed == [paths[0]]
+    assert not result.recreate_table
+
+
+def test_plan_changed_staged_file(mocker, src_dir):
+    """A staged file that changed since left stale rows in the delta table, it is recreated"""
+    paths = [join(src_dir, "a.json"), join(src_dir, "b.json")]
+    entries = {paths[0]: entry(paths[0], status=STAGED), paths[1]: entry(paths[1])}
+    with open(paths[0], "w") as f:
+        f.write('[{"id": "changed"}]')
+    result = plan(mocker, entries, paths, delta=True)
+    assert [fp.path for fp in result.to_load] == [paths[0]]
+    assert result.recreate_table and not result.resumed
+
+
+def test_plan_removed_file(mocker, src_dir):
+    """A removed file of a full load requires a rebuild"""
+    paths = [join(src_dir, "a.json")]
+    entries = {path: entry(path) for path in paths}
+    entries[join(src_dir, "removed.json")] = entries[paths[0]]
+    assert plan(mocker, entries, paths, delta=True).up_to_date
+    result = plan(mocker, entries, paths, delta=False)
+    assert [fp.path for fp in result.to_load] == paths
+    assert result.recreate_table
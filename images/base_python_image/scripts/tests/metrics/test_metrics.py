@@ -0,0 +1,91 @@
+import pytest
+import json
+from unittest import mock
+from urllib.request import urlopen
+import metrics
+from queue_implementation.consumer import CONSUMER_ACKS, CONSUMER_EVENTS, Consumer
+from queue_implementation.producer import Producer
+from queue_implementation.transport import InMemoryBroker, InMemoryTransport
+from tests.mocks import get_mock_json, get_mock_table_md
+
+
+pytestmark = pytest.mark.unittests
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(metrics, "_enabled", True)
+
+
+def test_disabled_instruments_record_nothing():
+    registry = metrics.Registry()
+    counter = registry.counter("rows_total", "Rows")
+    histogram = registry.histogram("load_seconds", "Load time")
+    counter.inc(5)
+    histogram.observe(1.0)
+    with histogram.time():
+        pass
+    assert counter.value == 0
+    assert histogram.count == 0
+    assert registry.summary() == ""
+
+
+def test_counter_and_histogram(enabled):
+    registry = metrics.Registry()
+    counter = registry.counter("rows_total", "Rows")
+    counter.inc()
+    counter.inc(4)
+    # registering the same name again returns the existing metric
+    assert registry.counter("rows_total", "Rows") is counter
+    histogram = registry.histogram("load_seconds", "Load time", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    with histogram.time():
+        pass
+
+    assert counter.value == 5
+    assert histogram.counts == [3, 1, 1]
+    assert registry.render().splitlines() == [
+        "# HELP dataproc_rows_total Rows",
+        "# TYPE dataproc_rows_total counter",
+        "dataproc_rows_total 5",
+        "# HELP dataproc_load_seconds Load time",
+        "# TYPE dataproc_load_seconds histogram",
+        'dataproc_load_seconds_bucket{le="0.1"} 3',
+        'dataproc_load_seconds_bucket{le="1.0"} 4',
+        'dataproc_load_seconds_bucket{le="+Inf"} 5',
+        f"dataproc_load_seconds_sum {histogram.sum}",
+        "dataproc_load_seconds_count 5",
+    ]
+    assert registry.summary().startswith("dataproc_rows_total=5 dataproc_load_seconds=5x")
+
+
+def test_http_endpoint(enabled):
+    registry = metrics.Registry()
+    registry.counter("rows_total", "Rows").inc(3)
+    server = metrics.start_http_server(0, registry)
+    try:
+        port = server.server_address[1]
+        with urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+            assert "dataproc_rows_total 3" in response.read().decode("utf-8")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@mock.patch("queue_implementation.consumer.PgHook")
+def test_consumer_instrumentation(pg_hook, enabled):
+    broker = InMemoryBroker()
+    acks, events = CONSUMER_ACKS.value, CONSUMER_EVENTS.value
+    producer = Producer(host="", queue="test_queue", transport=InMemoryTransport(broker))
+    for event in json.loads(get_mock_json()):
+        producer.publish_event(msg=json.dumps(event))
+    consumer = Consumer(
+        host="", queue="test_queue", table_md=get_mock_table_md(), transport=InMemoryTransport(broker)
+    )
+    consumer.transport.consume("test_queue", consumer._Consumer__load_to_pgres_callback)
+    consumer.transport.process_data_events()
+
+    assert CONSUMER_ACKS.value - acks == 2
+    assert CONSUMER_EVENTS.value - events == 2
@@ -0,0 +1,56 @@
+import pytest
+import struct
+from datetime import date, datetime
+from pgcopy import HEADER, NULL, TRAILER, BinaryCopyStream, row_encoder
+
+pytestmark = pytest.mark.unittests
+
+
+def field(fmt, value):
+    data = struct.pack(fmt, value)
+    return struct.pack(">i", len(data)) + data
+
+
+@pytest.mark.parametrize(
+    "column_type, value, expected",
+    [
+        ("varchar", "föo", struct.pack(">i", 4) + "föo".encode("utf-8")),
+        ("varchar", None, NULL),
+        # microseconds since 2000-01-01
+        ("timestamp", "2000-01-02 00:00:01.5", field(">q", 86401500000)),
+        ("timestamp", datetime(1999, 12, 31, 23, 59, 59), field(">q", -1000000)),
+        ("timestamptz", "2000-01-01T01:00:00+01:00", field(">q", 0)),
+        ("date", "2000-02-01", field(">i", 31)),
+        ("date", date(1999, 12, 31), field(">i", -1)),
+        ("integer", "42", field(">i", 42)),
+        ("bigint", 1 << 40, field(">q", 1 << 40)),
+        ("smallint", -2, field(">h", -2)),
+        ("double precision", "1.5", field(">d", 1.5)),
+        ("boolean", "true", field(">?", True)),
+        ("boolean", False, field(">?", False)),
+    ],
+)
+def test_encoders(column_type, value, expected):
+    encode_row = row_encoder([column_type])
+    assert encode_row([value]) == struct.pack(">h", 1) + expected
+
+
+def test_unsupported_type():
+    with pytest.raises(ValueError):
+        row_encoder(["varchar", "numeric"])
+
+
+def test_timestamptz_requires_time_zone():
+    with pytest.raises(ValueError):
+        row_encoder(["timestamptz"])(["2000-01-01 00:00:00"])
+
+
+def test_binary_copy_stream():
+    """The stream holds the PGCOPY header, one tuple per row and the trailer, read in chunks of any size"""
+    rows = [["foo", "2000-01-01 00:00:00"], ["bar", None]]
+    stream = BinaryCopyStream(rows=rows, column_types=["varchar", "timestamp"], chunk_size=4)
+    chunks = list(iter(lambda: stream.read(5), b""))
+    assert all(len(chunk) <= 5 for chunk in chunks)
+    encode_row = row_encoder(["varchar", "timestamp"])
+    assert b"".join(chunks) == HEADER + encode_row(rows[0]) + encode_row(rows[1]) + TRAILER
+    assert stream.rows_written == 2
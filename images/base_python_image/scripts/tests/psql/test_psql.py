@@ -1,6 +1,8 @@
 import pytest
 from unittest.mock import MagicMock
-from psql_client import PgHook
+from psql_client import PgHook, CopyStream, close_pools
+from pgcopy import BinaryCopyStream
+from rollup import Rollup
 from sql_gen import SQLGenerator
 from tempfile import NamedTemporaryFile
 pytestmark = pytest.mark.unittests
@@ -37,7 +39,9 @@ def table_metadata_mock():
     ]
     table_md_mock.delimiter = ","
     table_md_mock.load_prefix = "test"
+    table_md_mock.filter_key = None
     table_md_mock.delta_params = None
+    table_md_mock.partitioning = None
     return table_md_mock
 
 
@@ -62,6 +66,36 @@ def test_execute_accepts_types(mocker, queries):
     hook.execute(queries=queries)
 
 
+@pytest.mark.parametrize("pool", ["threaded", "process"])
+def test_pooled_hook_reuses_connection(mocker, pool):
+    """Pooled hooks connect once and keep handing out the same connection"""
+    mock = MagicMock()
+    mock.return_value.closed = 0
+    mocker.patch("psql_client.psycopg2.connect", mock)
+    hook = PgHook(**MOCK_DB_AUTH, pool=pool, minconn=1, maxconn=2)
+    hook.execute("SELECT 1;")
+    hook.execute(["SELECT 1;", "SELECT 2;"])
+    close_pools()
+    mock.assert_called_once_with(
+        database="test", user="test", password="test", host="test", port="test"
+    )
+    assert mock.return_value.commit.call_count == 2
+
+
+def test_session_rolls_back_on_error(mocker):
+    mock = MagicMock()
+    mock.return_value.closed = 0
+    mocker.patch("psql_client.psycopg2.connect", mock)
+    hook = PgHook(**MOCK_DB_AUTH, pool="process")
+    with pytest.raises(ValueError):
+        with hook.session() as cur:
+            cur.execute("SELECT 1;")
+            raise ValueError("boom")
+    close_pools()
+    mock.return_value.rollback.assert_called()
+    mock.return_value.commit.assert_not_called()
+
+
 @pytest.mark.parametrize("queries", ["SELECT 1;", ["SELECT 1;", "SELECT 1;"]])
 def test_execute(queries):
     hook = PgHook()
@@ -102,6 +136,25 @@ def test_load_to_table(drop_table):
             assert list(cur.fetchall()[0]) == row
 
 
+def test_copy_stream_binary():
+    hook = PgHook()
+    table_md_mock = table_metadata_mock()
+    sql_gen = SQLGenerator(table_md=table_md_mock)
+    hook.execute(sql_gen.create_table_query())
+    row = ["luca", "fz234kan"]
+    stream = BinaryCopyStream(
+        rows=[row], column_types=[col["type"] for col in table_md_mock.columns]
+    )
+    hook.copy_stream(query=sql_gen.copy_query("binary"), stream=stream)
+
+    with hook.get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"SELECT * FROM {table_md_mock.schema_name}.{table_md_mock.table_name} WHERE name='luca';"
+            )
+            assert list(cur.fetchall()[0]) == row
+
+
 def test_load_to_table_delta():
     """Tests that upserts work. This is done by adding the delta_params inside the table metadatabase and comparing
     that the row exists in both tables (master and delta) and that indeed the row matches the expected input
@@ -138,6 +191,34 @@ def test_load_to_table_delta():
             assert result[0] == result[1]
 
 
+@pytest.mark.parametrize("strategy", ["on_conflict", "merge"])
+def test_load_to_table_delta_set_based(strategy):
+    """Tests that set based upserts update existing rows in place instead of duplicating them"""
+    hook = PgHook()
+    table_md_mock = table_metadata_mock()
+    table_md_mock.delta_params = {
+        "master_table": f"{table_md_mock.table_name}_{strategy}",
+        "delta_key": "id",
+        "strategy": strategy,
+    }
+    header = ["name", "id"]
+    for name in ["david", "sarah"]:
+        with NamedTemporaryFile(
+            dir="/tmp", prefix=table_md_mock.load_prefix, mode="w+"
+        ) as f:
+            f.write(",".join(header) + "\n")
+            f.write(f"{name},fz234kal\n")
+            f.flush()
+            hook.load_to_table(src_path=f.name, table_md=table_md_mock)
+
+    with hook.get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"SELECT * FROM {table_md_mock.schema_name}.{table_md_mock.delta_params['master_table']}"
+            )
+            assert cur.fetchall() == [("sarah", "fz234kal")]
+
+
 def test_copy_expert():
     hook = PgHook()
     table_md_mock = table_metadata_mock()
@@ -169,3 +250,59 @@ def test_copy_expert_file_not_exists():
     sql_gen = SQLGenerator(table_md=table_md_mock)
     with pytest.raises(FileNotFoundError):
         hook.copy_expert(query=sql_gen.copy_query(), src_path="/tmp/notexists.csv")
+
+
+def test_copy_stream_chunks():
+    """CopyStream encodes rows lazily, NULLs are written as empty fields and reads never exceed the requested size"""
+    rows = [["david", "fz234kal"], ["sarah", None], ["a,b", "c"]]
+    stream = CopyStream(rows=rows, header=["name", "id"], chunk_size=4)
+    chunks = list(iter(lambda: stream.read(6), ""))
+    assert all(len(chunk) <= 6 for chunk in chunks)
+    assert "".join(chunks) == 'name,id\ndavid,fz234kal\nsarah,\n"a,b",c\n'
+    assert stream.rows_written == 3
+
+
+def test_copy_stream():
+    hook = PgHook()
+    table_md_mock = table_metadata_mock()
+    sql_gen = SQLGenerator(table_md=table_md_mock)
+    hook.execute(sql_gen.create_table_query())
+    row = ["maria", "fz234kam"]
+    stream = CopyStream(rows=[row], header=["name", "id"])
+    hook.copy_stream(query=sql_gen.copy_query(), stream=stream)
+
+    with hook.get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"SELECT * FROM {table_md_mock.schema_name}.{table_md_mock.table_name} WHERE name='maria';"
+            )
+            assert list(cur.fetchall()[0]) == row
+
+
+def test_copy_stream_after_load():
+    """The rollup of the copied rows is merged in the transaction of the COPY, twice adding up"""
+    hook = PgHook()
+    fields = ["received_at", "username", "organization_name", "user_type"]
+    rows = [
+        ["2020-12-08 10:00:00", "anna", "foo_org", None],
+        ["2020-12-08 11:00:00", "bob", "foo_org", None],
+    ]
+    hook.execute(
+        "CREATE TABLE test.rollup_events "
+        "(received_at timestamp, username text, organization_name text, user_type text);"
+    )
+    for _ in range(2):
+        rollup = Rollup(schema="test")
+        rollup.add_rows(rows, fields)
+        hook.copy_stream(
+            query="COPY test.rollup_events FROM STDIN WITH CSV HEADER",
+            stream=CopyStream(rows=rows, header=fields),
+            after_load=rollup.merge,
+        )
+
+    with hook.get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT received_at::text, organization_name, user_type, events FROM test.events_rollup;")
+            assert cur.fetchall() == [("2020-12-08", "foo_org", None, 4)]
+            cur.execute("SELECT received_at::text, unique_users FROM test.events_rollup_users;")
+            assert cur.fetchall() == [("2020-12-08", 2)]
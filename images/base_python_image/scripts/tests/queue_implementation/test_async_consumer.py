@@ -0,0 +1,48 @@
+import pytest
+import asyncio
+import json
+from datetime import datetime
+from queue_implementation.async_consumer import AsyncConsumer
+from sql_gen import SQLGenerator
+from tests.mocks import get_mock_table_md
+from unittest import mock
+
+pytestmark = pytest.mark.unittests
+
+TEST_QUEUE = "test_queue"
+
+
+@mock.patch("queue_implementation.async_consumer.PgHook")
+def test_async_consumer_creates_partitions(pg_hook):
+    """The partitions of the rows are created before writing them, once per partition"""
+    md = get_mock_table_md()
+    md.table_md["delta_params"] = None
+    md.table_md["partitioning"] = {"grain": "monthly"}
+    consumer = AsyncConsumer(host="", queue=TEST_QUEUE, table_md=md)
+    write_rows = consumer._AsyncConsumer__write_rows
+    write_rows([("foo", "created", datetime(2020, 12, 8)), ("bar", "created", None)])
+    write_rows([("baz", "created", datetime(2020, 12, 31)), ("qux", "created", datetime(2021, 1, 1))])
+
+    assert [call[0][0] for call in pg_hook.return_value.execute.call_args_list] == [
+        [SQLGenerator(md).create_partition_query(datetime(2020, 12, 1))],
+        [SQLGenerator(md).create_partition_query(datetime(2021, 1, 1))],
+    ]
+    assert pg_hook.return_value.session.return_value.__enter__.return_value.executemany.call_count == 2
+
+
+@mock.patch("queue_implementation.async_consumer.PgHook")
+def test_async_consumer_enriches_events(pg_hook):
+    """Events get the organization_key of the cache, refreshed off the event loop before the message is extracted"""
+    orgs_cache = mock.MagicMock(column={"name": "organization_key", "type": "varchar", "length": 300})
+    orgs_cache.enrich.side_effect = lambda event: dict(event, organization_key="org_key")
+    consumer = AsyncConsumer(host="", queue=TEST_QUEUE, table_md=get_mock_table_md(), orgs_cache=orgs_cache)
+    channel, method = mock.MagicMock(), mock.MagicMock(delivery_tag=1)
+    body = json.dumps({"id": "foo", "event_type": "created", "event_ts": "2020-12-08 20:03:16"})
+
+    asyncio.run(consumer._AsyncConsumer__handle_message(channel, method, None, body.encode("utf-8")))
+    orgs_cache.refresh_if_stale.assert_called_once_with()
+    cur = pg_hook.return_value.session.return_value.__enter__.return_value
+    cur.executemany.assert_called_once_with(
+        consumer.insert_query, [("foo", "created", datetime(2020, 12, 8, 20, 3, 16), "org_key")]
+    )
+    channel.basic_ack.assert_called_once_with(delivery_tag=1)
@@ -0,0 +1,70 @@
+import pytest
+import asyncio
+import pika
+from queue_implementation.producer import AsyncProducer, NackedPublishError
+from unittest import mock
+
+pytestmark = pytest.mark.unittests
+
+TEST_QUEUE = "test_queue"
+
+
+class FakeConnections:
+    """Stands in for AsyncioConnection, opening connections and channels right away and keeping their callbacks"""
+
+    def __init__(self):
+        self.connections = []
+        self.on_close = None
+        self.on_confirm = None
+
+    def __call__(self, parameters, on_open_callback, on_open_error_callback, on_close_callback, custom_ioloop):
+        connection = mock.MagicMock(is_closed=False)
+        connection.channel.side_effect = lambda on_open_callback: on_open_callback(self.channel(connection))
+        self.connections.append(connection)
+        self.on_close = on_close_callback
+        on_open_callback(connection)
+        return connection
+
+    def channel(self, connection):
+        channel = mock.MagicMock()
+        channel.queue_declare.side_effect = lambda queue, callback: callback(mock.MagicMock())
+        channel.confirm_delivery.side_effect = self.confirm_delivery
+        connection.opened_channel = channel
+        return channel
+
+    def confirm_delivery(self, ack_nack_callback, callback):
+        self.on_confirm = ack_nack_callback
+        callback(mock.MagicMock())
+
+    def ack(self, delivery_tag, multiple=False):
+        self.on_confirm(mock.MagicMock(method=pika.spec.Basic.Ack(delivery_tag=delivery_tag, multiple=multiple)))
+
+
+@mock.patch("queue_implementation.aio.AsyncioConnection", new_callable=FakeConnections)
+def test_async_producer_fails_confirms_of_closed_connection(connections):
+    async def publish():
+        producer = AsyncProducer(host="localhost", queue=TEST_QUEUE, max_outstanding=2)
+        await producer.connect()
+        await producer.publish_event(msg="a")
+        connections.ack(1)
+        await producer.wait_for_confirms()
+
+        await producer.publish_event(msg="b")
+        await producer.publish_event(msg="c")
+        connections.on_close(connections.connections[0], pika.exceptions.ConnectionClosedByBroker(320, "closed"))
+        # both slots are free again and the waiters are released
+        assert not producer._outstanding
+        with pytest.raises(NackedPublishError, match="2 messages"):
+            await asyncio.wait_for(producer.wait_for_confirms(), timeout=1)
+
+        # the next publish goes through a new connection, whose delivery tags start over
+        await producer.publish_event(msg="d")
+        assert len(connections.connections) == 2
+        connections.connections[1].opened_channel.basic_publish.assert_called_once_with(
+            exchange="", routing_key=TEST_QUEUE, body="d", properties=None
+        )
+        connections.ack(1)
+        await producer.close()
+        connections.connections[1].close.assert_called_once_with()
+
+    asyncio.new_event_loop().run_until_complete(publish())
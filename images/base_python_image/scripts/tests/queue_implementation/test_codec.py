@@ -0,0 +1,45 @@
+import pytest
+import json
+import pika
+from queue_implementation.codec import pack_events, set_json_decoder, unpack_events
+from tests.mocks import get_mock_json
+
+pytestmark = pytest.mark.unittests
+
+
+@pytest.mark.parametrize("pack_format", ["ndjson", "json"])
+@pytest.mark.parametrize("compress", [False, True])
+def test_pack_unpack_events(pack_format, compress):
+    events = json.loads(get_mock_json())
+    body, properties = pack_events(events, pack_format=pack_format, compress=compress)
+    assert unpack_events(body, properties) == events
+
+
+def test_unpack_single_event():
+    """Messages published without properties hold a single JSON event"""
+    event = json.loads(get_mock_json())[0]
+    assert unpack_events(json.dumps(event).encode("utf-8")) == [event]
+    assert unpack_events(json.dumps(event), pika.BasicProperties()) == [event]
+
+
+def test_pack_unknown_format():
+    with pytest.raises(ValueError):
+        pack_events([{}], pack_format="xml")
+
+
+@pytest.mark.parametrize("decoder", ["json", "orjson"])
+def test_json_decoders(decoder):
+    if decoder == "orjson":
+        pytest.importorskip("orjson")
+    events = [{"id": "foo", "n": 1}, {"id": "bar", "n": None}]
+    set_json_decoder(decoder)
+    try:
+        body, properties = pack_events(events)
+        assert unpack_events(body, properties) == events
+    finally:
+        set_json_decoder("json")
+
+
+def test_unknown_json_decoder():
+    with pytest.raises(ValueError):
+        set_json_decoder("simplejson")
@@ -1,4 +1,5 @@
 import pytest
+import asyncio
 from time import sleep
 import threading
 from os.path import expandvars
@@ -8,6 +9,7 @@ from psql_client import PgHook
 from tests.mocks import get_mock_table_md
 from tests.mocks import get_mock_json
 from queue_implementation.consumer import Consumer
+from queue_implementation.async_consumer import AsyncConsumer
 from queue_implementation.producer import Producer
 from datetime import datetime
 
@@ -66,3 +68,55 @@ def test_consumer_consume_events(publish_for_consumption):
             assert cur.fetchall() == expected
 
     consumer_thread.__running = False
+
+
+def test_consumer_batch_load_to_pgres(publish_for_consumption):
+    """Both events are loaded with a single COPY once the linger time of the batch has passed"""
+    table_md = get_mock_table_md()
+    pg_hook = PgHook()
+    pg_hook.execute(f"DROP TABLE IF EXISTS {table_md.schema_name}.{table_md.table_name};")
+    consumer = Consumer(
+        host=RABBIT_MQ_HOST,
+        queue=TEST_QUEUE,
+        table_md=table_md,
+        batch_size=10,
+        max_linger=1,
+    )
+    consumer_thread = threading.Thread(
+        target=consumer.batch_load_to_pgres, daemon=True
+    )
+    consumer_thread.start()
+    sleep(4)
+
+    expected = [
+        ("foo", "created", datetime(2020, 12, 8, 20, 3, 16, 759617)),
+        ("bar", "created", datetime(2014, 12, 8, 20, 3, 16, 759617)),
+    ]
+
+    with pg_hook.get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT * FROM {table_md.schema_name}.{table_md.table_name};")
+            assert cur.fetchall() == expected
+
+
+def test_async_consumer_consume_events(publish_for_consumption):
+    table_md = get_mock_table_md()
+    pg_hook = PgHook()
+    pg_hook.execute(f"DROP TABLE IF EXISTS {table_md.schema_name}.{table_md.table_name};")
+    consumer = AsyncConsumer(
+        host=RABBIT_MQ_HOST, queue=TEST_QUEUE, table_md=table_md, prefetch_count=2
+    )
+    loop = asyncio.new_event_loop()
+    loop.call_later(4, consumer.stop)
+    loop.run_until_complete(consumer.consume_events())
+    loop.close()
+
+    expected = [
+        ("foo", "created", datetime(2020, 12, 8, 20, 3, 16, 759617)),
+        ("bar", "created", datetime(2014, 12, 8, 20, 3, 16, 759617)),
+    ]
+
+    with pg_hook.get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT * FROM {table_md.schema_name}.{table_md.table_name};")
+            assert sorted(cur.fetchall()) == sorted(expected)
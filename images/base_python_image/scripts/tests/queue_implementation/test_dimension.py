@@ -0,0 +1,116 @@
+import pytest
+import json
+import threading
+from unittest import mock
+from queue_implementation.consumer import Consumer
+from queue_implementation.dimension import DimensionCache
+from queue_implementation.producer import Producer
+from queue_implementation.transport import InMemoryBroker, InMemoryTransport
+from tests.mocks import get_mock_json, get_mock_table_md
+
+
+pytestmark = pytest.mark.unittests
+
+TEST_QUEUE = "test_queue"
+ORGS = [("foo_org", "key_1"), ("bar_org", "key_2")]
+
+
+def mock_pg_hook(rows=ORGS):
+    pg_hook = mock.MagicMock()
+    cur = pg_hook.session.return_value.__enter__.return_value
+    cur.fetchone.return_value = ("staging.raw_orgs",)
+    cur.fetchall.return_value = rows
+    return pg_hook
+
+
+def test_cache_enriches_events():
+    cache = DimensionCache(pg_hook=mock_pg_hook())
+    cache.refresh_if_stale()
+    assert cache.enrich({"organization_name": "foo_org"}) == {
+        "organization_name": "foo_org",
+        "organization_key": "key_1",
+    }
+    assert cache.enrich({"organization_name": "unknown"})["organization_key"] is None
+    assert cache.enrich({})["organization_key"] is None
+
+
+def test_cache_of_missing_table_is_empty():
+    pg_hook = mock_pg_hook()
+    pg_hook.session.return_value.__enter__.return_value.fetchone.return_value = (None,)
+    cache = DimensionCache(pg_hook=pg_hook)
+    cache.refresh()
+    assert cache.values == {}
+
+
+@mock.patch("queue_implementation.dimension.monotonic")
+def test_cache_refreshes_once_expired(monotonic):
+    pg_hook = mock_pg_hook()
+    cache = DimensionCache(ttl=10, pg_hook=pg_hook)
+    monotonic.return_value = 100
+    cache.refresh_if_stale()
+    monotonic.return_value = 109
+    cache.refresh_if_stale()
+    assert pg_hook.session.call_count == 1
+    monotonic.return_value = 110
+    cache.refresh_if_stale()
+    assert pg_hook.session.call_count == 2
+
+
+@mock.patch("queue_implementation.dimension.select")
+def test_cache_refreshes_on_notification(select):
+    """Only the notifications of the cached table trigger a refresh"""
+    pg_hook = mock_pg_hook()
+    listener = pg_hook.get_conn.return_value
+    listener.closed = False
+    listener.notifies = []
+    cache = DimensionCache(ttl=0, listen=True, pg_hook=pg_hook)
+    cache.POLL_INTERVAL = 0
+    # listening starts on first use, along with a refresh
+    cache.refresh_if_stale()
+    listener.cursor.return_value.__enter__.return_value.execute.assert_called_once_with(
+        "LISTEN table_loaded"
+    )
+    assert pg_hook.session.call_count == 1
+
+    select.return_value = ([listener], [], [])
+    listener.notifies = [mock.Mock(payload="staging.raw_events")]
+    cache.refresh_if_stale()
+    assert pg_hook.session.call_count == 1
+    listener.notifies = [mock.Mock(payload="staging.raw_orgs")]
+    cache.refresh_if_stale()
+    assert pg_hook.session.call_count == 2
+    assert listener.notifies == []
+
+
+def test_cache_needs_a_refresh_policy():
+    with pytest.raises(ValueError):
+        DimensionCache(ttl=0, listen=False, pg_hook=mock.MagicMock())
+
+
+@mock.patch("queue_implementation.consumer.PgHook")
+def test_consumer_loads_enriched_events(pg_hook):
+    broker = InMemoryBroker()
+    producer = Producer(host="", queue=TEST_QUEUE, transport=InMemoryTransport(broker))
+    for event, (org, _) in zip(json.loads(get_mock_json()), ORGS):
+        producer.publish_event(msg=json.dumps(dict(event, organization_name=org)))
+    consumer = Consumer(
+        host="",
+        queue=TEST_QUEUE,
+        table_md=get_mock_table_md(),
+        batch_size=2,
+        max_linger=0.01,
+        transport=InMemoryTransport(broker),
+        orgs_cache=DimensionCache(pg_hook=mock_pg_hook()),
+    )
+    thread = threading.Thread(target=consumer.batch_load_to_pgres)
+    thread.start()
+    assert broker.wait_idle(timeout=5)
+    consumer.stop()
+    thread.join(timeout=5)
+
+    # the column is added to tables created before enrichment was turned on
+    queries = pg_hook.return_value.execute.call_args[0][0]
+    assert "ADD COLUMN IF NOT EXISTS organization_key varchar(300)" in queries[1]
+    stream = pg_hook.return_value.copy_stream.call_args[1]["stream"]
+    assert [row[-1] for row in stream.rows] == ["key_1", "key_2"]
+    assert "organization_key" in pg_hook.return_value.copy_stream.call_args[1]["query"]
@@ -1,8 +1,10 @@
 import pytest
+import asyncio
 from time import sleep
 from os.path import expandvars
 import pika
-from queue_implementation.producer import Producer
+from queue_implementation.producer import Producer, AsyncProducer
+from queue_implementation.codec import NDJSON_CONTENT_TYPE, unpack_events
 
 pytestmark = pytest.mark.unittests_rabbitmq
 
@@ -29,3 +31,31 @@ def teardown_module(module):
 def test_producer():
     producer = Producer(host=RABBIT_MQ_HOST, queue=TEST_QUEUE)
     producer.publish_event(msg="this is a test msg")
+
+
+def test_producer_publish_events():
+    producer = Producer(host=RABBIT_MQ_HOST, queue=TEST_QUEUE)
+    channel = producer.transport.channel
+    channel.queue_purge(queue=TEST_QUEUE)
+    events = [{"id": "foo"}, {"id": "bar"}]
+    producer.publish_events(events, pack_format="ndjson", compress=True)
+    sleep(1)
+    method, properties, body = channel.basic_get(queue=TEST_QUEUE, auto_ack=True)
+    assert properties.content_type == NDJSON_CONTENT_TYPE
+    assert unpack_events(body, properties) == events
+    producer.close()
+
+
+def test_async_producer_confirms():
+    async def publish():
+        producer = AsyncProducer(
+            host=RABBIT_MQ_HOST, queue=TEST_QUEUE, max_outstanding=2
+        )
+        await producer.connect()
+        for i in range(10):
+            await producer.publish_event(msg=f"this is test msg {i}")
+        await producer.wait_for_confirms()
+        assert not producer._outstanding
+        await producer.close()
+
+    asyncio.new_event_loop().run_until_complete(publish())
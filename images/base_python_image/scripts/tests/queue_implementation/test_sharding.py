@@ -0,0 +1,146 @@
+import pytest
+import json
+import threading
+from collections import defaultdict
+from unittest import mock
+from queue_implementation.codec import unpack_events
+from queue_implementation.consumer import Consumer
+from queue_implementation.producer import Producer
+from queue_implementation.sharding import jump_hash, owned_shards, shard_of, shard_queue
+from queue_implementation.transport import InMemoryBroker, InMemoryTransport
+from tests.mocks import get_mock_table_md
+
+
+pytestmark = pytest.mark.unittests
+
+TEST_QUEUE = "test_queue"
+N_SHARDS = 4
+ORGS = [f"org_{i}" for i in range(20)]
+
+
+def test_jump_hash_moves_keys_to_the_new_bucket_only():
+    keys = range(10000)
+    for n_buckets in (1, 2, 5, 10):
+        moved = 0
+        for key in keys:
+            before, after = jump_hash(key, n_buckets), jump_hash(key, n_buckets + 1)
+            assert 0 <= before < n_buckets
+            if before != after:
+                assert after == n_buckets
+                moved += 1
+        # about 1 / (n + 1) of the keys move
+        assert abs(moved / len(keys) - 1 / (n_buckets + 1)) < 0.05
+
+
+def test_jump_hash_rejects_empty_buckets():
+    with pytest.raises(ValueError):
+        jump_hash(1, 0)
+
+
+def test_shard_of_is_stable():
+    assert shard_of("org_1", N_SHARDS) == shard_of("org_1", N_SHARDS)
+    assert shard_of(None, N_SHARDS) == shard_of("", N_SHARDS)
+    assert shard_of(1, N_SHARDS) == shard_of("1", N_SHARDS)
+    assert {shard_of(org, N_SHARDS) for org in ORGS} == set(range(N_SHARDS))
+
+
+def test_owned_shards_split_every_shard_once():
+    owned = [owned_shards(member, 3, 8) for member in range(3)]
+    assert sorted(shard for shards in owned for shard in shards) == list(range(8))
+    assert owned[0] == [0, 3, 6]
+    with pytest.raises(ValueError):
+        owned_shards(3, 3, 8)
+    with pytest.raises(ValueError):
+        owned_shards(0, 4, 2)
+
+
+def sharded_producer(broker):
+    return Producer(
+        host="",
+        queue=TEST_QUEUE,
+        transport=InMemoryTransport(broker),
+        shards=N_SHARDS,
+        exchange="test_exchange",
+    )
+
+
+def queued_events(broker, shard):
+    return [
+        event
+        for body, properties, _, _ in broker.queue(shard_queue(TEST_QUEUE, shard))
+        for event in unpack_events(body, properties)
+    ]
+
+
+def test_producer_routes_events_by_key():
+    broker = InMemoryBroker()
+    producer = sharded_producer(broker)
+    events = [{"id": i, "organization_name": ORGS[i % len(ORGS)]} for i in range(200)]
+    for event in events:
+        producer.publish_event(json.dumps(event), shard=producer.shard_of(event))
+
+    for shard in range(N_SHARDS):
+        by_org = defaultdict(list)
+        for event in queued_events(broker, shard):
+            assert shard_of(event["organization_name"], N_SHARDS) == shard
+            by_org[event["organization_name"]].append(event["id"])
+        # the events of an organization keep their publishing order
+        for ids in by_org.values():
+            assert ids == sorted(ids)
+    assert sum(len(queued_events(broker, shard)) for shard in range(N_SHARDS)) == 200
+    assert not broker.queue(TEST_QUEUE)
+
+
+def test_sharded_producer_needs_a_shard():
+    producer = sharded_producer(InMemoryBroker())
+    with pytest.raises(ValueError):
+        producer.publish_event("{}")
+
+
+def test_publish_events_packs_a_message_per_shard():
+    broker = InMemoryBroker()
+    producer = sharded_producer(broker)
+    events = [{"id": i, "organization_name": org} for i, org in enumerate(ORGS)]
+    producer.publish_events(events)
+
+    for shard in range(N_SHARDS):
+        assert len(broker.queue(shard_queue(TEST_QUEUE, shard))) == 1
+        assert queued_events(broker, shard) == [
+            event for event in events if shard_of(event["organization_name"], N_SHARDS) == shard
+        ]
+
+
+@mock.patch("queue_implementation.consumer.PgHook")
+def test_consumer_consumes_its_shards_only(pg_hook):
+    broker = InMemoryBroker()
+    producer = sharded_producer(broker)
+    consumer = Consumer(
+        host="",
+        queue=TEST_QUEUE,
+        table_md=get_mock_table_md(),
+        batch_size=1000,
+        max_linger=0.01,
+        transport=InMemoryTransport(broker),
+        shards=owned_shards(0, 2, N_SHARDS),
+        exchange="test_exchange",
+    )
+    events = [
+        {"id": org, "event_type": "created", "event_ts": "2020-12-08 20:03:16", "organization_name": org}
+        for org in ORGS
+    ]
+    producer.publish_events(events)
+    thread = threading.Thread(target=consumer.batch_load_to_pgres)
+    thread.start()
+    # the shards of the other member are left in their queues
+    assert not broker.wait_idle(timeout=0.2)
+    consumer.stop()
+    thread.join(timeout=5)
+
+    loaded = {
+        row[0]
+        for call in pg_hook.return_value.copy_stream.call_args_list
+        for row in call[1]["stream"].rows
+    }
+    assert loaded == {org for org in ORGS if shard_of(org, N_SHARDS) in (0, 2)}
+    assert not broker.queue(shard_queue(TEST_QUEUE, 0))
+    assert broker.queue(shard_queue(TEST_QUEUE, 1))
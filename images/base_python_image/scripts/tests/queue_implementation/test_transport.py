@@ -0,0 +1,201 @@
+import pytest
+import json
+import threading
+from unittest import mock
+import pika
+from queue_implementation.consumer import Consumer
+from queue_implementation.producer import Producer
+from queue_implementation.transport import (
+    InMemoryBroker,
+    InMemoryTransport,
+    PikaTransport,
+    get_transport,
+)
+from tests.mocks import get_mock_json, get_mock_table_md
+
+
+pytestmark = pytest.mark.unittests
+
+TEST_QUEUE = "test_queue"
+
+
+def collect(transport, ack=True):
+    delivered = []
+
+    def on_message(ch, method, properties, body):
+        delivered.append((method.delivery_tag, body, method.redelivered))
+        if ack:
+            ch.ack(method.delivery_tag)
+
+    transport.consume(TEST_QUEUE, on_message)
+    return delivered
+
+
+def publish(broker, bodies):
+    producer = Producer(host="", queue=TEST_QUEUE, transport=InMemoryTransport(broker))
+    for body in bodies:
+        producer.publish_event(msg=body)
+
+
+def test_messages_are_delivered_in_order():
+    broker = InMemoryBroker()
+    publish(broker, ["a", "b", "c"])
+    consumer = InMemoryTransport(broker)
+    delivered = collect(consumer)
+    consumer.process_data_events()
+    assert delivered == [(1, b"a", False), (2, b"b", False), (3, b"c", False)]
+    assert broker.published == 3
+    assert broker.wait_idle(timeout=0)
+
+
+def test_prefetch_limits_unacknowledged_messages():
+    broker = InMemoryBroker()
+    publish(broker, ["a", "b", "c"])
+    consumer = InMemoryTransport(broker)
+    consumer.set_prefetch(2)
+    delivered = collect(consumer, ack=False)
+    consumer.process_data_events()
+    assert [body for _, body, _ in delivered] == [b"a", b"b"]
+
+    consumer.ack(2, multiple=True)
+    consumer.process_data_events()
+    assert [body for _, body, _ in delivered] == [b"a", b"b", b"c"]
+    assert not broker.wait_idle(timeout=0)
+
+
+def test_nack_and_close_redeliver():
+    broker = InMemoryBroker()
+    publish(broker, ["a", "b", "c"])
+    consumer = InMemoryTransport(broker)
+    delivered = collect(consumer, ack=False)
+    consumer.process_data_events()
+    consumer.nack(1)
+    # dropped
+    consumer.nack(3, requeue=False)
+    consumer.close()
+
+    other = InMemoryTransport(broker)
+    redelivered = collect(other)
+    other.process_data_events()
+    assert [(body, flag) for _, body, flag in redelivered] == [(b"a", True), (b"b", True)]
+    assert broker.wait_idle(timeout=0)
+
+
+def test_consumers_share_a_queue_across_threads():
+    broker = InMemoryBroker()
+    consumers = [InMemoryTransport(broker) for _ in range(3)]
+    delivered = [collect(consumer) for consumer in consumers]
+    threads = [threading.Thread(target=consumer.start_consuming) for consumer in consumers]
+    for thread in threads:
+        thread.start()
+    publish(broker, [str(i) for i in range(100)])
+
+    assert broker.wait_idle(timeout=5)
+    for consumer in consumers:
+        consumer.stop_consuming()
+    for thread in threads:
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+    bodies = sorted(int(body) for messages in delivered for _, body, _ in messages)
+    assert bodies == list(range(100))
+
+
+def test_process_data_events_waits_for_messages():
+    broker = InMemoryBroker()
+    consumer = InMemoryTransport(broker)
+    delivered = collect(consumer)
+    threading.Timer(0.05, publish, args=(broker, ["a"])).start()
+    consumer.process_data_events(time_limit=5)
+    assert [body for _, body, _ in delivered] == [b"a"]
+
+
+def test_get_transport():
+    assert isinstance(get_transport("memory"), InMemoryTransport)
+    with pytest.raises(ValueError):
+        get_transport("kafka")
+
+
+@mock.patch("queue_implementation.transport.pika.BlockingConnection")
+def test_pika_transport_reconnects_when_publishing(blocking_connection):
+    first, second = mock.MagicMock(), mock.MagicMock()
+    blocking_connection.side_effect = [first, second]
+    first.channel.return_value.basic_publish.side_effect = pika.exceptions.AMQPConnectionError
+    transport = PikaTransport(host="localhost")
+    transport.declare_queue(TEST_QUEUE)
+    transport.publish(TEST_QUEUE, "a")
+
+    first.close.assert_called_once()
+    # the queues are declared again on the new connection
+    second.channel.return_value.queue_declare.assert_called_once_with(queue=TEST_QUEUE)
+    second.channel.return_value.basic_publish.assert_called_once_with(
+        exchange="", routing_key=TEST_QUEUE, body="a", properties=None
+    )
+
+
+def publish_mock_events(broker, n_copies=1):
+    publish(
+        broker,
+        [json.dumps(event) for _ in range(n_copies) for event in json.loads(get_mock_json())],
+    )
+
+
+@mock.patch("queue_implementation.consumer.PgHook")
+def test_consumer_single_mode(pg_hook):
+    broker = InMemoryBroker(record_latencies=True)
+    publish_mock_events(broker)
+    cur = pg_hook.return_value.session.return_value.__enter__.return_value
+    consumer = Consumer(
+        host="", queue=TEST_QUEUE, table_md=get_mock_table_md(), transport=InMemoryTransport(broker)
+    )
+    thread = threading.Thread(target=consumer.consume_events)
+    thread.start()
+    assert broker.wait_idle(timeout=5)
+    consumer.stop()
+    thread.join(timeout=5)
+
+    assert [call[0][1][0][0] for call in cur.executemany.call_args_list] == ["foo", "bar"]
+    assert len(broker.ack_latencies) == 2
+
+
+@mock.patch("queue_implementation.consumer.PgHook")
+def test_consumer_batch_mode(pg_hook):
+    broker = InMemoryBroker()
+    publish_mock_events(broker, n_copies=3)
+    consumer = Consumer(
+        host="",
+        queue=TEST_QUEUE,
+        table_md=get_mock_table_md(),
+        batch_size=4,
+        max_linger=0.01,
+        transport=InMemoryTransport(broker),
+    )
+    thread = threading.Thread(target=consumer.batch_load_to_pgres)
+    thread.start()
+    assert broker.wait_idle(timeout=5)
+    consumer.stop()
+    thread.join(timeout=5)
+
+    # a full batch of 4 events, then the 2 left once they lingered
+    assert pg_hook.return_value.copy_stream.call_count == 2
+
+
+@mock.patch("queue_implementation.consumer.PgHook")
+def test_consumer_batch_mode_loads_buffered_events_when_stopped(pg_hook):
+    broker = InMemoryBroker()
+    publish_mock_events(broker)
+    consumer = Consumer(
+        host="",
+        queue=TEST_QUEUE,
+        table_md=get_mock_table_md(),
+        batch_size=10,
+        max_linger=60,
+        transport=InMemoryTransport(broker),
+    )
+    thread = threading.Thread(target=consumer.batch_load_to_pgres)
+    thread.start()
+    assert not broker.wait_idle(timeout=0.1)
+    consumer.stop()
+    thread.join(timeout=5)
+
+    pg_hook.return_value.copy_stream.assert_called_once()
+    assert broker.wait_idle(timeout=0)
@@ -1,6 +1,7 @@
 import pytest
 from time import sleep
 import random
+from os import listdir
 from os.path import join
 import threading
 from tempfile import TemporaryDirectory
@@ -44,6 +45,26 @@ def test_watcher_parses_existing_files():
     raw_data_dir.cleanup()
 
 
+def test_watcher_parses_existing_files_concurrently():
+    """Several files are handled by the worker threads over a single publishing connection"""
+    raw_data_dir = TemporaryDirectory(dir="/tmp", prefix="raw_data")
+    for _ in range(5):
+        with open(
+            join(raw_data_dir.name, f"events_data_{str(random.getrandbits(50))}.json"),
+            "w",
+        ) as f:
+            f.write(get_mock_json())
+            f.flush()
+    queue = Queue()
+    watcher = Watcher(
+        path=raw_data_dir.name, watchdog_queue=queue, rabbitmq_queue=TEST_QUEUE, workers=3
+    )
+    assert queue.empty()
+    assert not listdir(raw_data_dir.name)
+    watcher.close()
+    raw_data_dir.cleanup()
+
+
 def test_watcher_detects_new_file():
     raw_data_dir = TemporaryDirectory(dir="/tmp", prefix="raw_data")
     queue = Queue()
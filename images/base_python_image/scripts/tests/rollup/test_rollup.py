@@ -0,0 +1,255 @@
+import pytest
+import json
+import pandas as pd
+import threading
+from collections import Counter
+from datetime import date, datetime
+from dedupe import BloomFilter, Deduper
+from file_op import extract_data, stream_data
+from os.path import dirname, join
+from queue_implementation.consumer import Consumer
+from queue_implementation.producer import Producer
+from queue_implementation.transport import InMemoryBroker, InMemoryTransport
+from rollup import HyperLogLog, Rollup, event_day
+from sql_gen import TableMD
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from tests.mocks import get_mock_table_md
+from unittest import mock
+
+pytestmark = pytest.mark.unittests
+
+TEST_QUEUE = "test_queue"
+RAW_DATA_DIR = join(dirname(dirname(dirname(dirname(__file__)))), "raw_data")
+EVENTS = [
+    {"id": "1", "username": "anna", "user_type": "admin", "organization_name": "foo_org",
+     "received_at": "2020-12-08 10:00:00"},
+    {"id": "2", "username": "anna", "user_type": "admin", "organization_name": "foo_org",
+     "received_at": "2020-12-08 11:00:00"},
+    {"id": "3", "username": "bob", "user_type": None, "organization_name": "foo_org",
+     "received_at": "2020-12-08 12:00:00"},
+    {"id": "4", "username": "bob", "user_type": "user", "organization_name": "bar_org",
+     "received_at": "2020-12-09 10:00:00"},
+    {"id": "5", "username": None, "user_type": "user", "organization_name": "bar_org", "received_at": None},
+]
+COUNTS = {
+    (date(2020, 12, 8), "foo_org", "admin"): 2,
+    (date(2020, 12, 8), "foo_org", None): 1,
+    (date(2020, 12, 9), "bar_org", "user"): 1,
+}
+
+
+def events_table_md():
+    with NamedTemporaryFile() as f:
+        f.write(
+            b"""
+    table_name: raw_events
+    schema: test
+    delimiter: ","
+    filter_key: received_at
+    columns:
+      - name: id
+        type: varchar
+      - name: username
+        type: varchar
+      - name: user_type
+        type: varchar
+      - name: organization_name
+        type: varchar
+      - name: received_at
+        type: timestamp
+    """
+        )
+        f.seek(0)
+        return TableMD(f.name)
+
+
+def test_hyperloglog_estimate():
+    sketch = HyperLogLog()
+    for i in range(100000):
+        sketch.add(f"user_{i}")
+    assert sketch.estimate() == pytest.approx(100000, rel=0.03)
+    small = HyperLogLog()
+    for i in range(10):
+        small.add(f"user_{i % 5}")
+    assert small.estimate() == 5
+    assert HyperLogLog().estimate() == 0
+    with pytest.raises(ValueError):
+        HyperLogLog(precision=20)
+
+
+def test_hyperloglog_merge():
+    """Merged sketches estimate the union, whichever sketch saw a value"""
+    first, second, union = HyperLogLog(precision=10), HyperLogLog(precision=10), HyperLogLog(precision=10)
+    for i in range(5000):
+        (first if i % 2 else second).add(str(i))
+        union.add(str(i))
+        union.add(str(i))
+    first.merge(HyperLogLog(precision=10, registers=second.to_bytes()))
+    assert first.registers == union.registers
+    with pytest.raises(ValueError):
+        first.merge(HyperLogLog())
+    with pytest.raises(ValueError):
+        HyperLogLog(precision=10, registers=b"\x00")
+
+
+def test_event_day():
+    assert event_day("2020-12-08 20:03:16.759617") == date(2020, 12, 8)
+    assert event_day(datetime(2020, 12, 8, 20)) == date(2020, 12, 8)
+    assert event_day(date(2020, 12, 8)) == date(2020, 12, 8)
+    assert event_day(None) is None
+    assert event_day(float("nan")) is None
+
+
+def test_rollup_add_rows():
+    rollup = Rollup()
+    fields = list(EVENTS[0])
+    rollup.add_rows([tuple(event.values()) for event in EVENTS], fields)
+    assert dict(rollup.counts) == COUNTS
+    assert {day: sketch.estimate() for day, sketch in rollup.sketches.items()} == {
+        date(2020, 12, 8): 2,
+        date(2020, 12, 9): 1,
+    }
+
+
+def test_rollup_merge():
+    """Counters are added up in the table, the stored sketch of a day is merged with the new one"""
+    rollup = Rollup()
+    rollup.add_rows([tuple(event.values()) for event in EVENTS], list(EVENTS[0]))
+    stored = HyperLogLog()
+    stored.add("carl")
+    cur = mock.MagicMock()
+    cur.fetchall.return_value = [(date(2020, 12, 8), memoryview(stored.to_bytes())), (date(2020, 12, 9), b"")]
+    rollup.merge(cur)
+
+    assert "CREATE TABLE IF NOT EXISTS modelled.events_rollup (" in cur.execute.call_args_list[0][0][0]
+    counters, inserted_sketches, updated_sketches = [call[0] for call in cur.executemany.call_args_list]
+    assert "ON CONFLICT (received_at, (COALESCE(organization_name, '')), (COALESCE(user_type, '')))" in counters[0]
+    assert sorted(counters[1], key=str) == sorted([key + (n,) for key, n in COUNTS.items()], key=str)
+    assert [row[0] for row in inserted_sketches[1]] == [date(2020, 12, 8), date(2020, 12, 9)]
+    assert [(row[0], row[2]) for row in updated_sketches[1]] == [(3, date(2020, 12, 8)), (1, date(2020, 12, 9))]
+    # merged aggregates are cleared, merging again is a no-op
+    assert not rollup.counts and not rollup.sketches
+    cur.reset_mock()
+    rollup.merge(cur)
+    assert not cur.execute.called
+
+
+def test_extract_data_rollup():
+    rollup = Rollup()
+    with NamedTemporaryFile() as inputfile:
+        inputfile.write(json.dumps(EVENTS).encode("utf-8"))
+        inputfile.flush()
+        with TemporaryDirectory(dir="/tmp") as tmpdir:
+            for chunk_rows in (None, 2):
+                extract_data(
+                    src_path=inputfile.name,
+                    dst_path=join(tmpdir, "test"),
+                    columns=list(EVENTS[0]),
+                    chunk_rows=chunk_rows,
+                    rollup=rollup,
+                )
+        assert dict(rollup.counts) == {key: n * 2 for key, n in COUNTS.items()}
+
+        rollup = Rollup()
+        stream = stream_data(src_path=inputfile.name, table_md=events_table_md(), rollup=rollup)
+        assert not rollup.counts
+        stream.read()
+        assert dict(rollup.counts) == COUNTS
+
+
+def test_extract_data_rollup_counts_every_event():
+    """With the default dedupe key, the rollup of the sample counts every event but the one sent twice"""
+    events_path = join(RAW_DATA_DIR, "events", "events_sample.json")
+    events = pd.read_json(events_path, dtype=False).drop_duplicates()
+    deduper = Deduper(schema="test", table_name="test_table", pg_hook=mock.MagicMock())
+    deduper.bloom = BloomFilter(capacity=1000)
+    rollup = Rollup()
+    with TemporaryDirectory(dir="/tmp") as tmpdir:
+        extract_data(
+            src_path=events_path,
+            dst_path=join(tmpdir, "events"),
+            columns=list(events.columns),
+            deduper=deduper,
+            rollup=rollup,
+        )
+
+    days = pd.to_datetime(events["received_at"]).dt.date
+    per_day = Counter()
+    for (day, *_), n in rollup.counts.items():
+        per_day[day] += n
+    assert dict(per_day) == days.value_counts().to_dict()
+    groups = events.groupby([days, "organization_name", "user_type"], dropna=False).size()
+    # missing dimensions are grouped under None
+    assert {tuple(v if v == v else None for v in key): n for key, n in groups.items()} == dict(rollup.counts)
+
+
+@mock.patch("queue_implementation.consumer.PgHook")
+def test_consumer_merges_rollup_with_batch(pg_hook):
+    broker = InMemoryBroker()
+    producer = Producer(host="", queue=TEST_QUEUE, transport=InMemoryTransport(broker))
+    for event in EVENTS:
+        producer.publish_event(msg=json.dumps(event))
+    consumer = Consumer(
+        host="",
+        queue=TEST_QUEUE,
+        table_md=events_table_md(),
+        batch_size=10,
+        max_linger=0.01,
+        transport=InMemoryTransport(broker),
+        rollup=Rollup(),
+    )
+    thread = threading.Thread(target=consumer.batch_load_to_pgres)
+    thread.start()
+    assert broker.wait_idle(timeout=5)
+    consumer.stop()
+    thread.join(timeout=5)
+
+    # the batch is only aggregated by the callback committing along with the COPY
+    assert not consumer.rollup.counts
+    after_load = pg_hook.return_value.copy_stream.call_args[1]["after_load"]
+    cur = mock.MagicMock()
+    after_load(cur)
+    counters = cur.executemany.call_args_list[0][0][1]
+    assert sorted(counters, key=str) == sorted([key + (n,) for key, n in COUNTS.items()], key=str)
+    assert not consumer.rollup.counts
+
+
+@mock.patch("queue_implementation.consumer.PgHook")
+def test_consumer_counts_redelivered_message_once(pg_hook):
+    """The rollup of a message whose insert fails is left out, the message is counted once redelivered and loaded"""
+    broker = InMemoryBroker()
+    producer = Producer(host="", queue=TEST_QUEUE, transport=InMemoryTransport(broker))
+    producer.publish_event(msg=json.dumps(EVENTS[0]))
+    cur = pg_hook.return_value.session.return_value.__enter__.return_value
+    cur.executemany.side_effect = [RuntimeError("insert failed")] + [None] * 4
+    rollup = Rollup()
+    failing = Consumer(
+        host="", queue=TEST_QUEUE, table_md=events_table_md(), transport=InMemoryTransport(broker), rollup=rollup
+    )
+    with pytest.raises(RuntimeError):
+        failing.consume_events()
+    failing.close()
+    assert not rollup.counts
+
+    consumer = Consumer(
+        host="", queue=TEST_QUEUE, table_md=events_table_md(), transport=InMemoryTransport(broker), rollup=rollup
+    )
+    thread = threading.Thread(target=consumer.consume_events)
+    thread.start()
+    assert broker.wait_idle(timeout=5)
+    consumer.stop()
+    thread.join(timeout=5)
+
+    counters = [args[1] for args, _ in cur.executemany.call_args_list if "events_rollup (" in args[0]]
+    assert counters == [[(date(2020, 12, 8), "foo_org", "admin", 1)]]
+
+
+def test_consumer_needs_rollup_columns():
+    with pytest.raises(ValueError):
+        Consumer(
+            host="",
+            queue=TEST_QUEUE,
+            table_md=get_mock_table_md(),
+            transport=InMemoryTransport(InMemoryBroker()),
+            rollup=Rollup(),
+        )
@@ -0,0 +1,49 @@
+import pytest
+from datetime import datetime
+from row_codec import RowCodec, compile_extractor
+from tests.mocks import get_mock_table_md
+
+pytestmark = pytest.mark.unittests
+
+COLUMNS = [
+    {"name": "id", "type": "varchar", "length": 300},
+    {"name": "event_ts", "type": "timestamp"},
+]
+
+
+def test_extractor():
+    extract = compile_extractor(COLUMNS)
+    assert extract({"event_ts": "2020-12-08 20:03:16.759617", "id": "foo", "x": 1}) == (
+        "foo",
+        datetime(2020, 12, 8, 20, 3, 16, 759617),
+    )
+
+
+def test_extractor_missing_keys_are_null():
+    assert compile_extractor(COLUMNS)({"id": "foo"}) == ("foo", None)
+
+
+def test_extractor_without_coercion():
+    extract = compile_extractor(COLUMNS, coerce_timestamps=False)
+    assert extract({"id": "foo", "event_ts": "2020-12-08"}) == ("foo", "2020-12-08")
+
+
+def test_extractor_rejects_malformed_timestamps():
+    with pytest.raises(ValueError):
+        compile_extractor(COLUMNS)({"id": "foo", "event_ts": "not a timestamp"})
+
+
+def test_extractor_column_names_are_not_code():
+    """Column names are embedded in the generated code as string literals only"""
+    columns = [{"name": "a') or print('b", "type": "varchar"}]
+    assert compile_extractor(columns)({"a') or print('b": 1}) == (1,)
+
+
+def test_table_md_row_codec():
+    md = get_mock_table_md()
+    assert md.row_codec is md.row_codec
+    assert md.row_codec.fields == ("id", "event_type", "event_ts")
+    assert md.row_codec.extract_all([{"id": "foo"}, {"id": "bar"}]) == [
+        ("foo", None, None),
+        ("bar", None, None),
+    ]
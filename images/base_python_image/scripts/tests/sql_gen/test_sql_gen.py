@@ -1,4 +1,5 @@
 import pytest
+from datetime import datetime
 from sql_gen import SQLGenerator, TableMD
 from tests.mocks import get_mock_table_md
 
@@ -27,6 +28,16 @@ def test_table_md():
     }
 
 
+def test_table_md_partitioning_defaults():
+    md = get_mock_table_md()
+    assert md.partitioning is None
+    md.table_md["partitioning"] = {}
+    assert md.partitioning == {"key": "event_ts", "grain": "daily"}
+    md.table_md["partitioning"] = {"grain": "hourly"}
+    with pytest.raises(ValueError):
+        md.partitioning
+
+
 def test_table_md_path_not_exists():
     with pytest.raises(FileNotFoundError):
         TableMD("test")
@@ -55,6 +66,29 @@ CREATE TABLE IF NOT EXISTS test.test_table_delta(id varchar(300),event_type varc
     assert query.strip() == expected.strip()
 
 
+def test_table_md_with_columns():
+    md = get_mock_table_md()
+    enriched = md.with_columns(
+        [{"name": "org_key", "type": "varchar", "length": 300}, {"name": "id", "type": "varchar"}]
+    )
+    assert [col["name"] for col in enriched.columns] == ["id", "event_type", "event_ts", "org_key"]
+    assert enriched.row_codec.fields == ("id", "event_type", "event_ts", "org_key")
+    # the original metadata is left untouched
+    assert [col["name"] for col in md.columns] == ["id", "event_type", "event_ts"]
+
+
+def test_add_columns_query():
+    gen = SQLGenerator(get_mock_table_md())
+    query = gen.add_columns_query([{"name": "org_key", "type": "varchar", "length": 300}])
+    assert query == "ALTER TABLE test.test_table_delta ADD COLUMN IF NOT EXISTS org_key varchar(300);"
+
+
+def test_notify_loaded_query():
+    """Delta tables are upserted into their master table, which is the table notified"""
+    gen = SQLGenerator(get_mock_table_md())
+    assert gen.notify_loaded_query() == "SELECT pg_notify('table_loaded', 'test.test_table');"
+
+
 def test_insert_value_into():
     md = get_mock_table_md()
     gen = SQLGenerator(md)
@@ -63,6 +97,14 @@ def test_insert_value_into():
     assert query.strip() == expected.strip()
 
 
+def test_insert_query():
+    md = get_mock_table_md()
+    gen = SQLGenerator(md)
+    query = gen.insert_query()
+    expected = "INSERT INTO test.test_table_delta (id,event_type,event_ts) VALUES (%s,%s,%s);"
+    assert query == expected
+
+
 def test_copy_query():
     md = get_mock_table_md()
     gen = SQLGenerator(md)
@@ -76,15 +118,121 @@ def test_copy_query():
     assert query.replace(" ", "") == expected.replace(" ", "")
 
 
+def test_copy_query_binary():
+    gen = SQLGenerator(get_mock_table_md())
+    assert (
+        gen.copy_query("binary")
+        == "COPY test.test_table_delta (id,event_type,event_ts) FROM STDIN WITH (FORMAT binary)"
+    )
+    with pytest.raises(ValueError):
+        gen.copy_query("parquet")
+
+
 def test_upsert_on_id_query():
     md = get_mock_table_md()
     gen = SQLGenerator(md)
     query = gen.upsert_on_id()
     expected = """
     CREATE TABLE IF NOT EXISTS test.test_table (LIKE test.test_table_delta);
+    CREATE INDEX IF NOT EXISTS test_table_id_idx ON test.test_table (id);
+    ANALYZE test.test_table_delta;
     DELETE FROM test.test_table WHERE id
     IN (SELECT id FROM test.test_table_delta);
     INSERT INTO test.test_table SELECT * FROM test.test_table_delta;
 """
     # comparing exact match of string because spaces can cause unexpected assertion failures
     assert query.replace(" ", "") == expected.replace(" ", "")
+
+
+def test_upsert_on_conflict_query():
+    md = get_mock_table_md()
+    md.table_md["delta_params"]["strategy"] = "on_conflict"
+    gen = SQLGenerator(md)
+    query = gen.upsert_on_id()
+    expected = """
+    CREATE TABLE IF NOT EXISTS test.test_table (LIKE test.test_table_delta);
+    CREATE UNIQUE INDEX IF NOT EXISTS test_table_id_uidx ON test.test_table (id);
+    INSERT INTO test.test_table (id,event_type,event_ts)
+    SELECT id,event_type,event_ts FROM (SELECT DISTINCT ON (id) * FROM test.test_table_delta ORDER BY id, event_ts DESC) AS delta
+    ON CONFLICT (id) DO UPDATE SET event_type = EXCLUDED.event_type, event_ts = EXCLUDED.event_ts;
+"""
+    assert query.replace(" ", "") == expected.replace(" ", "")
+
+
+@pytest.mark.parametrize(
+    "server_version, uses_merge", [(None, False), (140009, False), (150004, True)]
+)
+def test_upsert_merge_query(server_version, uses_merge):
+    md = get_mock_table_md()
+    md.table_md["delta_params"]["strategy"] = "merge"
+    gen = SQLGenerator(md)
+    query = gen.upsert_on_id(server_version=server_version)
+    # servers without MERGE fall back to INSERT ... ON CONFLICT
+    assert ("MERGE INTO test.test_table AS master" in query) is uses_merge
+    assert ("ON CONFLICT (id)" in query) is not uses_merge
+    assert "CREATE UNIQUE INDEX IF NOT EXISTS test_table_id_uidx" in query
+
+
+def test_upsert_on_conflict_rejects_partitioning():
+    md = get_mock_table_md()
+    md.table_md["delta_params"]["strategy"] = "on_conflict"
+    md.table_md["partitioning"] = {}
+    with pytest.raises(ValueError):
+        SQLGenerator(md).upsert_on_id()
+
+
+def test_create_partitioned_table_query():
+    md = get_mock_table_md()
+    md.table_md["delta_params"] = None
+    md.table_md["partitioning"] = {"grain": "monthly"}
+    gen = SQLGenerator(md)
+    expected = """
+CREATE TABLE IF NOT EXISTS test.test_table_delta(id varchar(300),event_type varchar(100),event_ts timestamp) PARTITION BY RANGE (event_ts);
+CREATE TABLE IF NOT EXISTS test.test_table_delta_default PARTITION OF test.test_table_delta DEFAULT;
+    """
+    query = gen.create_table_query()
+    # a table of the same name created before partitioning was set is rejected
+    assert query.startswith(gen.require_partitioned_query("test_table_delta"))
+    assert "WHERE n.nspname = 'test' AND c.relname = 'test_table_delta' AND c.relkind <> 'p'" in query
+    assert query[len(gen.require_partitioned_query("test_table_delta")):].strip() == expected.strip()
+
+
+def test_create_partition_query():
+    md = get_mock_table_md()
+    md.table_md["partitioning"] = {"grain": "monthly"}
+    gen = SQLGenerator(md)
+    lower_bound = gen.partition_lower_bound("2020-12-08 20:03:16.759617")
+    assert lower_bound == datetime(2020, 12, 1)
+    query = gen.create_partition_query(lower_bound)
+    # partitions of delta loads belong to the master table
+    assert "FOR lower_bound IN SELECT '2020-12-01 00:00:00'::TIMESTAMP LOOP" in query
+    assert "partition_name := 'test_table_p' || to_char(lower_bound, 'YYYYMM');" in query
+    assert "INTERVAL '1 month'" in query
+    assert "TRUNCATE" not in query
+    assert "PERFORM pg_advisory_xact_lock(hashtext('test.test_table'));" in query
+
+
+def test_upsert_partition_replace_query():
+    md = get_mock_table_md()
+    md.table_md["partitioning"] = {"grain": "daily"}
+    md.table_md["delta_params"]["strategy"] = "partition_replace"
+    gen = SQLGenerator(md)
+    query = gen.upsert_on_id()
+    assert (
+        "CREATE TABLE IF NOT EXISTS test.test_table (LIKE test.test_table_delta) PARTITION BY RANGE (event_ts);"
+        in query
+    )
+    assert "SELECT DISTINCT date_trunc('day', event_ts) FROM test.test_table_delta" in query
+    assert "c.relname = 'test_table' AND c.relkind <> 'p'" in query
+    assert "EXECUTE format('TRUNCATE %I.%I', 'test', partition_name);" in query
+    assert "DELETE FROM test.test_table WHERE" not in query
+    assert query.strip().endswith(
+        "INSERT INTO test.test_table SELECT * FROM test.test_table_delta;"
+    )
+
+
+def test_upsert_partition_replace_requires_partitioning():
+    md = get_mock_table_md()
+    md.table_md["delta_params"]["strategy"] = "partition_replace"
+    with pytest.raises(ValueError):
+        SQLGenerator(md).upsert_on_id()
@@ -0,0 +1,69 @@
+import pytest
+import pandas as pd
+from datetime import datetime, timedelta
+from unittest import mock
+from file_index import LoadWindow
+from watermark import Watermarks
+
+pytestmark = pytest.mark.unittests
+
+
+def test_window_for_date():
+    """A date includes the midnight of the next day, as the date filter always did"""
+    window = LoadWindow.for_date("2020-12-08")
+    assert window.contains(datetime(2020, 12, 8))
+    assert window.contains(datetime(2020, 12, 9))
+    assert not window.contains(datetime(2020, 12, 9, 0, 0, 1))
+    assert not window.contains(datetime(2020, 12, 7, 23, 59))
+
+
+def test_window_for_dates():
+    window = LoadWindow.for_dates("2020-12-01", "2020-12-07")
+    assert window == LoadWindow(start=datetime(2020, 12, 1), end=datetime(2020, 12, 8))
+    with pytest.raises(ValueError):
+        LoadWindow.for_dates("2020-12-07", "2020-12-01")
+    with pytest.raises(ValueError):
+        LoadWindow.for_dates("2020-12-01", "12/07/2020")
+
+
+def test_window_of():
+    window = LoadWindow(start=datetime(2020, 12, 1))
+    assert LoadWindow.of(window) is window
+    assert LoadWindow.of("2020-12-08") == LoadWindow.for_date("2020-12-08")
+
+
+def test_window_mask():
+    values = pd.Series(["2020-12-08 10:00:00", None, "2020-12-09 10:00:00", "2020-12-07 10:00:00"])
+    assert LoadWindow(start=datetime(2020, 12, 8)).mask(values).tolist() == [True, False, True, False]
+    assert LoadWindow().mask(values).tolist() == [True, False, True, True]
+    assert LoadWindow.for_date("2020-12-08").mask(values).tolist() == [True, False, False, False]
+
+
+def test_window_overlaps():
+    window = LoadWindow(start=datetime(2020, 12, 8))
+    assert window.overlaps(datetime(2020, 12, 1), datetime(2020, 12, 8))
+    assert not window.overlaps(datetime(2020, 12, 1), datetime(2020, 12, 7))
+    assert LoadWindow(end=datetime(2020, 12, 1)).overlaps(datetime(2020, 1, 1), datetime(2021, 1, 1))
+
+
+@pytest.mark.parametrize(
+    "watermark, expected",
+    [
+        (None, LoadWindow()),
+        (datetime(2020, 12, 8, 12), LoadWindow(start=datetime(2020, 12, 8, 11))),
+    ],
+)
+def test_watermarks_window(mocker, watermark, expected):
+    """The next load starts at the watermark minus the lateness, everything is loaded without a watermark"""
+    mocker.patch("watermark.Watermarks.get", return_value=watermark)
+    watermarks = Watermarks(schema="test", pg_hook=None)
+    assert watermarks.window("events", lateness=timedelta(hours=1)) == expected
+
+
+def test_watermarks_advance():
+    cur = mock.MagicMock()
+    Watermarks(schema="test", pg_hook=None).advance(cur, "events", loaded_table="events_delta", key="event_ts")
+    query, params = cur.execute.call_args[0]
+    assert "max(event_ts) FROM test.events_delta" in query
+    assert "GREATEST(load_watermarks.watermark, EXCLUDED.watermark)" in query
+    assert params == ("events",)
@@ -0,0 +1,75 @@
+import logging
+import psycopg2.extensions
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Optional
+from file_index import LoadWindow
+from psql_client import PgHook
+
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+CREATE_WATERMARKS_SQL = """
+CREATE TABLE IF NOT EXISTS {schema}.load_watermarks (
+    table_name varchar(300) PRIMARY KEY,
+    watermark timestamp NOT NULL,
+    updated_at timestamp NOT NULL DEFAULT now()
+);
+"""
+
+
+@dataclass
+class Watermarks:
+    """
+    High watermarks of the tables loaded incrementally, kept in {schema}.load_watermarks next to the tables: the
+    largest filter key value loaded into every table. Incremental loads only load the records from the watermark on
+    (minus a lateness window for records arriving late), the upsert into the master table making it harmless to
+    load records at the watermark again.
+    :param schema: Schema of the tables, holding the watermarks
+    :type schema: str
+    :param pg_hook: Hook used for reading the watermarks
+    :type pg_hook: PgHook
+    """
+
+    schema: str
+    pg_hook: PgHook = field(default_factory=PgHook)
+
+    def create_table_query(self) -> str:
+        return CREATE_WATERMARKS_SQL.format(schema=self.schema)
+
+    def get(self, table_name: str) -> Optional[datetime]:
+        """Watermark of a table, None when nothing was loaded incrementally into it yet"""
+        with self.pg_hook.session() as cur:
+            cur.execute(self.create_table_query())
+            cur.execute(
+                f"SELECT watermark FROM {self.schema}.load_watermarks WHERE table_name = %s",
+                (table_name,),
+            )
+            row = cur.fetchone()
+        return row[0] if row else None
+
+    def window(self, table_name: str, lateness: timedelta = timedelta(0)) -> LoadWindow:
+        """Window of the next incremental load of a table, everything when there is no watermark yet"""
+        watermark = self.get(table_name)
+        if watermark is None:
+            logger.info(f"no watermark for {table_name}, loading everything")
+            return LoadWindow()
+        return LoadWindow(start=watermark - lateness)
+
+    def advance(
+        self, cur: psycopg2.extensions.cursor, table_name: str, loaded_table: str, key: str
+    ) -> None:
+        """
+        Moves the watermark of a table up to the largest key value of the rows loaded into loaded_table (the delta
+        table), on the cursor (transaction) of the load. The watermark never moves back and is left as is when
+        nothing was loaded.
+        """
+        cur.execute(self.create_table_query())
+        cur.execute(
+            f"""INSERT INTO {self.schema}.load_watermarks (table_name, watermark)
+            SELECT %s, max({key}) FROM {self.schema}.{loaded_table} HAVING max({key}) IS NOT NULL
+            ON CONFLICT (table_name) DO UPDATE
+            SET watermark = GREATEST(load_watermarks.watermark, EXCLUDED.watermark), updated_at = now()""",
+            (table_name,),
+        )